@@ -1,6 +1,7 @@
 import os
 from datetime import datetime, time
 from threading import Thread
+from time import perf_counter
 
 import numpy as np
 import pvporcupine
@@ -8,31 +9,243 @@ import pvporcupine
 import soundfile
 from pvrecorder import PvRecorder
 
-import speech_recognition as sr #Speech Recognition and Audio
-import numpy as np
+from vad import Endpointer
+from metrics import METRICS, FrameLoopMonitor
+from audio_writer import default_writer
+from startup import STARTUP
 
 def show_audio_devices():
     for i, dev in enumerate(PvRecorder.get_audio_devices()):
         print(f'[{i}]: {dev}')
 
-def record_seconds(device_id, seconds = 3, sample_rate = 16_000, frame_length = 512):
-    recorder = PvRecorder(device_index=device_id, frame_length=frame_length, 
+def record_seconds(device_id, seconds = 3, sample_rate = 16_000, frame_length = 512, endpointer = None,
+                   recorder_factory = PvRecorder):
+    """
+    Record audio from a device. If an Endpointer is given, `seconds` is the
+    maximum length and recording stops as soon as the speaker is done.
+    `recorder_factory` builds the recorder, with the same arguments as PvRecorder.
+    """
+    recorder = recorder_factory(device_index=device_id, frame_length=frame_length, 
         buffer_size_msec=1000, log_overflow=True)
 
-    num_loops = (seconds * sample_rate) // frame_length
-    frames = []
+    num_loops = int(seconds * sample_rate) // frame_length
+    audio = np.empty(num_loops * frame_length, dtype=np.int16)
+
+    if endpointer is not None:
+        endpointer.reset()
+    monitor = FrameLoopMonitor(sample_rate)
 
     recorder.start()
+    num_recorded = 0
     for i in range(num_loops):
-        frames.append(recorder.read())
+        frame = audio[i * frame_length:(i + 1) * frame_length]
+        frame[:] = recorder.read()
+        monitor.tick(frame_length)
+        num_recorded += frame_length
+
+        if endpointer is not None and endpointer.update(frame):
+            break
     recorder.stop()
     recorder.delete()
-    return frames
+    return audio[:num_recorded]
+
+def write_audio(audio, output_path, sample_rate = 16_000, background = True):
+    """
+    Write int16 audio to a file. Accepts a 1-D array/view or a list of frames.
+    By default the file is written by the background AudioWriter in its
+    configured format. Returns the file name written.
+    """
+    if not isinstance(audio, np.ndarray):
+        audio = np.concatenate(audio, axis=0)
+    if background:
+        return default_writer().write(audio, output_path, sample_rate = sample_rate)
 
-def write_audio(audio_frames, output_path, sample_rate = 16_000):
-    recorded_audio = np.concatenate(audio_frames, axis=0).astype(np.int16)
-    soundfile.write(output_path, recorded_audio, samplerate=sample_rate, subtype='PCM_16')
+    soundfile.write(output_path, audio.astype(np.int16, copy=False), samplerate=sample_rate, subtype='PCM_16')
     print("Saved audio to file:", output_path)
+    return output_path
+
+class AudioRingBuffer:
+    """
+    Preallocated int16 ring buffer holding the most recent `seconds` of audio.
+
+    Every sample is stored twice (at `i` and `i + capacity`), so any window of
+    up to `capacity` samples can be returned as one contiguous zero-copy view.
+    Views stay valid until the samples they cover are overwritten.
+    """
+
+    def __init__(self, seconds, sample_rate = 16_000):
+        self.sample_rate = sample_rate
+        self.capacity = int(seconds * sample_rate)
+        self.total_written = 0
+
+        self._buffer = np.zeros(2 * self.capacity, dtype=np.int16)
+        self._write_pos = 0
+
+    def write(self, pcm):
+        """Copy a frame of samples into the buffer and return a view of it."""
+        n = len(pcm)
+        if n > self.capacity:
+            raise ValueError("Frame is larger than the ring buffer.")
+
+        cap = self.capacity
+        start = self._write_pos
+        end = start + n
+        if end <= cap:
+            self._buffer[start:end] = pcm
+            self._buffer[start + cap:end + cap] = self._buffer[start:end]
+        else:
+            #Frame wraps around the end of the buffer
+            split = cap - start
+            self._buffer[start:cap] = pcm[:split]
+            self._buffer[0:n - split] = pcm[split:]
+            self._buffer[start + cap:] = self._buffer[start:cap]
+            self._buffer[cap:cap + n - split] = self._buffer[0:n - split]
+
+        self._write_pos = end % cap
+        self.total_written += n
+        return self.view(self.total_written - n)
+
+    def view(self, start, end = None):
+        """
+        Return a zero-copy view of the absolute sample positions [start, end).
+        Positions older than the buffer capacity are clipped away.
+        """
+        if end is None:
+            end = self.total_written
+        start = max(start, self.total_written - self.capacity, 0)
+        end = max(min(end, self.total_written), start)
+
+        offset = start % self.capacity if self.capacity else 0
+        return self._buffer[offset:offset + (end - start)]
+
+    def latest(self, seconds):
+        """Return a view of the most recent `seconds` of audio."""
+        return self.view(self.total_written - int(seconds * self.sample_rate))
+
+def keyword_names(keyword_paths):
+    """Turn Porcupine keyword file paths into the spoken keywords."""
+    keywords = list()
+    for x in keyword_paths:
+        keyword_phrase_part = os.path.basename(x).replace('.ppn', '').split('_')
+        if len(keyword_phrase_part) > 6:
+            keywords.append(' '.join(keyword_phrase_part[0:-6]))
+        else:
+            keywords.append(keyword_phrase_part[0])
+    return keywords
+
+class WakeDetector:
+    """
+    Wake word detection and endpointing over a continuous stream of audio
+    frames. Every frame is kept in a ring buffer, and process() reports what
+    happened as a list of events:
+
+    - (WakeDetector.WAKE, keyword, pre-roll audio) when the wake word is heard,
+    - (WakeDetector.AUDIO, keyword, frame) for each frame of the command after it,
+    - (WakeDetector.END, keyword, utterance) when the endpointer decides the command is over.
+
+    Audio in events are zero-copy views into the ring buffer, valid until overwritten.
+    """
+
+    WAKE = 'wake'
+    AUDIO = 'audio'
+    END = 'end'
+
+    NO_EVENTS = ()
+
+    def __init__(
+            self,
+            library_path=pvporcupine.LIBRARY_PATH,
+            model_path=pvporcupine.MODEL_PATH,
+            keyword_paths=[pvporcupine.KEYWORD_PATHS['jarvis']],
+            sensitivities=[0.5],
+            preroll_seconds=0.5,
+            endpointer=None,
+            wake_engine=None):
+        """
+        Constructor. Takes the same keyword settings as WakeThread.
+        :param wake_engine: Optional object used instead of Porcupine, with Porcupine's `process`, `delete`,
+        `sample_rate` and `frame_length`. Used to replay recordings without the wake word engine.
+        """
+        self.keywords = keyword_names(keyword_paths)
+        self.sensitivities = sensitivities
+
+        if wake_engine is None:
+            wake_engine = pvporcupine.create(
+                library_path=library_path,
+                model_path=model_path,
+                keyword_paths=keyword_paths,
+                sensitivities=sensitivities)
+        self._porcupine = wake_engine
+        self.sample_rate = self._porcupine.sample_rate
+        self.frame_length = self._porcupine.frame_length
+
+        self.endpointer = endpointer if endpointer is not None else Endpointer(sample_rate=self.sample_rate)
+
+        #Keep enough audio for the pre-roll plus the longest possible utterance
+        self.ring_buffer = AudioRingBuffer(
+            preroll_seconds + self.endpointer.max_seconds + 1, sample_rate=self.sample_rate)
+        self._preroll_samples = int(preroll_seconds * self.sample_rate)
+
+        self.listening = False
+        self.keyword = None
+        self._utterance_start = 0
+
+        self._wake_timing = METRICS.histogram('wake_detection')
+        self._endpoint_delay = METRICS.histogram('endpointing')
+        self._wakes = METRICS.counter('wakes')
+
+    def start_listening(self, keyword = None, include_preroll = True):
+        """Begin an utterance without waiting for the wake word, e.g. for a follow up answer."""
+        self.listening = True
+        self.keyword = keyword
+        self._utterance_start = self.ring_buffer.total_written - (self._preroll_samples if include_preroll else 0)
+        self.endpointer.reset()
+
+    def cancel(self):
+        """Abandon the current utterance, e.g. when another microphone heard the wake word better."""
+        self.listening = False
+
+    def utterance(self):
+        """Zero-copy view of the current utterance so far, including pre-roll."""
+        return self.ring_buffer.view(self._utterance_start)
+
+    def process(self, pcm, detect = True):
+        """
+        Feed one frame of audio and return the events it caused. With
+        `detect` False the frame is only recorded, skipping wake word
+        detection and noise tracking while idle to save CPU.
+        """
+        frame = self.ring_buffer.write(pcm) #Always record, so pre-roll is available
+
+        if not self.listening:
+            if not detect:
+                return self.NO_EVENTS
+            start = perf_counter()
+            result = self._porcupine.process(pcm)
+            self._wake_timing.observe(perf_counter() - start)
+            if result < 0:
+                #Keep adjusting to background noise while idle
+                self.endpointer.observe(frame)
+                return self.NO_EVENTS
+
+            self.start_listening(self.keywords[result])
+            self._wakes.inc()
+            print('[%s] Detected %s' % (str(datetime.now()), self.keyword))
+            print("Noise floor (dB):", getattr(self.endpointer.vad, 'noise_db', None))
+            self.endpointer.update(frame)
+            return [(self.WAKE, self.keyword, self.ring_buffer.view(self._utterance_start))]
+
+        events = [(self.AUDIO, self.keyword, frame)]
+        if self.endpointer.update(frame):
+            print(f"Total Seconds: {self.endpointer.total_seconds:.2f}, Speech Seconds: {self.endpointer.speech_seconds:.2f}")
+            self.listening = False
+            #Trailing silence waited for before deciding the speaker was done
+            self._endpoint_delay.observe(self.endpointer.seconds_silent)
+            events.append((self.END, self.keyword, self.ring_buffer.view(self._utterance_start)))
+        return events
+
+    def delete(self):
+        self._porcupine.delete()
 
 class WakeThread(Thread):
     """
@@ -47,7 +260,13 @@ class WakeThread(Thread):
             keyword_paths=[pvporcupine.KEYWORD_PATHS['jarvis']],
             sensitivities=[0.5],
             input_device_index=None,
-            output_path=None):
+            output_path=None,
+            preroll_seconds=0.5,
+            endpointer=None,
+            on_wake=None,
+            on_audio=None,
+            recorder_factory=PvRecorder,
+            wake_engine=None):
 
         """
         Constructor.
@@ -59,7 +278,17 @@ class WakeThread(Thread):
         be used.
         :param input_device_index: Optional argument. If provided, audio is recorded from this input device. Otherwise,
         the default audio input device is used.
-        :param output_path: If provided recorded audio will be stored in this location at the end of the run.
+        :param output_path: If provided recorded audio is streamed to this file while it is captured. Its extension
+        follows the AudioWriter's format and `{timestamp}` is replaced by the time of the recording.
+        :param preroll_seconds: Seconds of audio captured before the wake word fired to include in the recording, so
+        the start of the command isn't cut off.
+        :param endpointer: Endpointer deciding when the command after the wake word has ended. Defaults to an
+        Endpointer using the EnergyFluxVAD.
+        :param on_wake: Optional callback `on_wake(keyword, audio)` called as soon as the wake word is detected, with
+        the pre-roll audio recorded so far. Lets consumers such as streaming recognition start before the end of speech.
+        :param on_audio: Optional callback `on_audio(frame)` called with every frame recorded after the wake word.
+        :param recorder_factory: Builds the audio recorder, with the same arguments as PvRecorder.
+        :param wake_engine: Optional replacement for Porcupine, see WakeDetector.
         """
 
         super(WakeThread, self).__init__()
@@ -72,115 +301,96 @@ class WakeThread(Thread):
         self._input_device_index = input_device_index
 
         self._output_path = output_path
-        self._recorded_frames = []
+        self._preroll_seconds = preroll_seconds
+        self._endpointer = endpointer
+        self._on_wake = on_wake
+        self._on_audio = on_audio
+        self._wake_engine = wake_engine
+        self.recorder_factory = recorder_factory
+
+        self._recorded_audio = np.zeros(0, dtype=np.int16)
+
+    @property
+    def input_device_index(self):
+        return self._input_device_index
+
+    def create_detector(self, endpointer = None):
+        """
+        Create a WakeDetector with this thread's keyword and endpointing settings.
+        :param endpointer: Overrides the thread's endpointer, e.g. to give each of several detectors their own.
+        """
+        return WakeDetector(
+            library_path=self._library_path,
+            model_path=self._model_path,
+            keyword_paths=self._keyword_paths,
+            sensitivities=self._sensitivities,
+            preroll_seconds=self._preroll_seconds,
+            endpointer=endpointer if endpointer is not None else self._endpointer,
+            wake_engine=self._wake_engine)
 
     def run(self):
         """
          Creates an input audio stream, instantiates an instance of Porcupine object, and monitors the audio stream for
          occurrences of the wake word(s). It prints the time of detection for each occurrence and the wake word.
          """
-
-        keywords = list()
-        for x in self._keyword_paths:
-            keyword_phrase_part = os.path.basename(x).replace('.ppn', '').split('_')
-            if len(keyword_phrase_part) > 6:
-                keywords.append(' '.join(keyword_phrase_part[0:-6]))
-            else:
-                keywords.append(keyword_phrase_part[0])
-
-        porcupine = None
+        detector = None
         recorder = None
-        result = None
-
-        #Wait for speech to begin and adjust for background noise
-        self.voice_threshold = 4
-        self.threshold_alpha = 0.8
-        self.pause_threshold = 2
-        self.silent_threshold = 1.2
-        self.timeout_seconds = 10
-
-        keyword_reached = False
-        seconds_silent = 0
+        output_stream = None
+        keyword = None
+        sample_rate = 16_000
 
         try:
-            porcupine = pvporcupine.create(
-                library_path=self._library_path,
-                model_path=self._model_path,
-                keyword_paths=self._keyword_paths,
-                sensitivities=self._sensitivities)
+            detector = self.create_detector()
+            sample_rate = detector.sample_rate
 
-            recorder = PvRecorder(device_index=self._input_device_index, frame_length=porcupine.frame_length)
+            recorder = self.recorder_factory(device_index=self._input_device_index, frame_length=detector.frame_length)
             recorder.start()
+            monitor = FrameLoopMonitor(sample_rate)
+            STARTUP.listening()
 
             print(f'Listening on device {recorder.selected_device} (')
-            for keyword, sensitivity in zip(keywords, self._sensitivities):
-                print('  %s (%.2f)' % (keyword, sensitivity))
+            for name, sensitivity in zip(detector.keywords, detector.sensitivities):
+                print('  %s (%.2f)' % (name, sensitivity))
             print(')')
 
-            # num_loops = (seconds * SRATE) / FRAME_LENGTH
-            # num_loops = seconds / seconds_per_loop
-            # seconds / seconds_per_loop = (seconds * SRATE) / FRAME_LENGTH
-            # 1 / seconds_per_loop = SRATE / FRAME_LENGTH
-            # seconds_per_loop = FRAME_LENGTH / SRATE
-            seconds_per_loop = porcupine.frame_length / porcupine.sample_rate
-            alpha = self.threshold_alpha ** (1 / seconds_per_loop) #Adjust alpha to compensate for number of loops needed for 1s
-
-            total_seconds = 0
-            while True:
-                pcm = recorder.read() #Read in audio buffer
-
-                result = porcupine.process(pcm)
-                if result >= 0:
-                    keyword_reached = True
-                    print('[%s] Detected %s' % (str(datetime.now()), keywords[result]))
-                    print("Voice Threshold set to:", self.voice_threshold)
-                
-                amplitude = np.mean(np.abs(np.array(pcm, dtype=np.int16)))
-                log_amplitude = np.log(amplitude)
-
-                # print(f"Amplitude: {amplitude:.2f}, Log Amplitude: {log_amplitude:.2f}, Seoncds Silent: {seconds_silent:.2f}")
-                
-                #Record frames
-                if keyword_reached:
-                    self._recorded_frames.append(pcm)
-
-                    total_seconds += seconds_per_loop
-
-                    #If amplitude falls below voice threshold, count as silent
-                    if log_amplitude < self.voice_threshold * self.silent_threshold:
-                        seconds_silent += seconds_per_loop
-                    else:
-                        seconds_silent = 0
-
-                    #Print Debug output each second of audio
-                    if int(total_seconds - seconds_per_loop) != int(total_seconds):
-                        print(f"Total Seconds: {total_seconds:.2f}, Amplitude (log): {log_amplitude:.2f}, Seconds Silent: {seconds_silent:.2f}")
-                    
-                    #If we have reached timeout or remained silent for logner than pause_threshold, then end
-                    if total_seconds > self.timeout_seconds or seconds_silent > self.pause_threshold:
-                        break
-
-                #Else continue listening to background audio
-                else:
-                    #Adjust voice threshold to adjust to background noise
-                    self.voice_threshold = (log_amplitude * alpha) + (self.voice_threshold * (1 - alpha))
+            finished = False
+            while not finished:
+                pcm = recorder.read()
+                monitor.tick(len(pcm))
+                for event, keyword, audio in detector.process(pcm):
+                    if event == WakeDetector.WAKE:
+                        #Write the recording to disk in the background while it is captured
+                        if self._output_path is not None:
+                            output_stream = default_writer().open(self._output_path, sample_rate = sample_rate)
+                            output_stream.write(audio)
+                        if self._on_wake is not None:
+                            self._on_wake(keyword, audio)
+                    elif event == WakeDetector.AUDIO:
+                        if output_stream is not None:
+                            output_stream.write(audio)
+                        if self._on_audio is not None:
+                            self._on_audio(audio)
+                    elif event == WakeDetector.END:
+                        #Zero-copy view of the utterance (including pre-roll) in the ring buffer
+                        self._recorded_audio = audio
+                        finished = True
 
         except KeyboardInterrupt:
             print('Stopping ...')
             
         finally:
-            if porcupine is not None:
-                porcupine.delete()
+            if detector is not None:
+                detector.delete()
 
             if recorder is not None:
                 recorder.delete()
 
+            if output_stream is not None:
+                output_stream.close()
+
             #Call back
             print("Listening Resources deleted, calling back...")
-            self._callback(keywords[result], self._recorded_frames)
-
-            if self._output_path is not None and len(self._recorded_frames) > 0:
-                write_audio(self._recorded_frames, self._output_path, sample_rate = porcupine.sample_rate)
+            self._callback(keyword, self._recorded_audio)
 
 class ListenInputThread(Thread):
     """
@@ -189,53 +399,46 @@ class ListenInputThread(Thread):
 
     def __init__(
             self,
-            callback = lambda keyword: print('[%s] Detected %s' % (str(datetime.now()), keyword)),
+            callback = lambda audio: print('[%s] Recorded %d samples' % (str(datetime.now()), len(audio))),
             timeout_seconds = 3,
             input_device_index = None,
-            output_path = 'data/logs/latest_input.wav'):
+            output_path = 'data/logs/input_{timestamp}.wav',
+            endpointer = None,
+            recorder_factory = PvRecorder):
 
         """
         Constructor.
+        :param timeout_seconds: Maximum number of seconds to listen for.
         :param input_device_index: Optional argument. If provided, audio is recorded from this input device. Otherwise,
         the default audio input device is used.
         :param output_path: If provided recorded audio will be stored in this location at the end of the run.
+        :param endpointer: Optional Endpointer. If provided, listening stops once the speaker is done instead of
+        always running until timeout.
+        :param recorder_factory: Builds the audio recorder, with the same arguments as PvRecorder.
         """
 
-        super(WakeThread, self).__init__()
+        super(ListenInputThread, self).__init__()
 
         self._callback = callback
         self._timeout_seconds = timeout_seconds
         self._input_device_index = input_device_index
         self._output_path = output_path
+        self._endpointer = endpointer
+        self._recorder_factory = recorder_factory
 
-        self._recorded_frames = []
+        self._recorded_audio = np.zeros(0, dtype=np.int16)
 
     def run(self):
-        """Creates an input audio stream and listens until timeout."""
-        recorder = None
-
+        """Creates an input audio stream and listens until timeout or the end of speech."""
         try:
-            recorder = PvRecorder(device_index=self._input_device_index, frame_length=512)
-            recorder.start()
-
-            seconds = 0
-            while True:
-                pcm = recorder.read() #Read in audio buffer
-                
-                self._recorded_frames.append(pcm)
-
-                seconds += 1
-                if seconds > self._timeout_seconds:
-                    break
+            self._recorded_audio = record_seconds(self._input_device_index, seconds = self._timeout_seconds,
+                endpointer = self._endpointer, recorder_factory = self._recorder_factory)
 
         except KeyboardInterrupt:
             print('Stopping ...')
             
         finally:
-            if recorder is not None:
-                recorder.delete()
-            
-            self._callback(self._recorded_frames)
+            self._callback(self._recorded_audio)
 
-            if self._output_path is not None and len(self._recorded_frames) > 0:
-                write_audio(self._recorded_frames, self._output_path)
\ No newline at end of file
+            if self._output_path is not None and len(self._recorded_audio) > 0:
+                write_audio(self._recorded_audio, self._output_path)
\ No newline at end of file
@@ -0,0 +1,282 @@
+import os
+import time
+import queue
+import atexit
+from datetime import datetime
+from threading import Thread, Lock
+
+import numpy as np
+import soundfile
+
+from metrics import METRICS
+
+#Output formats as (extension, soundfile format, soundfile subtype)
+AUDIO_FORMATS = {
+    'wav': ('.wav', 'WAV', 'PCM_16'),
+    'flac': ('.flac', 'FLAC', 'PCM_16'),
+    'opus': ('.ogg', 'OGG', 'OPUS'),
+}
+
+class RetentionPolicy:
+    """Limits on the files kept in a directory. The oldest files are deleted first."""
+
+    def __init__(self, max_files = None, max_bytes = None, max_age_seconds = None):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+
+    def apply(self, directory, keep = ()):
+        """Delete files in `directory` until it is within the limits, never deleting those in `keep`."""
+        entries = []
+        for entry in os.scandir(directory):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+
+        now = time.time()
+        total_bytes = sum(size for mtime, size, path in entries)
+        num_files = len(entries)
+        for mtime, size, path in entries:
+            too_many = self.max_files is not None and num_files > self.max_files
+            too_big = self.max_bytes is not None and total_bytes > self.max_bytes
+            too_old = self.max_age_seconds is not None and now - mtime > self.max_age_seconds
+            if not (too_many or too_big or too_old):
+                break
+            if os.path.abspath(path) in keep:
+                continue
+            os.remove(path)
+            num_files -= 1
+            total_bytes -= size
+
+class AudioStream:
+    """Handle to one recording which an AudioWriter writes to disk incrementally."""
+
+    def __init__(self, writer, file_name, sample_rate, audio_format):
+        self.file_name = file_name
+        self.sample_rate = sample_rate
+        self.audio_format = audio_format
+        self._writer = writer
+        self._sound_file = None
+        self._file = None
+        #Set once frames had to be dropped, the incomplete file is then discarded rather than saved
+        self.failed = False
+
+    def write(self, audio):
+        """
+        Queue int16 samples for writing. The samples are copied, so ring
+        buffer views are safe to pass. Returns False once the stream failed.
+        """
+        return self._writer._enqueue(self, np.array(audio, dtype=np.int16, copy=True))
+
+    def close(self):
+        """Queue the end of the recording."""
+        self._writer._enqueue(self, None)
+
+class AudioWriter:
+    """
+    Writes recordings to disk on a background thread while they are being
+    captured, so the interaction path never waits on disk. Buffered frames
+    are bounded, fsyncs are batched, and retention policies keep the
+    output directories within size limits. Whatever is queued is written
+    before the interpreter exits.
+    """
+
+    def __init__(self, audio_format = 'flac', fsync_seconds = 5.0, max_queued_frames = 1024, retention = None,
+                 max_block_seconds = 0.5, exit_timeout = 10.0):
+        """
+        Constructor.
+        :param audio_format: Default output format, one of AUDIO_FORMATS.
+        :param fsync_seconds: Open files are fsynced at most this often, and always when closed.
+        :param max_queued_frames: Frames buffered for the writer thread before writers have to wait.
+        :param retention: Optional dict of directory to RetentionPolicy, applied whenever a file there is closed.
+        :param max_block_seconds: Longest a stream's write waits for room in the queue. A stream which waits longer
+        has failed: its later frames are ignored and its file is discarded when it is closed.
+        :param exit_timeout: Longest the interpreter waits at exit for queued recordings to be written.
+        """
+        if audio_format not in AUDIO_FORMATS:
+            raise ValueError(f"Unknown audio format {audio_format}, expected one of {list(AUDIO_FORMATS)}")
+        self.audio_format = audio_format
+        self._fsync_seconds = fsync_seconds
+        self._retention = {os.path.abspath(directory): policy for directory, policy in (retention or {}).items()}
+        self._referenced = {}
+        self._max_block_seconds = max_block_seconds
+        self._exit_timeout = exit_timeout
+
+        self._queue = queue.Queue(maxsize=max_queued_frames)
+        self._open_streams = set()
+        self._last_fsync = time.monotonic()
+        self._closed = False
+        self._dropped = METRICS.counter('audio_writer_dropped_frames')
+        self._failed = METRICS.counter('audio_writer_failed_streams')
+
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        #The thread is a daemon so it never keeps the bot alive, which would lose whatever is still queued at exit
+        atexit.register(self.close)
+
+    def protect(self, directory, referenced):
+        """
+        Never let retention delete files in `directory` which are still in
+        use. `referenced()` returns their file names, e.g. those of the
+        stored guests' recordings. It is called on the writer's thread, so it
+        must never wait on a lock held by someone who may be writing audio.
+        """
+        self._referenced.setdefault(os.path.abspath(directory), []).append(referenced)
+
+    def file_name(self, file_name, audio_format = None):
+        """Resolve the file name actually written: `{timestamp}` is filled in and the extension matches the format."""
+        extension = AUDIO_FORMATS[audio_format or self.audio_format][0]
+        file_name = file_name.replace('{timestamp}', datetime.now().strftime('%Y%m%d-%H%M%S-%f'))
+        return os.path.splitext(file_name)[0] + extension
+
+    def open(self, file_name, sample_rate = 16_000, audio_format = None):
+        """Start a new recording and return its AudioStream."""
+        audio_format = audio_format or self.audio_format
+        return AudioStream(self, self.file_name(file_name, audio_format), sample_rate, audio_format)
+
+    def write(self, audio, file_name, sample_rate = 16_000, audio_format = None):
+        """Queue a whole recording for writing and return the file name it will be written to."""
+        stream = self.open(file_name, sample_rate, audio_format)
+        #A whole recording is a single item, so it always waits for room rather than failing
+        self._enqueue(stream, np.array(audio, dtype=np.int16, copy=True), timeout = None)
+        stream.close()
+        return stream.file_name
+
+    def write_now(self, audio, file_name, sample_rate = 16_000, audio_format = None):
+        """
+        Write a whole recording on the calling thread and sync it to disk, for files which must exist once the
+        call returns, e.g. those a guest is committed with. Returns the file name written.
+        """
+        audio_format = audio_format or self.audio_format
+        file_name = self.file_name(file_name, audio_format)
+        extension, file_format, subtype = AUDIO_FORMATS[audio_format]
+        os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+        with open(file_name, 'wb') as f:
+            soundfile.write(f, np.asarray(audio, dtype=np.int16), sample_rate, format=file_format, subtype=subtype)
+            f.flush()
+            os.fsync(f.fileno())
+        print("Saved audio to file:", file_name)
+        return file_name
+
+    def _enqueue(self, stream, audio, timeout = -1):
+        if self._closed:
+            print("[Audio Writer] Closed, not writing", stream.file_name)
+            return False
+        if stream.failed and audio is not None:
+            self._dropped.inc()
+            return False
+        #The end of a recording closes the file, so it is never given up on
+        timeout = None if audio is None else self._max_block_seconds if timeout == -1 else timeout
+        try:
+            self._queue.put((stream, audio), timeout=timeout)
+        except queue.Full:
+            stream.failed = True
+            self._dropped.inc()
+            self._failed.inc()
+            print("[Audio Writer] Disk can't keep up, discarding", stream.file_name)
+            return False
+        return True
+
+    def flush(self):
+        """Block until everything queued so far has been written."""
+        self._queue.join()
+
+    def close(self, timeout = None):
+        """
+        Write everything queued, close any recordings left open and stop the
+        writer thread. Called at exit, waiting at most `exit_timeout`.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        self._queue.put((None, None))
+        self._thread.join(self._exit_timeout if timeout is None else timeout)
+        if self._thread.is_alive():
+            print("[Audio Writer] Gave up waiting for", self._queue.qsize(), "queued frames")
+
+    def _run(self):
+        while True:
+            try:
+                stream, audio = self._queue.get(timeout=self._fsync_seconds)
+            except queue.Empty:
+                self._fsync_open_streams()
+                continue
+            if stream is None:
+                #Closing, anything still queued came before this
+                for stream in list(self._open_streams):
+                    self._close(stream)
+                self._queue.task_done()
+                return
+            try:
+                if audio is None:
+                    self._close(stream)
+                else:
+                    self._write(stream, audio)
+            except Exception as e:
+                print("[Audio Writer] Failed writing", stream.file_name, e)
+            finally:
+                self._queue.task_done()
+
+            if time.monotonic() - self._last_fsync >= self._fsync_seconds:
+                self._fsync_open_streams()
+
+    def _write(self, stream, audio):
+        if stream._sound_file is None:
+            extension, file_format, subtype = AUDIO_FORMATS[stream.audio_format]
+            os.makedirs(os.path.dirname(stream.file_name) or '.', exist_ok=True)
+            stream._file = open(stream.file_name, 'wb')
+            stream._sound_file = soundfile.SoundFile(stream._file, mode='w', samplerate=stream.sample_rate,
+                                                     channels=1, format=file_format, subtype=subtype)
+            self._open_streams.add(stream)
+        stream._sound_file.write(audio)
+
+    def _close(self, stream):
+        if stream._sound_file is None:
+            return
+        stream._sound_file.close()
+        stream._file.flush()
+        os.fsync(stream._file.fileno())
+        stream._file.close()
+        self._open_streams.discard(stream)
+        if stream.failed:
+            #Frames are missing from the middle, so the recording is not kept
+            os.remove(stream.file_name)
+            print("Discarded incomplete audio file:", stream.file_name)
+            return
+        print("Saved audio to file:", stream.file_name)
+
+        directory = os.path.abspath(os.path.dirname(stream.file_name))
+        if directory in self._retention:
+            keep = set(os.path.abspath(s.file_name) for s in self._open_streams) | {os.path.abspath(stream.file_name)}
+            for referenced in self._referenced.get(directory, ()):
+                keep |= set(os.path.abspath(file_name) for file_name in referenced() if file_name)
+            self._retention[directory].apply(directory, keep = keep)
+
+    def _fsync_open_streams(self):
+        for stream in self._open_streams:
+            stream._sound_file.flush()
+            stream._file.flush()
+            os.fsync(stream._file.fileno())
+        self._last_fsync = time.monotonic()
+
+_default_writer = None
+_default_writer_lock = Lock()
+
+def default_writer():
+    """The process wide AudioWriter, started on first use."""
+    global _default_writer
+    with _default_writer_lock:
+        if _default_writer is None:
+            _default_writer = AudioWriter(retention = {
+                'data/logs': RetentionPolicy(max_files = 500, max_bytes = 500 * 1024 * 1024),
+                'data/names': RetentionPolicy(max_bytes = 2 * 1024 * 1024 * 1024),
+            })
+        return _default_writer
+
+def set_default_writer(writer):
+    """Replace the process wide AudioWriter, e.g. to change the format or retention policies."""
+    global _default_writer
+    with _default_writer_lock:
+        _default_writer = writer
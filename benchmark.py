@@ -0,0 +1,364 @@
+"""
+Offline replay harness and end-to-end latency benchmark for the audio pipeline.
+
+Replays a corpus of recordings through WakeThread (or ListenInputThread),
+local stand-ins for Azure speech recognition/synthesis, CommandsParser and
+WelcomeBot.parse_text, without a microphone or network:
+
+    python benchmark.py data/corpus --speed 0 --stt-latency 0.4 --tts-latency 0.2
+
+The corpus is a directory of 16 kHz mono WAV files, each with a JSON file of
+the same name describing it:
+
+    {"wake": 1.25, "speech_end": 3.4, "text": "could you take my photo"}
+
+`wake` is the time the wake word ends (null if the clip has none) and
+`speech_end` the time the speaker stops talking, both in seconds. An
+optional `command` gives the command the text should be parsed into.
+
+With `--scripted-wake` no hardware libraries are needed: the wake word
+engine, recorder, audio output and vision modules are replaced by empty
+stand-ins if they aren't installed, since a scripted replay never calls
+into them.
+"""
+import os
+import sys
+import json
+import time
+import types
+import argparse
+import importlib.util
+from threading import Event
+
+import numpy as np
+import soundfile
+
+#Imported by the bot's modules, but never called into by a scripted replay
+STAND_IN_MODULES = ('pvporcupine', 'pvrecorder', 'pyaudio', 'cv2')
+
+class ReplayFinished(Exception):
+    """Raised by FileRecorder.read once the whole recording has been replayed."""
+
+class FileRecorder:
+    """Stand-in for PvRecorder which replays a WAV file at real-time or accelerated speed."""
+
+    def __init__(self, file_name, device_index = None, frame_length = 512, speed = 1.0, tail_seconds = 3.0,
+                 sample_rate = 16_000, **kwargs):
+        """
+        Constructor.
+        :param file_name: 16 bit WAV file to replay. Multi-channel files are mixed down to mono.
+        :param frame_length: Samples returned by each read().
+        :param speed: Replay speed relative to real time. 0 replays as fast as possible.
+        :param tail_seconds: Seconds of silence appended, so endpointing can finish at the end of the file.
+        Other PvRecorder arguments are accepted and ignored.
+        """
+        audio, file_sample_rate = soundfile.read(file_name, dtype='int16', always_2d=True)
+        if file_sample_rate != sample_rate:
+            raise ValueError(f"{file_name} is {file_sample_rate} Hz, expected {sample_rate} Hz")
+
+        self.file_name = file_name
+        self.sample_rate = sample_rate
+        self.frame_length = frame_length
+        self.speed = speed
+        self.position = 0
+
+        audio = audio.mean(axis=1).astype(np.int16)
+        self._audio = np.concatenate((audio, np.zeros(int(tail_seconds * sample_rate), dtype=np.int16)))
+        self._start_time = None
+
+    @property
+    def selected_device(self):
+        return self.file_name
+
+    @staticmethod
+    def get_audio_devices():
+        return []
+
+    @property
+    def seconds_read(self):
+        return self.position / self.sample_rate
+
+    def start(self):
+        self._start_time = time.perf_counter()
+
+    def read(self):
+        if self.position >= len(self._audio):
+            raise ReplayFinished()
+
+        frame = self._audio[self.position:self.position + self.frame_length]
+        if len(frame) < self.frame_length:
+            frame = np.pad(frame, (0, self.frame_length - len(frame)))
+        self.position += self.frame_length
+
+        #Pace reads like a live microphone would
+        if self.speed > 0:
+            delay = self._start_time + self.seconds_read / self.speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        return frame.tolist()
+
+    def stop(self):
+        pass
+
+    def delete(self):
+        pass
+
+class ScriptedWakeEngine:
+    """Stand-in for Porcupine which fires at an annotated time, for machines without the wake word engine."""
+
+    def __init__(self, wake_seconds, sample_rate = 16_000, frame_length = 512):
+        self.sample_rate = sample_rate
+        self.frame_length = frame_length
+        self._wake_sample = None if wake_seconds is None else int(wake_seconds * sample_rate)
+        self._position = 0
+
+    def process(self, pcm):
+        self._position += len(pcm)
+        if self._wake_sample is not None and self._position >= self._wake_sample:
+            self._wake_sample = None
+            return 0
+        return -1
+
+    def delete(self):
+        pass
+
+class FakeRecognizer:
+    """Local stand-in for Azure speech recognition with a configurable latency."""
+
+    def __init__(self, latency = 0.3):
+        self.latency = latency
+
+    def recognize(self, audio, transcript):
+        time.sleep(self.latency)
+        return transcript
+
+class FakeSpeechManager:
+    """Local stand-in for SpeechManager with a configurable synthesis latency."""
+
+    def __init__(self, latency = 0.2):
+        self.latency = latency
+        self.spoken = []
+
+    def speak(self, text):
+        time.sleep(self.latency)
+        self.spoken.append(text)
+
+    def speak_template(self, template, **values):
+        self.speak(template.format(**values))
+
+    def interrupt(self):
+        pass
+
+def install_stand_ins():
+    """Put an empty module in place of each of STAND_IN_MODULES which isn't installed."""
+    for name in STAND_IN_MODULES:
+        if name in sys.modules or importlib.util.find_spec(name) is not None:
+            continue
+        module = types.ModuleType(name)
+        if name == 'pvporcupine':
+            #Read for WakeThread's default arguments
+            module.LIBRARY_PATH = module.MODEL_PATH = None
+            module.KEYWORD_PATHS = {'jarvis': 'jarvis_linux.ppn'}
+        elif name == 'pvrecorder':
+            module.PvRecorder = FileRecorder
+        sys.modules[name] = module
+        print(f"[Benchmark] {name} is not installed, using a stand-in")
+
+_pipeline = None
+
+def load_pipeline(stand_ins = False):
+    """
+    Import the bot's audio and command modules on first use, so importing
+    this module needs none of them. With `stand_ins`, missing hardware
+    modules are replaced first, see install_stand_ins. Returns a namespace of
+    the classes the benchmark drives.
+    """
+    global _pipeline
+    if _pipeline is not None:
+        return _pipeline
+    if stand_ins:
+        install_stand_ins()
+
+    from audio import WakeThread, ListenInputThread
+    from vad import Endpointer
+    from bot import WelcomeBot, CommandsParser, Responses
+
+    class BenchmarkBot(WelcomeBot):
+        """WelcomeBot which parses and dispatches commands for real but only acknowledges them."""
+
+        def __init__(self, commands_file_name = 'commands.context', speech_manager = None):
+            self.commands_parser = CommandsParser(commands_file = commands_file_name)
+            self.speech_manager = speech_manager if speech_manager is not None else FakeSpeechManager()
+            self.dispatched = []
+            self._cancelled = Event()
+            self._voice_match = None
+            self._wake_audio = None
+
+            #Replace every command with an acknowledgement, so no camera or face models are needed
+            for command in self.commands_parser.commands:
+                setattr(self, command, lambda command=command: self._acknowledge(command))
+
+        def _acknowledge(self, command):
+            self.dispatched.append(command)
+            self.speech_manager.speak(Responses.TAKE_MY_PHOTO if command == 'takeMyPhoto' else Responses.RECOGNIZE_ME)
+
+    _pipeline = types.SimpleNamespace(WakeThread=WakeThread, ListenInputThread=ListenInputThread,
+                                      Endpointer=Endpointer, BenchmarkBot=BenchmarkBot)
+    return _pipeline
+
+def load_corpus(corpus_dir):
+    """Return (wav file, annotation) pairs for every annotated WAV file in a directory."""
+    clips = []
+    for file_name in sorted(os.listdir(corpus_dir)):
+        if not file_name.endswith('.wav'):
+            continue
+        wav_file_name = os.path.join(corpus_dir, file_name)
+        json_file_name = os.path.splitext(wav_file_name)[0] + '.json'
+        annotation = {}
+        if os.path.exists(json_file_name):
+            with open(json_file_name, 'r', encoding='utf-8') as f:
+                annotation = json.load(f)
+        clips.append((wav_file_name, annotation))
+    return clips
+
+def run_clip(wav_file_name, annotation, bot, recognizer, mode = 'wake', speed = 0, scripted_wake = False):
+    """Replay one clip through the pipeline and return its measurements."""
+    recorders = []
+    def recorder_factory(**kwargs):
+        recorders.append(FileRecorder(wav_file_name, speed=speed, **kwargs))
+        return recorders[-1]
+
+    marks = {}
+    def on_end(*args):
+        #Also called with empty audio when the recording runs out before an utterance ends
+        if len(args[-1]) > 0:
+            marks['end_seconds'] = recorders[-1].seconds_read
+            marks['audio'] = args[-1]
+
+    pipeline = load_pipeline(stand_ins = scripted_wake)
+    endpointer = pipeline.Endpointer()
+    if mode == 'wake':
+        thread = pipeline.WakeThread(
+            callback=on_end,
+            on_wake=lambda keyword, audio: marks.setdefault('wake_seconds', recorders[-1].seconds_read),
+            endpointer=endpointer,
+            recorder_factory=recorder_factory,
+            wake_engine=ScriptedWakeEngine(annotation.get('wake')) if scripted_wake else None)
+    else:
+        thread = pipeline.ListenInputThread(callback=on_end, timeout_seconds=endpointer.max_seconds, output_path=None,
+                                   endpointer=endpointer, recorder_factory=recorder_factory)
+
+    cpu_start = time.process_time()
+    try:
+        thread.run()
+    except ReplayFinished:
+        pass
+    cpu_seconds = time.process_time() - cpu_start
+
+    result = {
+        'clip': os.path.basename(wav_file_name),
+        'audio_seconds': recorders[-1].seconds_read if recorders else 0,
+        'cpu_seconds': cpu_seconds,
+        'wake_seconds': marks.get('wake_seconds'),
+        'end_seconds': marks.get('end_seconds'),
+    }
+    if annotation.get('wake') is not None and result['wake_seconds'] is not None:
+        result['wake_latency'] = result['wake_seconds'] - annotation['wake']
+    if annotation.get('speech_end') is not None and result['end_seconds'] is not None:
+        result['endpoint_latency'] = result['end_seconds'] - annotation['speech_end']
+
+    #Only run the rest of the pipeline for utterances which were actually captured
+    if mode == 'listen' or result['wake_seconds'] is not None:
+        start = time.perf_counter()
+        text = recognizer.recognize(marks.get('audio'), annotation.get('text'))
+        result['stt'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        result['command'] = bot.commands_parser.parse(text)
+        result['parse'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        bot.parse_text(text)
+        result['response'] = time.perf_counter() - start
+
+        result['total'] = max(result.get('endpoint_latency', 0), 0) + result['stt'] + result['response']
+    return result
+
+def percentiles(values):
+    values = np.array([v for v in values if v is not None], dtype=np.float64)
+    if len(values) == 0:
+        return None
+    return {'p50': float(np.percentile(values, 50)), 'p90': float(np.percentile(values, 90)),
+            'p99': float(np.percentile(values, 99)), 'mean': float(values.mean()), 'count': len(values)}
+
+def summarize(results, clips):
+    """Combine per-clip measurements into latency percentiles and accuracy figures."""
+    annotations = {os.path.basename(wav_file_name): annotation for wav_file_name, annotation in clips}
+    report = {'stages': {}, 'accuracy': {}}
+
+    for stage in ('wake_latency', 'endpoint_latency', 'stt', 'parse', 'response', 'total'):
+        report['stages'][stage] = percentiles(result.get(stage) for result in results)
+
+    audio_seconds = sum(result['audio_seconds'] for result in results)
+    cpu_seconds = sum(result['cpu_seconds'] for result in results)
+    report['cpu_per_audio_second'] = cpu_seconds / audio_seconds if audio_seconds > 0 else None
+
+    expected = [result for result in results if annotations[result['clip']].get('wake') is not None]
+    unexpected = [result for result in results if annotations[result['clip']].get('wake') is None]
+    report['accuracy']['wake_hits'] = sum(result['wake_seconds'] is not None for result in expected)
+    report['accuracy']['wake_misses'] = sum(result['wake_seconds'] is None for result in expected)
+    report['accuracy']['wake_false_alarms'] = sum(result['wake_seconds'] is not None for result in unexpected)
+
+    #Endpoints before the end of speech cut the speaker off
+    endpoint_latencies = [result['endpoint_latency'] for result in results if 'endpoint_latency' in result]
+    report['accuracy']['early_cutoffs'] = sum(latency < -0.05 for latency in endpoint_latencies)
+
+    annotated_text = [result for result in results
+                      if 'command' in result and annotations[result['clip']].get('command') is not None]
+    if annotated_text:
+        report['accuracy']['command_accuracy'] = float(np.mean(
+            [result['command'] == annotations[result['clip']]['command'] for result in annotated_text]))
+    return report
+
+def print_report(report):
+    print(f"{'stage':<18}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'n':>6}")
+    for stage, stats in report['stages'].items():
+        if stats is not None:
+            print(f"{stage:<18}{stats['p50'] * 1000:>10.1f}{stats['p90'] * 1000:>10.1f}"
+                  f"{stats['p99'] * 1000:>10.1f}{stats['count']:>6}")
+    if report['cpu_per_audio_second'] is not None:
+        print(f"CPU seconds per audio second: {report['cpu_per_audio_second']:.4f}")
+    for name, value in report['accuracy'].items():
+        print(f"{name}: {value}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('corpus_dir', help='Directory of annotated 16 kHz mono WAV files')
+    parser.add_argument('--mode', choices=('wake', 'listen'), default='wake',
+                        help='Replay through WakeThread, or through ListenInputThread without a wake word')
+    parser.add_argument('--speed', type=float, default=0, help='Replay speed, 1 is real time, 0 is as fast as possible')
+    parser.add_argument('--stt-latency', type=float, default=0.3, help='Seconds the stand-in recognizer takes')
+    parser.add_argument('--tts-latency', type=float, default=0.2, help='Seconds the stand-in synthesizer takes')
+    parser.add_argument('--scripted-wake', action='store_true',
+                        help='Fire the wake word at the annotated time instead of running Porcupine')
+    parser.add_argument('--commands', default='commands.context', help='Commands file to parse with')
+    parser.add_argument('--json', help='Also write the report to this JSON file')
+    args = parser.parse_args()
+
+    clips = load_corpus(args.corpus_dir)
+    bot = load_pipeline(stand_ins = args.scripted_wake).BenchmarkBot(args.commands, FakeSpeechManager(args.tts_latency))
+    recognizer = FakeRecognizer(args.stt_latency)
+
+    results = [run_clip(wav_file_name, annotation, bot, recognizer, mode=args.mode, speed=args.speed,
+                        scripted_wake=args.scripted_wake)
+               for wav_file_name, annotation in clips]
+    report = summarize(results, clips)
+    report['clips'] = results
+    print_report(report)
+
+    if args.json is not None:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+
+if __name__ == '__main__':
+    main()
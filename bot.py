@@ -1,46 +1,80 @@
-from audio import WakeThread, ListenInputThread, record_seconds, write_audio
-from visual import capture_face, GuestManager
+from startup import STARTUP, Subsystem
 
+with STARTUP.phase('import audio', 'import'):
+    from audio import WakeThread, ListenInputThread, record_seconds, write_audio
+with STARTUP.phase('import visual', 'import'):
+    from visual import CameraService, GuestManager
+    from face_gate import FaceGate, FaceWatcher
+from tracking import IdentityTracker
+from face_service import FaceService
+from command_matcher import CommandMatcher, normalize
+from vad import Endpointer
+from speech import SpeechManager, StreamingRecognizer, recognize_audio
+from runtime import BotRuntime, CommandCancelled
+from shm_capture import CaptureSupervisor
+from metrics import METRICS, span
+
+import asyncio
+from threading import Event
 import numpy as np
+from pvrecorder import PvRecorder
+
 
 class Responses:
     UNKNOWN_COMMAND = "Sorry, I couldn't quite understand what you wanted from me."
     TAKE_MY_PHOTO = "Sure, please look into my camera so I can take a good look at you."
     ASK_FOR_NAME = "It's nice to meet a new face!  What's your name?"
+    RECOGNIZE_ME = "Let me take a look at you."
+    WELCOME_BACK = "Welcome back, {name}!"
+    UNKNOWN_GUEST = "I don't think we've met before.  Say take my photo and I'll remember you."
+    NO_FACE = "I can't see your face.  Please look into my camera."
+
+    @classmethod
+    def fixed(cls):
+        """All responses which don't need any values filled in."""
+        return [value for name, value in vars(cls).items()
+                if not name.startswith('_') and isinstance(value, str) and '{' not in value]
+
+    @classmethod
+    def templates(cls):
+        """All responses with values to fill in, e.g. a guest's name."""
+        return [value for name, value in vars(cls).items()
+                if not name.startswith('_') and isinstance(value, str) and '{' in value]
 
 class CommandsParser:
     """Handles logic related to parsing commands given by the user."""
 
-    def __init__(self, commands_file='commands.context'):
+    def __init__(self, commands_file='commands.context', fuzzy_cutoff=None):
         command_lines = open(commands_file, 'r').readlines()
 
+        #Prompts are kept in file order, which breaks ties between equally good matches
         self.commands = {}
         curr_command = None
         for line in command_lines:
             line = line.strip()
-            print(line, curr_command)
             if line.endswith(':'):
                 curr_command = line[:-1]
-                self.commands[curr_command] = set()
+                self.commands[curr_command] = []
             elif line.startswith('- '):
                 assert curr_command is not None
-                self.commands[curr_command].add(line[2:])
+                if line[2:] not in self.commands[curr_command]:
+                    self.commands[curr_command].append(line[2:])
         
         print("Commands being used:", self.commands)
 
+        #Compile every prompt into one automaton, so parsing is a single pass over the text
+        self.matcher = CommandMatcher(self.commands, fuzzy_cutoff=fuzzy_cutoff)
+
     def parse(self, text):
         """Parses a given string of text for a command and returns the command."""
         if text is not None:
             print("Parsing text:", text)
-            text = ''.join([c.lower() for c in text if str.isalnum(c) or str.isspace(c)])
-
-            #For command, {set of all prompts which map to the command}
-            for command, prompts in self.commands.items():
-                #For all prompts, check if it is constained in text
-                for prompt in prompts:
-                    if prompt in text:
-                        print("Found command:", command)
-                        return command
+            text = normalize(text)
+
+            command = self.matcher.match(text)
+            if command is not None:
+                print("Found command:", command)
+                return command
         
         #If no command is found or no text is received, return no result
         print("Found no commands in:", text)
@@ -54,110 +88,314 @@ class WelcomeBot:
 
     def __init__(self,
                  commands_file_name = 'commands.context',
-                 guest_log_file_name = 'data/guest_log.json',
+                 guest_db_file_name = 'data/guests.db',
                  audio_input_device_index = None,
+                 audio_input_device_indices = None,
                  audio_output_device_index = None,
                  camera_device_index = None,
-                 azure_speech_config = None):
-        
+                 azure_speech_config = None,
+                 face_workers = 1,
+                 camera_width = 1280,
+                 camera_height = 720,
+                 camera_fps = 30,
+                 streaming_recognition = True,
+                 metrics_file_name = 'data/logs/metrics.prom',
+                 proactive_greeting = True,
+                 lazy_startup = True,
+                 time_to_listen_target = None,
+                 shared_capture = False):
+        """
+        Constructor. Wake listening is set up first; with `lazy_startup` the
+        camera, face models, speech and guest storage then load on background
+        threads, and commands only wait for the subsystems they use.
+        `time_to_listen_target` is an optional time-to-first-listen budget in
+        seconds which the startup report measures against. With
+        `shared_capture` the microphones and camera are recorded by
+        supervised capture processes into shared memory, see shm_capture.
+        """
+        if time_to_listen_target is not None:
+            STARTUP.target_seconds = time_to_listen_target
+
         #Store device configurations
         self._audio_input_device_index = audio_input_device_index
+        #Several microphones are only listened to together by the continuous runtime
+        self._audio_input_device_indices = audio_input_device_indices
         self._audio_output_device_index = audio_output_device_index
         self._camera_device_index = camera_device_index
         self._azure_speech_config = azure_speech_config
+        self._streaming_recognition = streaming_recognition
+        self._streaming_recognizer = None
+        self._metrics_file_name = metrics_file_name
+
+        #Set when the user barges in, the running command stops at its next step
+        self._cancelled = Event()
+
+        #The last wake phrase heard and the guest it sounded like, then those of the running command
+        self._heard_wake_audio = None
+        self._heard_voice_match = None
+        self._wake_audio = None
+        self._voice_match = None
+
+        #Record in separate processes, so inference in this one can't make the recorders overflow
+        self.capture_supervisor = None
+        recorder_factory = PvRecorder
+        if shared_capture:
+            self.capture_supervisor = CaptureSupervisor().start()
+            recorder_factory = self.capture_supervisor.recorder_factory
+
+        #Shared endpointer, so the noise floor learned while idle carries over to follow up questions
+        self.endpointer = Endpointer()
 
         #Create Listening Thread instance
         self.wake_thread = WakeThread(
-            callback = lambda keyword, audio_frames: self._run_callback(keyword, audio_frames),
+            callback = lambda keyword, audio: self._run_callback(keyword, audio),
             input_device_index=audio_input_device_index,
-            output_path='data/logs/latest_speech.wav'
+            output_path='data/logs/speech_{timestamp}.wav',
+            endpointer=self.endpointer,
+            on_wake=self._on_wake,
+            on_audio=self._stream_audio if streaming_recognition else None,
+            recorder_factory=recorder_factory
         )
 
         #Create Commands Parser for interpeting user language
-        self.commands_parser = CommandsParser(commands_file = commands_file_name)
+        with STARTUP.phase('parse commands', 'parse'):
+            self.commands_parser = CommandsParser(commands_file = commands_file_name)
+
+        #Everything below is a Subsystem: used like the object itself, waiting for it only when first needed
+        background = lazy_startup
+
+        #Keep the camera open and grabbing, so photos are instant
+        camera_service = self.capture_supervisor.camera if shared_capture else CameraService
+        self.camera = Subsystem('camera', lambda: camera_service(
+            camera_device_index, width = camera_width, height = camera_height, fps = camera_fps).start()).start(background)
+
+        #Start the face model workers and load their models before any request arrives
+        self.face_service = Subsystem('face models', lambda: self._load_face_service(face_workers)).start(background)
+
+        #Create Speech Manager and synthesize every fixed response ahead of time
+        self.speech_manager = Subsystem('speech', lambda: self._load_speech_manager(
+            azure_speech_config, audio_output_device_index)).start(background)
+
+        #Cheap face check on the camera stream, so the face models only see tight crops of real faces
+        self.face_gate = Subsystem('face gate', FaceGate).start(background)
 
         #Create Guest Manager for managing all faces stored
-        self.guest_manager = GuestManager(guest_log_file_name)
+        self.guest_manager = Subsystem('guests', lambda: self._load_guest_manager(guest_db_file_name)).start(background)
+
+        #Follow faces in view, so a visitor recognized once isn't run through the face model again
+        self.tracker = IdentityTracker()
+        #Greeting visitors as they walk up is hooked up by the continuous runtime
+        self._proactive_greeting = proactive_greeting
+        self.face_watcher = FaceWatcher(self.camera, self.face_gate, on_arrival = None, tracker = self.tracker)
+
+    def _load_face_service(self, face_workers):
+        face_service = FaceService(num_workers = face_workers)
+        with STARTUP.phase('face model warm up', 'model'):
+            face_service.warm_up()
+        return face_service
+
+    def _load_speech_manager(self, azure_speech_config, audio_output_device_index):
+        speech_manager = SpeechManager(azure_speech_config, output_device_index = audio_output_device_index)
+        with STARTUP.phase('speech prewarm', 'model'):
+            speech_manager.prewarm(Responses.fixed())
+            speech_manager.prewarm_templates(Responses.templates())
+        return speech_manager
+
+    def _load_guest_manager(self, guest_db_file_name):
+        #Recognition still works without the face gate, just less cheaply
+        self.face_gate.wait()
+        face_gate = self.face_gate.get() if self.face_gate.ready else None
+        return GuestManager(self.face_service, guest_db_file_name, face_gate = face_gate, tracker = self.tracker)
+
+    def readiness(self):
+        """Return the state of every subsystem, see StartupProfiler.readiness."""
+        return STARTUP.readiness()
 
     def run(self):
         """Begin running the bot by spawning a WakeThread."""
-        self.wake_thread.run()
+        STARTUP.report_when_ready()
+        self.face_watcher.start()
+        try:
+            self.wake_thread.run()
+        finally:
+            self.face_watcher.stop()
+            if self.capture_supervisor is not None:
+                self.capture_supervisor.stop()
+
+    def run_continuous(self):
+        """Keep listening and answering visitors back to back until interrupted."""
+        STARTUP.report_when_ready()
+        try:
+            asyncio.run(BotRuntime(self).run())
+        except KeyboardInterrupt:
+            print('Stopping ...')
+        finally:
+            if self.capture_supervisor is not None:
+                self.capture_supervisor.stop()
+
+    def listen(self, seconds):
+        """Record the user's answer to a question, up to `seconds` long."""
+        return record_seconds(self._audio_input_device_index, seconds=seconds, endpointer=self.endpointer,
+                              recorder_factory=self.wake_thread.recorder_factory)
     
-    def _run_callback(self, keyword, audio_frames):
+    def _on_wake(self, keyword, audio):
+        #Copy out of the ring buffer, the audio is needed again once the command is known
+        self._heard_wake_audio = np.copy(audio)
+        self._heard_voice_match = self.identify_voice(self._heard_wake_audio)
+        if self._streaming_recognition:
+            self._start_streaming_recognition(keyword, audio)
+
+    def identify_voice(self, audio):
+        """
+        Try to recognize the speaker from the wake phrase, while they are
+        still speaking. Returns the (guest, similarity) pair of the guest it
+        sounds like, or None. Never waits for the guest store to finish loading.
+        """
+        if not getattr(self.guest_manager, 'ready', True):
+            return None
+        voice_match = self.guest_manager.recognize_voice(audio)
+        if voice_match is not None:
+            print(f"[Voice ID] Sounds like {voice_match[0]['name']} ({voice_match[1]:.2f})")
+        return voice_match
+
+    def _start_streaming_recognition(self, keyword, audio):
+        """Start recognizing as soon as the wake word is heard, beginning with the pre-roll."""
+        self._streaming_recognizer = StreamingRecognizer(
+            self._azure_speech_config, on_partial = lambda text: print("[Partial]", text))
+        self._streaming_recognizer.write(audio)
+
+    def _stream_audio(self, frame):
+        """Forward each recorded frame to the recognizer while the user is still speaking."""
+        if self._streaming_recognizer is not None:
+            self._streaming_recognizer.write(frame)
+
+    def _run_callback(self, keyword, audio):
         """Once woken up, take remaining audio and interpret."""
-        #Interpret speech using Azure
-        text = self.azure_speech_recognition(audio_frames)
+        #The wake phrase and voice match belong to this utterance only, whatever happens to it
+        voice_match, self._heard_voice_match = self._heard_voice_match, None
+        wake_audio, self._heard_wake_audio = self._heard_wake_audio, None
+
+        #Interpret speech using Azure, most of which already happened while the user spoke
+        if self._streaming_recognizer is not None:
+            text = self._streaming_recognizer.finish()
+            self._streaming_recognizer = None
+        else:
+            text = self.azure_speech_recognition(audio)
 
         #Parse text using WelcomeBot's commands
-        self.parse_text(text)
+        self.parse_text(text, voice_match, wake_audio)
+        self.export_metrics()
+
+    def export_metrics(self):
+        """Write the latency histograms and counters gathered so far."""
+        if self._metrics_file_name is not None:
+            METRICS.export_prometheus(self._metrics_file_name)
     
-    def parse_text(self, text):
+    def parse_text(self, text, voice_match = None, wake_audio = None):
+        """
+        Run the command spoken in `text`. `wake_audio` is the wake phrase of
+        the utterance, and `voice_match` the (guest, similarity) pair it
+        sounded like, if any.
+        """
         #If no text was received from Azure, then TTS "Sorry, I couldn't quite understand what you wanted from me."
-        command = self.commands_parser.parse(text)
+        with span('command_parse'):
+            command = self.commands_parser.parse(text)
 
         #If no command was received, inform the user
         if command is None:
-            return self.azure_speech_synthesis(Responses.UNKNOWN_COMMAND)
+            return self.speech_manager.speak(Responses.UNKNOWN_COMMAND)
         #Otherwise, execute WelcomeBot's command
         else:
-            try:
-                func = getattr(self, command)
+            self.run_command(command, voice_match, wake_audio)
+
+    def cancel_command(self):
+        """Stop the running command and its response, e.g. when the user barges in with the wake word."""
+        self._cancelled.set()
+        if getattr(self.speech_manager, 'ready', True):
+            self.speech_manager.interrupt()
+
+    def check_cancelled(self):
+        """Raise CommandCancelled if the running command was cancelled. Called between a command's steps."""
+        if self._cancelled.is_set():
+            raise CommandCancelled()
+
+    def run_command(self, command, voice_match = None, wake_audio = None):
+        """
+        Execute one of WelcomeBot's commands by name, with the voice match and
+        wake phrase of the utterance which asked for it, if one did.
+        """
+        try:
+            func = getattr(self, command)
+        except AttributeError:
+            return print("Command wasn't found in WelcomeBot:", command)
+        self._cancelled.clear()
+        self._voice_match = voice_match
+        self._wake_audio = wake_audio
+        try:
+            with span('command_execution'):
                 func()
-            except AttributeError as e:
-                print("Command wasn't found in WelcomeBot:", command)
+        except CommandCancelled:
+            print("Command was cancelled:", command)
+        finally:
+            #They only apply to the command spoken right after them
+            self._voice_match = None
+            self._wake_audio = None
     
     def recognizeMe(self):
         """Take a photo of the user and try to recognize them from the past."""
-        #TODO
+        self.speech_manager.speak(Responses.RECOGNIZE_ME)
+        self.check_cancelled()
+
+        #Take photo of user
+        frame = self.camera.capture()
+        self.face_gate.wait()
+        observation = self.face_gate.detect(frame) if self.face_gate.ready else None
+        if self.face_gate.ready and observation is None:
+            return self.speech_manager.speak(Responses.NO_FACE)
+
+        #Look up the closest stored face, reusing the face already found. A guest recognized by their voice is
+        #only a candidate, whom the camera has to confirm
+        candidate_id = self._voice_match[0]['id'] if self._voice_match is not None else None
+        matches = self.guest_manager.recognize(frame, observation = observation, candidate_id = candidate_id)
+        self.check_cancelled()
+        if len(matches) == 0:
+            return self.speech_manager.speak(Responses.UNKNOWN_GUEST)
+
+        guest, score = matches[0]
+        print(f"Recognized {guest['name']} (similarity {score:.2f})")
+        #Learn their voice, so next time the wake phrase is enough
+        if self._wake_audio is not None:
+            self.guest_manager.add_voice(guest['id'], self._wake_audio)
+        self.speech_manager.speak_template(Responses.WELCOME_BACK, name=guest['name'])
 
     def takeMyPhoto(self):
         """Take a photo of the user and store in database under their name."""
         #Ask user for their name
-        self.azure_speech_synthesis(Responses.ASK_FOR_NAME)
+        self.speech_manager.speak(Responses.ASK_FOR_NAME)
+        self.check_cancelled()
 
         #If not using WSL, can convert this section to azure speech's listen_once_async()
-        audio_frames = record_seconds(self._audio_input_device_index, seconds=3)
-        
+        name_audio = self.listen(4)
+        self.check_cancelled()
+
         #Ask user to position themselves for the camera
-        self.azure_speech_synthesis(Responses.TAKE_MY_PHOTO)
+        self.speech_manager.speak(Responses.TAKE_MY_PHOTO)
+        self.check_cancelled()
 
         #Take photo of user
-        frame = capture_face(self._camera_device_index)
+        frame = self.camera.capture()
 
         #Try to interpet user name (#TODO)
-        name = self.azure_speech_recognition(audio_frames)
+        name = self.azure_speech_recognition(name_audio)
+        self.check_cancelled()
 
         #Store guest into the database
-        self.guest_manager.add_guest(frame, audio_frames, name)
+        self.guest_manager.add_guest(frame, name_audio, name, voice_audio = self._wake_audio)
 
-    def azure_speech_recognition(self, audio_frames):
-        print("Writing Audio to Stream: ", len(audio_frames), "frames")
-        
-        channels = 1
-        bitsPerSample = 16
-        samplesPerSecond = 16000
-        audioFormat = speechsdk.audio.AudioStreamFormat(samplesPerSecond, bitsPerSample, channels)
-        custom_push_stream = speechsdk.audio.PushAudioInputStream(stream_format=audioFormat)
-        audio_config = speechsdk.audio.AudioConfig(stream=custom_push_stream)
-
-        #Write audio_frames to stream
-        for frames in audio_frames:
-            custom_push_stream.write(np.array(frames, dtype='int16').tobytes())
-        custom_push_stream.close()
-
-        speech_recognizer = speechsdk.SpeechRecognizer(speech_config=self._azure_speech_config, audio_config=audio_config)
-
-        print("Sending voice data to Azure...")
-        result = speech_recognizer.recognize_once_async().get()
-
-        # Check the result
-        if result.reason == speechsdk.ResultReason.RecognizedSpeech:
-            print("Recognized: {}".format(result.text))
-            return result.text
-        elif result.reason == speechsdk.ResultReason.NoMatch:
-            print("No speech could be recognized")
-        elif result.reason == speechsdk.ResultReason.Canceled:
-            cancellation_details = result.cancellation_details
-            print("Speech Recognition canceled: {}".format(cancellation_details.reason))
-            if cancellation_details.reason == speechsdk.CancellationReason.Error:
-                print("Error details: {}".format(cancellation_details.error_details))
+        #Synthesize their name now, so greeting them next time needs no network call
+        if name:
+            self.speech_manager.prewarm_in_background([name])
+
+    def azure_speech_recognition(self, audio):
+        """Recognize speech in an already captured recording."""
+        return recognize_audio(self._azure_speech_config, audio)
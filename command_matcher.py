@@ -0,0 +1,127 @@
+import difflib
+from collections import deque
+
+class _NormalizeTable(dict):
+    """
+    Translation table for str.translate which lowercases letters/digits,
+    keeps whitespace and drops everything else. Entries are computed on
+    first use of each character and cached.
+    """
+
+    def __missing__(self, codepoint):
+        c = chr(codepoint)
+        if c.isalnum():
+            value = c.lower()
+        elif c.isspace():
+            value = ' '
+        else:
+            value = None
+        self[codepoint] = value
+        return value
+
+NORMALIZE_TABLE = _NormalizeTable()
+
+def normalize(text):
+    """Lowercase text, drop punctuation and collapse whitespace."""
+    return ' '.join(text.translate(NORMALIZE_TABLE).split())
+
+class CommandMatcher:
+    """
+    Aho-Corasick automaton over the normalized prompts of every command, so
+    a text is scanned once regardless of how many prompts there are.
+
+    Matches are whole words only. When several prompts match, the longest
+    one wins, then the earliest in the text, then the command and prompt
+    declared first.
+    """
+
+    def __init__(self, commands, fuzzy_cutoff = None):
+        """
+        Constructor.
+        :param commands: Ordered mapping of command name to its prompts.
+        :param fuzzy_cutoff: If set, a similarity ratio in [0, 1]. When no prompt matches exactly, word windows of
+        the text are compared against every prompt and the best one above the cutoff is used.
+        """
+        self.fuzzy_cutoff = fuzzy_cutoff
+
+        #Trie stored as parallel lists indexed by state
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        self._prompts = []
+
+        for command, prompts in commands.items():
+            for prompt in prompts:
+                prompt = normalize(prompt)
+                if prompt:
+                    self._add(prompt, command, len(self._prompts))
+                    self._prompts.append((prompt, command))
+        self._build_failure_links()
+
+        #Prompts grouped by word count, for fuzzy matching
+        self._prompts_by_length = {}
+        for priority, (prompt, command) in enumerate(self._prompts):
+            self._prompts_by_length.setdefault(len(prompt.split()), []).append((priority, prompt, command))
+
+    def _add(self, prompt, command, priority):
+        state = 0
+        for c in prompt:
+            if c not in self._goto[state]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+                self._goto[state][c] = len(self._goto) - 1
+            state = self._goto[state][c]
+        self._output[state].append((len(prompt), priority, command))
+
+    def _build_failure_links(self):
+        """Breadth first pass computing failure links and merged outputs."""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and c not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(c, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def find_all(self, text):
+        """Return every whole-word prompt match as (start, length, priority, command), in text order."""
+        matches = []
+        state = 0
+        for i, c in enumerate(text):
+            while state and c not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(c, 0)
+
+            for length, priority, command in self._output[state]:
+                start = i - length + 1
+                #Only accept matches on word boundaries
+                if (start == 0 or text[start - 1] == ' ') and (i + 1 == len(text) or text[i + 1] == ' '):
+                    matches.append((start, length, priority, command))
+        return matches
+
+    def match(self, text):
+        """Return the best matching command for a normalized text, or None."""
+        matches = self.find_all(text)
+        if matches:
+            start, length, priority, command = min(matches, key=lambda m: (-m[1], m[0], m[2]))
+            return command
+        if self.fuzzy_cutoff is not None:
+            return self._fuzzy_match(text)
+        return None
+
+    def _fuzzy_match(self, text):
+        """Compare word windows of the text against prompts with the same number of words."""
+        words = text.split()
+        best = None
+        for num_words, prompts in self._prompts_by_length.items():
+            for start in range(len(words) - num_words + 1):
+                window = ' '.join(words[start:start + num_words])
+                for priority, prompt, command in prompts:
+                    ratio = difflib.SequenceMatcher(None, window, prompt).ratio()
+                    if ratio >= self.fuzzy_cutoff and (best is None or (-ratio, priority) < best[:2]):
+                        best = (-ratio, priority, command)
+        return best[2] if best is not None else None
@@ -0,0 +1,197 @@
+import os
+import json
+from threading import RLock
+
+import numpy as np
+
+try:
+    import faiss #Optional approximate nearest neighbour index
+except ImportError:
+    faiss = None
+
+class EmbeddingIndex:
+    """
+    Stores L2-normalized embeddings as rows of one contiguous float32 matrix,
+    memory-mapped from a .npy file, so a lookup is a single matrix-vector
+    product instead of re-embedding every stored sample. The model which
+    computed the embeddings is recorded with them, since embeddings of
+    different models can't be compared. Safe to use from several threads,
+    e.g. to recognize voices while a guest is being added.
+    """
+
+    def __init__(self, index_file_name, dim = None, initial_capacity = 256, ann_threshold = 20_000, model = None):
+        """
+        Constructor.
+        :param index_file_name: Path of the .npy embedding matrix. Keys are stored next to it in a `.ids.npy` file,
+        and the model and embedding size in a `.meta.json` file.
+        :param dim: Embedding size. Only needed to create a new index, otherwise taken from the first embedding added.
+        :param initial_capacity: Number of rows preallocated when the index is created.
+        :param ann_threshold: Once this many embeddings are stored an approximate index is used for queries, if faiss
+        is installed.
+        :param model: Name of the model the caller's embeddings come from. Adding or querying is refused if the index
+        was built with another model.
+        """
+        self._index_file_name = index_file_name
+        self._ids_file_name = os.path.splitext(index_file_name)[0] + '.ids.npy'
+        self._meta_file_name = os.path.splitext(index_file_name)[0] + '.meta.json'
+        self._initial_capacity = initial_capacity
+        self._ann_threshold = ann_threshold
+        self._expected_model = model
+
+        self.dim = dim
+        self.model = model
+        self.count = 0
+        self._matrix = None
+        self._ids = None
+        self._ann = None
+        #Growing remaps the files, which queries on other threads must not see half done
+        self._lock = RLock()
+
+        if os.path.exists(self._index_file_name) and os.path.exists(self._ids_file_name):
+            self._load()
+
+    def _load(self):
+        self._matrix = np.load(self._index_file_name, mmap_mode='r+')
+        self._ids = np.load(self._ids_file_name, mmap_mode='r+')
+        self.dim = self._matrix.shape[1]
+        #Rows are filled in order, unused rows have an id of -1
+        self.count = int(np.count_nonzero(self._ids >= 0))
+        #Indices written before models were recorded are assumed to hold the caller's model
+        if os.path.exists(self._meta_file_name):
+            with open(self._meta_file_name, 'r', encoding='utf-8') as f:
+                self.model = json.load(f).get('model')
+        else:
+            self.model = self._expected_model
+
+    def _check(self, embeddings):
+        """Raise a ValueError if embeddings can't be compared with the stored ones."""
+        if self._expected_model is not None and self.model is not None and self.model != self._expected_model:
+            raise ValueError(f"{self._index_file_name} holds {self.model} embeddings, not {self._expected_model}. "
+                             "Rebuild it with enroll.py --reindex")
+        if self.dim is not None and embeddings.shape[1] != self.dim:
+            raise ValueError(f"Expected embeddings of size {self.dim}, got {embeddings.shape[1]}")
+
+    def __len__(self):
+        return self.count
+
+    def keys(self):
+        """Return the keys of every stored embedding."""
+        with self._lock:
+            if self.count == 0:
+                return np.zeros(0, dtype=np.int64)
+            return np.array(self._ids[:self.count])
+
+    def _allocate(self, capacity):
+        """Create (or grow) the memory-mapped files to hold `capacity` rows."""
+        matrix_tmp = self._index_file_name + '.tmp'
+        ids_tmp = self._ids_file_name + '.tmp'
+
+        matrix = np.lib.format.open_memmap(matrix_tmp, mode='w+', dtype=np.float32, shape=(capacity, self.dim))
+        ids = np.lib.format.open_memmap(ids_tmp, mode='w+', dtype=np.int64, shape=(capacity,))
+        ids[:] = -1
+        if self.count > 0:
+            matrix[:self.count] = self._matrix[:self.count]
+            ids[:self.count] = self._ids[:self.count]
+        matrix.flush()
+        ids.flush()
+        del matrix, ids
+        with open(self._meta_file_name + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'model': self.model, 'dim': self.dim}, f)
+
+        #Swap the new files in atomically and remap them
+        self._matrix = self._ids = None
+        os.replace(matrix_tmp, self._index_file_name)
+        os.replace(ids_tmp, self._ids_file_name)
+        os.replace(self._meta_file_name + '.tmp', self._meta_file_name)
+        self._matrix = np.load(self._index_file_name, mmap_mode='r+')
+        self._ids = np.load(self._ids_file_name, mmap_mode='r+')
+
+    @staticmethod
+    def _normalize(embeddings):
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+    def add(self, key, embedding):
+        """Store the embedding for an integer key (e.g. a guest id)."""
+        self.add_many([key], [embedding])
+
+    def add_many(self, keys, embeddings):
+        """Store several embeddings at once."""
+        embeddings = self._normalize(embeddings)
+        with self._lock:
+            self._check(embeddings)
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+
+            #Grow by doubling so appends stay amortized O(1)
+            needed = self.count + len(embeddings)
+            capacity = 0 if self._matrix is None else self._matrix.shape[0]
+            if needed > capacity:
+                capacity = max(capacity, self._initial_capacity)
+                while capacity < needed:
+                    capacity *= 2
+                self._allocate(capacity)
+
+            self._matrix[self.count:needed] = embeddings
+            self._ids[self.count:needed] = keys
+            self._matrix.flush()
+            self._ids.flush()
+
+            if self._ann is not None:
+                self._ann.add(embeddings)
+            self.count = needed
+
+    def replace(self, other):
+        """Atomically take over the files of another index, e.g. one rebuilt with a new model."""
+        with self._lock, other._lock:
+            for index in (self, other):
+                index._matrix = index._ids = index._ann = None
+            os.replace(other._index_file_name, self._index_file_name)
+            os.replace(other._ids_file_name, self._ids_file_name)
+            os.replace(other._meta_file_name, self._meta_file_name)
+            self._load()
+
+    def similarity(self, key, embedding):
+        """Return the best cosine similarity of `embedding` to the embeddings stored for `key`, or None if it has none."""
+        query = self._normalize(embedding)
+        with self._lock:
+            self._check(query)
+            rows = np.flatnonzero(self._ids[:self.count] == key) if self.count > 0 else []
+            if len(rows) == 0:
+                return None
+            return float(np.max(self._matrix[rows] @ query[0]))
+
+    def _build_ann(self):
+        """Build an HNSW index over the stored embeddings."""
+        ann = faiss.IndexHNSWFlat(self.dim, 32, faiss.METRIC_INNER_PRODUCT)
+        ann.add(np.ascontiguousarray(self._matrix[:self.count]))
+        return ann
+
+    def query(self, embedding, k = 1, threshold = 0.0):
+        """
+        Find the stored embeddings most similar to `embedding`.
+        Returns up to k (key, cosine similarity) pairs, best first, with a
+        similarity of at least `threshold`.
+        """
+        query = self._normalize(embedding)
+        with self._lock:
+            self._check(query)
+            if self.count == 0:
+                return []
+            k = min(k, self.count)
+
+            if faiss is not None and self.count >= self._ann_threshold:
+                if self._ann is None:
+                    self._ann = self._build_ann()
+                scores, rows = self._ann.search(query, k)
+                scores, rows = scores[0], rows[0]
+            else:
+                #Cosine similarity against every stored embedding in one product
+                similarities = self._matrix[:self.count] @ query[0]
+                rows = np.argpartition(-similarities, k - 1)[:k]
+                rows = rows[np.argsort(-similarities[rows])]
+                scores = similarities[rows]
+
+            return [(int(self._ids[row]), float(score))
+                    for row, score in zip(rows, scores) if row >= 0 and score >= threshold]
@@ -0,0 +1,295 @@
+"""
+Enroll guests in bulk from a directory of photos or a CSV manifest, or
+rebuild the face index of every stored guest after a model upgrade.
+
+Photos are decoded and embedded by FaceService worker processes in
+batches, cropped by the same FaceGate the bot recognizes faces with.
+Guests are written to the GuestStore in bulk transactions, and an
+interrupted run picks up where it stopped when started again.
+
+Directory input: every image is one guest, named after the file (e.g.
+`Ada_Lovelace.jpg`). A sound file with the same name next to it (e.g.
+`Ada_Lovelace.wav`) is used as the guest's name recording.
+
+Manifest input: a CSV file with `name` and `photo` columns and an optional
+`audio` column. Relative paths are resolved against the manifest's folder.
+"""
+import os
+import csv
+import time
+import shutil
+import argparse
+from collections import deque
+
+from face_service import FaceService
+from face_gate import FaceGate
+from visual import GuestManager
+from embedding_index import EmbeddingIndex
+from voice_id import load_clip
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+AUDIO_EXTENSIONS = ('.wav', '.flac', '.ogg')
+
+def directory_items(directory):
+    """Yield one enrollment item per image in a directory, in name order."""
+    file_names = sorted(os.listdir(directory))
+    audio_files = {os.path.splitext(f)[0]: f for f in file_names if f.lower().endswith(AUDIO_EXTENSIONS)}
+    for file_name in file_names:
+        stem, extension = os.path.splitext(file_name)
+        if extension.lower() not in IMAGE_EXTENSIONS:
+            continue
+        photo = os.path.abspath(os.path.join(directory, file_name))
+        audio = audio_files.get(stem)
+        yield {
+            'source': photo,
+            'name': stem.replace('_', ' ').strip(),
+            'photo': photo,
+            'audio': os.path.abspath(os.path.join(directory, audio)) if audio is not None else None,
+        }
+
+def manifest_items(manifest_file_name):
+    """Yield one enrollment item per row of a CSV manifest, reading it as a stream."""
+    directory = os.path.dirname(os.path.abspath(manifest_file_name))
+    with open(manifest_file_name, 'r', encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            photo = os.path.abspath(os.path.join(directory, row['photo']))
+            audio = row.get('audio')
+            yield {
+                'source': photo,
+                'name': row['name'].strip(),
+                'photo': photo,
+                'audio': os.path.abspath(os.path.join(directory, audio)) if audio else None,
+            }
+
+class EnrollmentStats:
+    """Counts and throughput of a bulk run, printed as it progresses."""
+
+    def __init__(self, total = None, report_seconds = 2.0):
+        self.total = total
+        self.enrolled = 0
+        self.failed = 0
+        self.skipped = 0
+        self.failures = []
+        self._start = time.perf_counter()
+        self._last_report = self._start
+        self._report_seconds = report_seconds
+
+    @property
+    def done(self):
+        return self.enrolled + self.failed + self.skipped
+
+    @property
+    def rate(self):
+        return self.enrolled / max(time.perf_counter() - self._start, 1e-9)
+
+    def fail(self, item, error):
+        self.failed += 1
+        self.failures.append((item['photo'], error))
+        print(f"[Enroll] Failed {item['photo']}: {error}")
+
+    def report(self, force = False):
+        now = time.perf_counter()
+        if not force and now - self._last_report < self._report_seconds:
+            return
+        self._last_report = now
+        progress = f"{self.done}/{self.total}" if self.total is not None else f"{self.done}"
+        print(f"[Enroll] {progress} processed: {self.enrolled} enrolled, {self.failed} failed, "
+              f"{self.skipped} already done ({self.rate:.1f} guests/s)")
+
+def _copy_file(source, destination):
+    os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+    shutil.copyfile(source, destination)
+
+def _commit(guest_manager, batch):
+    """Write one batch of embedded items: guest records in one transaction, then their files and embeddings."""
+    store = guest_manager.store
+    new_items = [item for item, embedding in batch if item['guest_id'] is None]
+    guest_ids = store.add_many([{
+        'name': item['name'],
+        'source': item['source'],
+        'face_file_name': os.path.join('data/faces', '{id}' + os.path.splitext(item['photo'])[1].lower()),
+        'audio_file_name': (os.path.join('data/names', '{id}' + os.path.splitext(item['audio'])[1].lower())
+                            if item['audio'] is not None else None),
+    } for item in new_items])
+    for item, guest_id in zip(new_items, guest_ids):
+        item['guest_id'] = guest_id
+
+    #Files are copied after the commit; a guest missing from the index is redone on resume, files included
+    for item, embedding in batch:
+        guest = store.get(item['guest_id'])
+        _copy_file(item['photo'], guest['face_file_name'])
+        if item['audio'] is not None and guest['audio_file_name'] is not None:
+            _copy_file(item['audio'], guest['audio_file_name'])
+
+    guest_manager.face_index.add_many([item['guest_id'] for item, embedding in batch],
+                                      [embedding for item, embedding in batch])
+
+    #Name recordings double as voice prints
+    voice_id = guest_manager.voice_id
+    for item, embedding in batch:
+        if item['audio'] is not None:
+            try:
+                voice_id.enroll(item['guest_id'], load_clip(item['audio'], voice_id.sample_rate))
+            except Exception as e:
+                print(f"[Enroll] Could not read {item['audio']}: {e}")
+
+def enroll(guest_manager, items, total = None, commit_size = 256, max_in_flight = 128):
+    """
+    Enroll every item not enrolled by an earlier run and return the run's
+    EnrollmentStats. Items are dicts with a unique `source`, a `name`, a
+    `photo` file and an optional `audio` file.
+    :param guest_manager: GuestManager whose store, face index and face service are used.
+    :param items: Iterable of items, consumed as a stream.
+    :param total: Number of items, if known, for progress reports.
+    :param commit_size: Guests written per transaction.
+    :param max_in_flight: Photos queued for the face workers at once, bounding memory.
+    """
+    face_service = guest_manager._face_service
+    enrolled = guest_manager.store.enrolled_sources()
+    indexed = set(guest_manager.face_index.keys().tolist())
+    stats = EnrollmentStats(total)
+
+    in_flight = deque()
+    batch = []
+
+    def collect():
+        item, future = in_flight.popleft()
+        try:
+            embedding, error = future.result()
+        except Exception as e:
+            embedding, error = None, str(e)
+        if error is not None:
+            stats.fail(item, error)
+            return
+        batch.append((item, embedding))
+        if len(batch) >= commit_size:
+            _commit(guest_manager, batch)
+            stats.enrolled += len(batch)
+            batch.clear()
+        stats.report()
+
+    for item in items:
+        guest_id = enrolled.get(item['source'])
+        if guest_id is not None and guest_id in indexed:
+            stats.skipped += 1
+            continue
+        #A guest recorded before an interruption but never indexed keeps its id
+        item['guest_id'] = guest_id
+        in_flight.append((item, face_service.submit_embed_file(item['photo'], face_gate = guest_manager._face_gate)))
+        while len(in_flight) >= max_in_flight:
+            collect()
+
+    while in_flight:
+        collect()
+    if batch:
+        _commit(guest_manager, batch)
+        stats.enrolled += len(batch)
+    stats.report(force = True)
+    return stats
+
+def reindex(guest_manager, commit_size = 256, max_in_flight = 128):
+    """
+    Re-embed every stored guest's face with the face service's current model
+    and swap the new index in once it is complete, so the old index keeps
+    working until then. If any guest's face is missing or fails to embed,
+    the old index is kept, so no guest silently drops out of recognition.
+    Returns the run's EnrollmentStats.
+    """
+    face_service = guest_manager._face_service
+    face_index = guest_manager.face_index
+    new_index_file_name = os.path.splitext(face_index._index_file_name)[0] + '.reindex.npy'
+    for file_name in (new_index_file_name, os.path.splitext(new_index_file_name)[0] + '.ids.npy'):
+        if os.path.exists(file_name):
+            os.remove(file_name)
+    new_index = EmbeddingIndex(new_index_file_name, model = face_service.model_name)
+    stats = EnrollmentStats(len(guest_manager.store))
+
+    in_flight = deque()
+    keys, embeddings = [], []
+
+    def collect():
+        guest, future = in_flight.popleft()
+        try:
+            embedding, error = future.result()
+        except Exception as e:
+            embedding, error = None, str(e)
+        if error is not None:
+            stats.fail({'photo': guest['face_file_name']}, error)
+            return
+        keys.append(guest['id'])
+        embeddings.append(embedding)
+        if len(keys) >= commit_size:
+            new_index.add_many(keys, embeddings)
+            stats.enrolled += len(keys)
+            keys.clear()
+            embeddings.clear()
+        stats.report()
+
+    for guest in guest_manager.store:
+        if not guest['face_file_name'] or not os.path.exists(guest['face_file_name']):
+            stats.fail({'photo': guest['face_file_name']}, 'face file missing')
+            continue
+        #Stored faces were accepted once already, so don't drop a guest if the new detector misses their face
+        in_flight.append((guest, face_service.submit_embed_file(guest['face_file_name'], enforce_detection = False,
+                                                                face_gate = guest_manager._face_gate)))
+        while len(in_flight) >= max_in_flight:
+            collect()
+
+    while in_flight:
+        collect()
+    if keys:
+        new_index.add_many(keys, embeddings)
+        stats.enrolled += len(keys)
+
+    stats.report(force = True)
+    if stats.failed > 0:
+        #The old index may hold another model's embeddings, so the failed guests' rows can't be carried over
+        print(f"[Enroll] Keeping the old face index, {stats.failed} guest(s) could not be re-embedded")
+    elif len(new_index) > 0:
+        face_index.replace(new_index)
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('input', nargs='?', help='Directory of guest photos, or a CSV manifest')
+    parser.add_argument('--reindex', action='store_true', help='Re-embed every stored guest instead of enrolling')
+    parser.add_argument('--db', default='data/guests.db', help='Guest database')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Face worker processes')
+    parser.add_argument('--batch-size', type=int, default=16, help='Photos embedded per worker call')
+    parser.add_argument('--commit-size', type=int, default=256, help='Guests written per transaction')
+    args = parser.parse_args()
+    if args.input is None and not args.reindex:
+        parser.error('an input directory or manifest is required unless --reindex is given')
+
+    #Always the bot's model, an index of any other model couldn't be used for recognition
+    face_service = FaceService(num_workers = args.workers, max_batch_size = args.batch_size)
+    face_service.warm_up()
+    #Faces are embedded the way the bot will look them up, which is without a gate if OpenCV has none
+    try:
+        face_gate = FaceGate()
+    except Exception as e:
+        print("[Enroll] Face gate unavailable, embedding whole photos:", e)
+        face_gate = None
+    guest_manager = GuestManager(face_service, args.db, face_gate = face_gate)
+
+    #Keep every worker busy with a couple of batches queued each
+    max_in_flight = 2 * args.workers * args.batch_size
+    try:
+        if args.reindex:
+            stats = reindex(guest_manager, commit_size = args.commit_size, max_in_flight = max_in_flight)
+        elif os.path.isdir(args.input):
+            total = sum(1 for f in os.listdir(args.input) if f.lower().endswith(IMAGE_EXTENSIONS))
+            stats = enroll(guest_manager, directory_items(args.input), total = total,
+                           commit_size = args.commit_size, max_in_flight = max_in_flight)
+        else:
+            stats = enroll(guest_manager, manifest_items(args.input),
+                           commit_size = args.commit_size, max_in_flight = max_in_flight)
+    finally:
+        face_service.shutdown()
+        guest_manager.store.close()
+
+    if stats.failures:
+        print(f"[Enroll] {len(stats.failures)} photo(s) failed, fix them and run again to retry")
+
+if __name__ == '__main__':
+    main()
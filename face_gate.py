@@ -0,0 +1,227 @@
+import os
+import math
+import time
+from threading import Thread, Lock
+
+import cv2
+
+from metrics import METRICS, span
+
+class FaceObservation:
+    """A face found by FaceGate, in full resolution frame coordinates."""
+
+    def __init__(self, box, frame_width, roll = 0.0, yaw = None):
+        """
+        :param box: (x, y, width, height) of the face.
+        :param frame_width: Width of the frame the face was found in.
+        :param roll: In-plane rotation of the eye line in degrees, 0 when the eyes weren't found.
+        :param yaw: Horizontal offset of the eyes from the face centre as a fraction of the face width, or None.
+        """
+        self.box = box
+        x, y, w, h = box
+        self.center = (x + w / 2, y + h / 2)
+        self.size = w / frame_width
+        self.roll = roll
+        self.yaw = yaw
+
+class FaceGate:
+    """
+    Cheap face presence check run before the embedding model. Frames are
+    searched for faces with an OpenCV Haar cascade at low resolution, faces
+    which are too small or turned away are rejected, and accepted faces are
+    cut out as a level, tight crop, so the embedding model can skip its own
+    detector.
+    """
+
+    def __init__(self, detect_width = 320, min_face_fraction = 0.06, max_roll_degrees = 25, max_yaw = 0.25,
+                 margin = 0.2, crop_size = 224, cascade_dir = None):
+        """
+        Constructor.
+        :param detect_width: Frames are downscaled to this width before searching for faces.
+        :param min_face_fraction: Smallest face accepted, as a fraction of the frame width.
+        :param max_roll_degrees: Most the head may be tilted sideways.
+        :param max_yaw: Most the eyes may be off the face centre, as a fraction of the face width.
+        :param margin: Space kept around the face in the crop, as a fraction of the face size.
+        :param crop_size: Side of the square crop handed to the embedding model.
+        :param cascade_dir: Folder with the Haar cascade files. Defaults to the ones shipped with OpenCV.
+        """
+        #The Haar cascades were dropped from the main OpenCV package in version 5
+        if not hasattr(cv2, 'CascadeClassifier'):
+            raise ImportError(f"FaceGate needs OpenCV 4 (pip install 'opencv-python<5'), found {cv2.__version__}")
+
+        #Enough to build the same gate elsewhere, e.g. in the face service's workers
+        self.settings = {'detect_width': detect_width, 'min_face_fraction': min_face_fraction,
+                         'max_roll_degrees': max_roll_degrees, 'max_yaw': max_yaw, 'margin': margin,
+                         'crop_size': crop_size, 'cascade_dir': cascade_dir}
+        cascade_dir = cascade_dir if cascade_dir is not None else cv2.data.haarcascades
+        self._face_cascade = cv2.CascadeClassifier(os.path.join(cascade_dir, 'haarcascade_frontalface_default.xml'))
+        self._eye_cascade = cv2.CascadeClassifier(os.path.join(cascade_dir, 'haarcascade_eye.xml'))
+        if self._face_cascade.empty():
+            raise ValueError(f"Could not load the face cascade from {cascade_dir}")
+
+        self._detect_width = detect_width
+        self._min_face_fraction = min_face_fraction
+        self._max_roll_degrees = max_roll_degrees
+        self._max_yaw = max_yaw
+        self._margin = margin
+        self._crop_size = crop_size
+
+        #The camera watcher and command handlers share the cascades
+        self._lock = Lock()
+
+    def detect(self, frame):
+        """Return a FaceObservation of the largest acceptable face in a BGR frame, or None."""
+        with span('face_gate'):
+            observation, reason = self._detect(frame)
+        if observation is None:
+            METRICS.counter(f'face_gate_{reason}').inc()
+        return observation
+
+    def _detect(self, frame):
+        height, width = frame.shape[:2]
+        scale = min(self._detect_width / width, 1.0)
+        small = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else frame
+        gray = cv2.equalizeHist(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY))
+
+        min_size = max(int(self._min_face_fraction * gray.shape[1]), 16)
+        with self._lock:
+            faces = self._face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5,
+                                                        minSize=(min_size, min_size))
+        if len(faces) == 0:
+            return None, 'no_face'
+
+        #The closest visitor is the one talking to the bot
+        x, y, w, h = max(faces, key=lambda face: face[2] * face[3])
+        box = (int(x / scale), int(y / scale), int(w / scale), int(h / scale))
+
+        roll, yaw = self._pose(frame, box)
+        if abs(roll) > self._max_roll_degrees or (yaw is not None and abs(yaw) > self._max_yaw):
+            return None, 'bad_pose'
+        return FaceObservation(box, width, roll, yaw), None
+
+    def _pose(self, frame, box):
+        """Estimate roll and yaw from the eyes in the upper half of the face. Roll is 0 and yaw None without two eyes."""
+        x, y, w, h = box
+        upper = frame[y:y + h * 6 // 10, x:x + w]
+        #Search the eyes on a small copy of the face, whatever the camera resolution
+        eye_scale = min(120 / w, 1.0)
+        roi = cv2.cvtColor(cv2.resize(upper, None, fx=eye_scale, fy=eye_scale, interpolation=cv2.INTER_AREA),
+                           cv2.COLOR_BGR2GRAY)
+        min_size = max(roi.shape[1] // 8, 8)
+        with self._lock:
+            eyes = self._eye_cascade.detectMultiScale(roi, scaleFactor=1.1, minNeighbors=5, minSize=(min_size, min_size))
+        if len(eyes) < 2:
+            return 0.0, None
+
+        #The two largest detections, left to right, as centres in face coordinates
+        eyes = sorted(eyes, key=lambda eye: eye[2] * eye[3])[-2:]
+        centers = sorted(((ex + ew / 2) / eye_scale, (ey + eh / 2) / eye_scale) for ex, ey, ew, eh in eyes)
+        (left_x, left_y), (right_x, right_y) = centers
+
+        roll = math.degrees(math.atan2(right_y - left_y, right_x - left_x))
+        yaw = ((left_x + right_x) / 2 - w / 2) / w
+        return roll, yaw
+
+    def crop(self, frame, observation):
+        """Cut a level, square crop of the face, resized for the embedding model, in a single warp."""
+        x, y, w, h = observation.box
+        side = max(w, h) * (1 + 2 * self._margin)
+        center = observation.center
+        matrix = cv2.getRotationMatrix2D(center, observation.roll, self._crop_size / side)
+        matrix[:, 2] += (self._crop_size / 2 - center[0], self._crop_size / 2 - center[1])
+        return cv2.warpAffine(frame, matrix, (self._crop_size, self._crop_size), flags=cv2.INTER_LINEAR,
+                              borderMode=cv2.BORDER_REPLICATE)
+
+class FaceWatcher:
+    """
+    Watches the camera for visitors walking up. Once a face large enough to
+    be standing in front of the bot has been seen for a few checks in a row,
+    `on_arrival(observation, frame)` is called. The same visitor only
+    triggers again after leaving the camera's view. Every check also feeds
+    an optional IdentityTracker, which follows faces between recognitions.
+    """
+
+    def __init__(self, camera, face_gate, on_arrival, interval = 0.2, min_face_fraction = 0.12, confirm_checks = 3,
+                 leave_checks = 10, cooldown_seconds = 20.0, tracker = None):
+        """
+        Constructor.
+        :param camera: CameraService to take frames from.
+        :param face_gate: FaceGate used to find faces.
+        :param on_arrival: Called from the watcher thread when a visitor arrives. May be set after construction.
+        :param interval: Seconds between checks.
+        :param min_face_fraction: Smallest face, as a fraction of the frame width, counted as standing at the bot.
+        :param confirm_checks: Checks in a row a face must be seen before it counts as an arrival.
+        :param leave_checks: Checks in a row without a face before the next arrival can trigger.
+        :param cooldown_seconds: Least time between two arrivals.
+        :param tracker: Optional IdentityTracker to feed the faces seen.
+        """
+        self._camera = camera
+        self._face_gate = face_gate
+        self.on_arrival = on_arrival
+        self._interval = interval
+        self._min_face_fraction = min_face_fraction
+        self._confirm_checks = confirm_checks
+        self._leave_checks = leave_checks
+        self._cooldown_seconds = cooldown_seconds
+        self._tracker = tracker
+
+        self._running = False
+        self._thread = None
+        self.present = False
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            self._thread = Thread(target=self._watch, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+
+    def _watch(self):
+        seen = 0
+        unseen = self._leave_checks
+        last_arrival = -math.inf
+        last_error = None
+        while self._running:
+            time.sleep(self._interval)
+            try:
+                frames = self._camera.latest(max_age = 2 * self._interval)
+                if len(frames) == 0:
+                    continue
+                frame = frames[-1]
+                observation = self._face_gate.detect(frame)
+            except Exception as e:
+                #A camera hiccup must not end watching for good, but a lasting failure is only reported once
+                METRICS.counter('face_watcher_errors').inc()
+                if str(e) != last_error:
+                    print("[Face Watcher] Check failed, still watching:", e)
+                    last_error = str(e)
+                continue
+            last_error = None
+
+            if self._tracker is not None:
+                self._tracker.update([observation] if observation is not None else [])
+
+            if observation is not None and observation.size >= self._min_face_fraction:
+                seen += 1
+                if seen == self._confirm_checks:
+                    was_away = unseen >= self._leave_checks
+                    unseen = 0
+                    self.present = True
+                    if was_away and time.monotonic() - last_arrival >= self._cooldown_seconds and self.on_arrival:
+                        last_arrival = time.monotonic()
+                        try:
+                            self.on_arrival(observation, frame)
+                        except Exception as e:
+                            print("[Face Watcher] Arrival callback failed:", e)
+                elif seen > self._confirm_checks:
+                    unseen = 0
+            else:
+                seen = 0
+                unseen += 1
+                if unseen >= self._leave_checks:
+                    self.present = False
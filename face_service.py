@@ -0,0 +1,316 @@
+import os
+import time
+import queue
+import asyncio
+import multiprocessing
+from collections import deque
+from threading import Thread, Lock
+from concurrent.futures import ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from metrics import METRICS
+
+FACE_MODEL_NAME = 'Facenet512'
+DETECTOR_BACKEND = 'opencv'
+
+#Settings of the models loaded in a worker process
+_worker_config = {}
+#FaceGates built in a worker process, by their settings
+_worker_face_gates = {}
+
+def _first_embedding(representations):
+    """Pull the embedding of the most prominent face out of a DeepFace.represent result."""
+    #Newer DeepFace versions return one dict per detected face
+    if len(representations) > 0 and isinstance(representations[0], dict):
+        return representations[0]['embedding']
+    return representations
+
+def _init_worker(model_name, detector_backend):
+    """Runs once in every worker process: load the models and run a dummy inference."""
+    from deepface import DeepFace #Facial Recognition, only imported inside workers
+
+    _worker_config['model_name'] = model_name
+    _worker_config['detector_backend'] = detector_backend
+
+    DeepFace.build_model(model_name)
+    dummy = np.zeros((224, 224, 3), dtype=np.uint8)
+    DeepFace.represent(dummy, model_name=model_name, detector_backend=detector_backend, enforce_detection=False)
+
+def _embed_batch(frames, detector_backend = None):
+    """Compute one face embedding per frame."""
+    from deepface import DeepFace
+
+    detector_backend = detector_backend or _worker_config['detector_backend']
+    return [_first_embedding(DeepFace.represent(frame, model_name=_worker_config['model_name'],
+                                                detector_backend=detector_backend, enforce_detection=False))
+            for frame in frames]
+
+def _worker_face_gate(settings):
+    """The worker's FaceGate with the given settings, built on first use."""
+    if settings not in _worker_face_gates:
+        from face_gate import FaceGate
+        _worker_face_gates[settings] = FaceGate(**dict(settings))
+    return _worker_face_gates[settings]
+
+def _embed_file_batch(file_names, options = (True, None)):
+    """
+    Decode image files inside the worker and compute one face embedding per
+    file, so only file names and embeddings cross the process boundary.
+    `options` is (enforce_detection, face gate settings). With face gate
+    settings, faces are embedded like GuestManager embeds them: a tight crop
+    of the face the gate found, or the whole frame if it found none.
+    Returns (embedding, error) pairs, since one bad file must not fail the batch.
+    """
+    import cv2
+    from deepface import DeepFace
+
+    enforce_detection, face_gate_settings = options
+    face_gate = _worker_face_gate(face_gate_settings) if face_gate_settings is not None else None
+    results = []
+    for file_name in file_names:
+        frame = cv2.imread(file_name)
+        if frame is None:
+            results.append((None, 'could not decode image'))
+            continue
+        observation = face_gate.detect(frame) if face_gate is not None else None
+        if observation is not None:
+            representations = DeepFace.represent(face_gate.crop(frame, observation),
+                                                 model_name=_worker_config['model_name'],
+                                                 detector_backend='skip', enforce_detection=False)
+            results.append((_first_embedding(representations), None))
+            continue
+        try:
+            representations = DeepFace.represent(frame, model_name=_worker_config['model_name'],
+                                                 detector_backend=_worker_config['detector_backend'],
+                                                 enforce_detection=enforce_detection)
+        except ValueError:
+            results.append((None, 'no face found'))
+            continue
+        results.append((_first_embedding(representations), None))
+    return results
+
+def _detect_batch(frames):
+    """Return the facial areas and confidences found in each frame."""
+    from deepface import DeepFace
+
+    results = []
+    for frame in frames:
+        faces = DeepFace.extract_faces(frame, detector_backend=_worker_config['detector_backend'],
+                                       enforce_detection=False)
+        results.append([{'facial_area': face['facial_area'], 'confidence': face.get('confidence')}
+                        for face in faces])
+    return results
+
+def _ping(hold_seconds = 0.0):
+    #Holding the worker keeps it from answering the other pings of a warm up round too
+    time.sleep(hold_seconds)
+    return os.getpid()
+
+_BATCH_FUNCTIONS = {'embed': _embed_batch, 'embed_file': _embed_file_batch, 'detect': _detect_batch}
+
+class FaceService:
+    """
+    Long-lived pool of worker processes which load the face detector and
+    embedding models once at startup. Requests are queued and sent to the
+    workers in batches, so the bot's process never imports DeepFace or
+    pays model-load cost on the request path. If a worker crashes, the
+    requests it held fail and the pool is rebuilt and warmed up again.
+    """
+
+    def __init__(self,
+                 num_workers = 1,
+                 model_name = FACE_MODEL_NAME,
+                 detector_backend = DETECTOR_BACKEND,
+                 max_batch_size = 8,
+                 max_batch_wait = 0.01):
+        """
+        Constructor.
+        :param num_workers: Number of worker processes, each holding its own copy of the models.
+        :param model_name: DeepFace embedding model.
+        :param detector_backend: DeepFace face detector.
+        :param max_batch_size: Maximum number of frames sent to a worker in one call.
+        :param max_batch_wait: Seconds to wait for more queued frames before sending a partial batch.
+        """
+        self.num_workers = num_workers
+        self.model_name = model_name
+        self.detector_backend = detector_backend
+        self._max_batch_size = max_batch_size
+        self._max_batch_wait = max_batch_wait
+
+        self._pool = self._create_pool()
+        self._pool_lock = Lock()
+
+        self._requests = queue.Queue()
+        self._stats_lock = Lock()
+        self._latencies = deque(maxlen=1000)
+        self._num_requests = 0
+        self._num_batches = 0
+        self._num_errors = 0
+        self._running = True
+
+        self._dispatcher = Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def _create_pool(self):
+        #Spawn instead of fork, so workers don't inherit the audio threads and SDK state of the bot
+        return ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(self.model_name, self.detector_backend))
+
+    def _restart_pool(self, broken_pool):
+        """Replace a pool whose worker died, unless that already happened, and warm the new one up."""
+        with self._pool_lock:
+            if self._pool is not broken_pool or not self._running:
+                return
+            print("[Face Service] A worker died, restarting the pool")
+            METRICS.counter('face_service_restarts').inc()
+            broken_pool.shutdown(wait=False)
+            self._pool = self._create_pool()
+        Thread(target=self._warm_up_quietly, daemon=True).start()
+
+    def _warm_up_quietly(self):
+        try:
+            self.warm_up()
+        except Exception as e:
+            print("[Face Service] Could not warm up the restarted pool:", e)
+
+    def warm_up(self, timeout = 300.0, hold_seconds = 0.1):
+        """
+        Start every worker and block until their models are loaded. Raises
+        TimeoutError if not every worker answered within `timeout` seconds.
+        """
+        start = time.perf_counter()
+        pids = set()
+        #Pings are sent in rounds of one per worker at once, until every worker process has answered one
+        while len(pids) < self.num_workers:
+            remaining = timeout - (time.perf_counter() - start)
+            if remaining <= 0:
+                raise TimeoutError(f"Only {len(pids)} of {self.num_workers} face workers started")
+            futures = [self._pool.submit(_ping, hold_seconds) for _ in range(self.num_workers)]
+            pids.update(future.result(timeout=remaining) for future in futures)
+        print(f"[Face Service] {len(pids)} worker(s) warm after {time.perf_counter() - start:.2f}s")
+
+    def submit_embed(self, frame, detector_backend = None):
+        """Queue a frame for embedding and return a concurrent Future of the embedding."""
+        return self._submit('embed', frame, detector_backend)
+
+    def submit_embed_file(self, file_name, enforce_detection = True, face_gate = None):
+        """
+        Queue an image file for embedding and return a concurrent Future of an
+        (embedding, error) pair. The file is decoded in the worker. Pass the
+        bot's FaceGate, so the face is cropped as it is for recognition.
+        """
+        face_gate_settings = tuple(sorted(face_gate.settings.items())) if face_gate is not None else None
+        return self._submit('embed_file', file_name, (enforce_detection, face_gate_settings))
+
+    def submit_detect(self, frame):
+        """Queue a frame for face detection and return a concurrent Future of the faces found."""
+        return self._submit('detect', frame)
+
+    async def embed(self, frame, detector_backend = None):
+        return await asyncio.wrap_future(self.submit_embed(frame, detector_backend))
+
+    async def detect(self, frame):
+        return await asyncio.wrap_future(self.submit_detect(frame))
+
+    def _submit(self, kind, frame, option = None):
+        future = Future()
+        self._requests.put((kind, option, frame, future, time.perf_counter()))
+        return future
+
+    def _dispatch(self):
+        """Collect queued requests into batches and hand them to the pool."""
+        while self._running:
+            request = self._requests.get()
+            if request is None:
+                break
+            batch = [request]
+
+            #Wait briefly for more requests of the same kind to share the call
+            deadline = time.perf_counter() + self._max_batch_wait
+            while len(batch) < self._max_batch_size:
+                try:
+                    request = self._requests.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._running = False
+                    break
+                batch.append(request)
+
+            #Group by request kind and option, keeping each group's order
+            groups = {}
+            for request in batch:
+                groups.setdefault((request[0], request[1]), []).append(request)
+            for (kind, option), requests in groups.items():
+                frames = [request[2] for request in requests]
+                args = (frames,) if option is None else (frames, option)
+                pool = self._pool
+                try:
+                    pool_future = pool.submit(_BATCH_FUNCTIONS[kind], *args)
+                except Exception as e:
+                    #The dispatcher has to outlive a broken pool, or no request would ever be answered again
+                    self._fail(requests, e)
+                    if isinstance(e, BrokenProcessPool):
+                        self._restart_pool(pool)
+                    continue
+                pool_future.add_done_callback(lambda f, requests=requests, pool=pool: self._complete(f, requests, pool))
+
+    def _fail(self, requests, error):
+        with self._stats_lock:
+            self._num_errors += len(requests)
+        for request in requests:
+            request[3].set_exception(error)
+
+    def _complete(self, pool_future, requests, pool = None):
+        """Distribute a batch's results to the callers' futures."""
+        now = time.perf_counter()
+        error = pool_future.exception()
+        with self._stats_lock:
+            self._num_batches += 1
+            self._num_requests += len(requests)
+            if error is not None:
+                self._num_errors += len(requests)
+            self._latencies.extend(now - request[4] for request in requests)
+
+        if error is not None:
+            for request in requests:
+                request[3].set_exception(error)
+            if isinstance(error, BrokenProcessPool) and pool is not None:
+                self._restart_pool(pool)
+            return
+        for request, result in zip(requests, pool_future.result()):
+            request[3].set_result(result)
+
+    def health(self):
+        """Return liveness and latency statistics of the service."""
+        start = time.perf_counter()
+        try:
+            self._pool.submit(_ping).result(timeout=5)
+            alive = True
+        except Exception:
+            alive = False
+        ping_seconds = time.perf_counter() - start
+
+        with self._stats_lock:
+            latencies = np.array(self._latencies) if len(self._latencies) > 0 else np.zeros(1)
+            return {
+                'alive': alive,
+                'ping_seconds': ping_seconds,
+                'queued': self._requests.qsize(),
+                'requests': self._num_requests,
+                'batches': self._num_batches,
+                'errors': self._num_errors,
+                'latency_p50': float(np.percentile(latencies, 50)),
+                'latency_p95': float(np.percentile(latencies, 95)),
+            }
+
+    def shutdown(self):
+        with self._pool_lock:
+            self._running = False
+        self._requests.put(None)
+        self._pool.shutdown(wait=True)
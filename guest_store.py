@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import sqlite3
+from threading import RLock
+
+GUEST_FIELDS = ('id', 'name', 'audio_file_name', 'face_file_name', 'created_at')
+
+class GuestStore:
+    """
+    SQLite backed guest records. The database runs in WAL mode, so each
+    enrollment is a small atomic append instead of a rewrite of every guest,
+    and readers never see a half written record.
+    """
+
+    #Guests read per query while iterating
+    PAGE_SIZE = 256
+
+    def __init__(self, db_file_name = 'data/guests.db', legacy_log_file_name = None):
+        """
+        Constructor.
+        :param db_file_name: Path of the SQLite database, created if missing.
+        :param legacy_log_file_name: Optional guest_log.json to import guests from when the database is empty.
+        """
+        self._db_file_name = db_file_name
+        #One connection is shared by every thread, so reads take the lock as well as writes
+        self._lock = RLock()
+
+        #Autocommit mode, transactions are opened explicitly where needed
+        self._conn = sqlite3.connect(db_file_name, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS guests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT,
+                audio_file_name TEXT,
+                face_file_name TEXT,
+                created_at REAL
+            )''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS guests_name ON guests (name COLLATE NOCASE)')
+        #Where bulk enrolled guests came from, so an interrupted enrollment can resume
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS guest_sources (
+                source TEXT PRIMARY KEY,
+                guest_id INTEGER REFERENCES guests (id)
+            )''')
+
+        if legacy_log_file_name is not None and len(self) == 0:
+            self._import_legacy_log(legacy_log_file_name)
+
+    def _import_legacy_log(self, log_file_name):
+        """Import the guests of an old guest_log.json in a single transaction."""
+        if not os.path.exists(log_file_name) or os.path.getsize(log_file_name) == 0:
+            return
+        with open(log_file_name, 'r', encoding='utf-8') as f:
+            guests = json.load(f)
+
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.executemany(
+                    'INSERT INTO guests (id, name, audio_file_name, face_file_name, created_at) VALUES (?, ?, ?, ?, ?)',
+                    [(g['id'], g['name'], g.get('audio_file_name'), g.get('face_file_name'), time.time())
+                     for g in guests])
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        print("Imported", len(guests), "guests from", log_file_name)
+
+    def add(self, name, prepare = None, **file_names):
+        """
+        Atomically insert a new guest and return its id. File names may
+        contain an `{id}` placeholder, e.g. face_file_name='data/faces/{id}.jpg'.
+        `prepare(guest)` is called with the new record before it is committed,
+        e.g. to write the guest's files; if it raises, the guest is rolled
+        back, so a guest is never stored without them. A rolled back id is
+        handed out again, so anything kept outside the database, such as a
+        face embedding, is only added once this returns.
+        """
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                #The database allocates the id, so concurrent writers never collide
+                cursor = self._conn.execute('INSERT INTO guests (name, created_at) VALUES (?, ?)', (name, time.time()))
+                guest_id = cursor.lastrowid
+                self._conn.execute(
+                    'UPDATE guests SET audio_file_name = ?, face_file_name = ? WHERE id = ?',
+                    (file_names.get('audio_file_name', '').format(id=guest_id) or None,
+                     file_names.get('face_file_name', '').format(id=guest_id) or None,
+                     guest_id))
+                if prepare is not None:
+                    prepare(self.get(guest_id))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return guest_id
+
+    def add_many(self, guests):
+        """
+        Insert many guests in one transaction and return their ids in order.
+        Each guest is a dict with a `name`, optional file names which may
+        contain an `{id}` placeholder, and an optional unique `source` it was
+        enrolled from.
+        """
+        guest_ids = []
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                for guest in guests:
+                    cursor = self._conn.execute('INSERT INTO guests (name, created_at) VALUES (?, ?)', (guest['name'], now))
+                    guest_id = cursor.lastrowid
+                    self._conn.execute(
+                        'UPDATE guests SET audio_file_name = ?, face_file_name = ? WHERE id = ?',
+                        ((guest.get('audio_file_name') or '').format(id=guest_id) or None,
+                         (guest.get('face_file_name') or '').format(id=guest_id) or None,
+                         guest_id))
+                    if guest.get('source') is not None:
+                        self._conn.execute('INSERT INTO guest_sources (source, guest_id) VALUES (?, ?)',
+                                           (guest['source'], guest_id))
+                    guest_ids.append(guest_id)
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return guest_ids
+
+    def enrolled_sources(self):
+        """Return a dict of every source guests were enrolled from to the guest's id."""
+        with self._lock:
+            return dict(self._conn.execute('SELECT source, guest_id FROM guest_sources').fetchall())
+
+    def get(self, guest_id):
+        """Return the guest with the given id as a dict, or None."""
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM guests WHERE id = ?', (guest_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def find_by_name(self, name):
+        """Return all guests with the given name (case insensitive)."""
+        with self._lock:
+            rows = self._conn.execute('SELECT * FROM guests WHERE name = ? COLLATE NOCASE ORDER BY id', (name,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def file_names(self):
+        """
+        Return the set of every audio and face file a committed guest refers
+        to. Read through a connection of its own without taking the lock, so
+        e.g. the audio writer's thread never waits for a guest being added,
+        who may be waiting for the writer in turn.
+        """
+        conn = sqlite3.connect(self._db_file_name)
+        try:
+            rows = conn.execute('SELECT audio_file_name, face_file_name FROM guests').fetchall()
+        finally:
+            conn.close()
+        return set(file_name for row in rows for file_name in row if file_name is not None)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM guests').fetchone()[0]
+
+    def __iter__(self):
+        """Stream all guests in id order, a page at a time, without loading them all at once."""
+        page_size = self.PAGE_SIZE
+        last_id = -1
+        while True:
+            #Pages are read under the lock, so no cursor is left open across another thread's transaction
+            with self._lock:
+                rows = self._conn.execute('SELECT * FROM guests WHERE id > ? ORDER BY id LIMIT ?',
+                                          (last_id, page_size)).fetchall()
+            for row in rows:
+                yield dict(row)
+            if len(rows) < page_size:
+                return
+            last_id = rows[-1]['id']
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
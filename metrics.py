@@ -0,0 +1,164 @@
+import os
+import json
+import time
+from bisect import bisect_left
+from threading import Lock
+from contextlib import contextmanager
+
+#Histogram bucket upper bounds in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Histogram:
+    """Fixed-bucket histogram of durations, cheap enough to update on every audio frame."""
+
+    def __init__(self, name, buckets = DEFAULT_BUCKETS):
+        self.name = name
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket containing it."""
+        if self.count == 0:
+            return None
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+class Counter:
+    """Monotonically increasing count."""
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+        self._lock = Lock()
+
+    def inc(self, amount = 1):
+        with self._lock:
+            self.value += amount
+
+class Metrics:
+    """Registry of named histograms and counters with Prometheus and JSON lines export."""
+
+    def __init__(self, prefix = 'welcomebot'):
+        self.prefix = prefix
+        self._histograms = {}
+        self._counters = {}
+        self._lock = Lock()
+
+    def histogram(self, name, buckets = DEFAULT_BUCKETS):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, Histogram(name, buckets))
+        return histogram
+
+    def counter(self, name):
+        counter = self._counters.get(name)
+        if counter is None:
+            with self._lock:
+                counter = self._counters.setdefault(name, Counter(name))
+        return counter
+
+    @contextmanager
+    def span(self, name):
+        """Time the enclosed block into the `name` histogram."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histogram(name).observe(time.perf_counter() - start)
+
+    def snapshot(self):
+        return {
+            'time': time.time(),
+            'histograms': {name: {'count': h.count, 'sum': h.sum, 'p50': h.quantile(0.5), 'p95': h.quantile(0.95),
+                                  'buckets': dict(zip([str(b) for b in h.buckets] + ['+Inf'], h.counts))}
+                           for name, h in self._histograms.items()},
+            'counters': {name: c.value for name, c in self._counters.items()},
+        }
+
+    def export_prometheus(self, file_name):
+        """Write every metric in the Prometheus text format, replacing the file atomically."""
+        lines = []
+        for name, histogram in sorted(self._histograms.items()):
+            metric = f'{self.prefix}_{name}_seconds'
+            lines.append(f'# TYPE {metric} histogram')
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram.count}')
+            lines.append(f'{metric}_sum {histogram.sum}')
+            lines.append(f'{metric}_count {histogram.count}')
+        for name, counter in sorted(self._counters.items()):
+            metric = f'{self.prefix}_{name}_total'
+            lines.append(f'# TYPE {metric} counter')
+            lines.append(f'{metric} {counter.value}')
+
+        tmp_file_name = file_name + '.tmp'
+        with open(tmp_file_name, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_file_name, file_name)
+
+    def export_jsonl(self, file_name):
+        """Append a snapshot of every metric as one JSON line."""
+        with open(file_name, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(self.snapshot()) + '\n')
+
+#Process wide registry used by the bot's modules
+METRICS = Metrics()
+
+def span(name):
+    return METRICS.span(name)
+
+class FrameLoopMonitor:
+    """
+    Tracks the timing of an audio read loop: jitter of the interval between
+    reads, and an estimate of recorder overflows. The recorder only logs its
+    overflows, so they are inferred from how far the audio read so far lags
+    behind wall clock time; once that backlog exceeds the recorder's buffer,
+    audio must have been dropped.
+    """
+
+    def __init__(self, sample_rate = 16_000, buffer_seconds = 1.0, metrics = METRICS):
+        self._sample_rate = sample_rate
+        self._buffer_seconds = buffer_seconds
+        self._jitter = metrics.histogram('frame_jitter')
+        self._frames = metrics.counter('audio_frames')
+        self._overflows = metrics.counter('recorder_overflows_estimated')
+
+        self._start = None
+        self._last = None
+        self._audio_seconds = 0.0
+
+    def tick(self, num_samples):
+        """Call once after every read of `num_samples` samples."""
+        now = time.perf_counter()
+        frame_seconds = num_samples / self._sample_rate
+        if self._start is None:
+            self._start = now - frame_seconds
+        else:
+            self._jitter.observe(abs((now - self._last) - frame_seconds))
+        self._last = now
+        self._audio_seconds += frame_seconds
+        self._frames.inc()
+
+        backlog = (now - self._start) - self._audio_seconds
+        if backlog > self._buffer_seconds:
+            self._overflows.inc()
+            #The dropped audio will never be read, catch the estimate up
+            self._audio_seconds += backlog
@@ -0,0 +1,267 @@
+import time
+import queue
+from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from pvrecorder import PvRecorder
+
+from audio import WakeDetector
+from vad import NoiseFloor
+from metrics import METRICS, FrameLoopMonitor
+from startup import STARTUP
+
+class MultiDeviceListener:
+    """
+    Listens for the wake word on several microphones in one process and
+    reports a single stream of WakeDetector events.
+
+    Every tick, the newest frame of each microphone is stacked into one
+    matrix and the per-channel signal-to-noise ratio is computed in a single
+    vectorized pass. Only channels which recently carried voice, at most
+    `max_active_channels` of them, run wake word detection, on a shared
+    thread pool, so quiet microphones cost almost nothing. When several
+    channels hear the wake word, the one with the best SNR is used. A
+    microphone which misses a tick is left out rather than padded with
+    silence, until it delivers audio again.
+    """
+
+    def __init__(self,
+                 device_indices,
+                 detector_factory,
+                 on_event,
+                 max_active_channels = 2,
+                 voice_gate_db = 6.0,
+                 hold_seconds = 1.5,
+                 merge_seconds = 0.15,
+                 snr_seconds = 0.6,
+                 num_workers = 2,
+                 recorder_factory = PvRecorder):
+        """
+        Constructor.
+        :param device_indices: Input devices to listen on.
+        :param detector_factory: Creates one WakeDetector per device, each with its own endpointer.
+        :param on_event: Callback `on_event(device_index, event, keyword, audio)` for the chosen channel's events.
+        :param max_active_channels: Most channels running wake word detection at once.
+        :param voice_gate_db: SNR above which a channel is considered to carry voice.
+        :param hold_seconds: How long a channel keeps running detection after it last carried voice.
+        :param merge_seconds: After a first detection, how long to wait for other channels before choosing one.
+        :param snr_seconds: Window over which each channel's SNR is averaged when choosing between channels.
+        :param num_workers: Threads running wake word detection.
+        :param recorder_factory: Builds the audio recorders, with the same arguments as PvRecorder.
+        """
+        self.device_indices = list(device_indices)
+        self._detectors = [detector_factory() for _ in self.device_indices]
+        self._on_event = on_event
+        self._max_active_channels = max_active_channels
+        self._voice_gate_db = voice_gate_db
+        self._recorder_factory = recorder_factory
+
+        detector = self._detectors[0]
+        self.sample_rate = detector.sample_rate
+        self.frame_length = detector.frame_length
+        ticks_per_second = self.sample_rate / self.frame_length
+        self._hold_ticks = int(hold_seconds * ticks_per_second)
+        self._merge_ticks = max(int(merge_seconds * ticks_per_second), 1)
+
+        num_channels = len(self.device_indices)
+        self._energy_history = np.zeros((num_channels, max(int(snr_seconds * ticks_per_second), 1)), dtype=np.float32)
+        self._noise_floor = NoiseFloor(np.full(num_channels, 30.0))
+        self._last_voiced = np.full(num_channels, -self._hold_ticks - 1)
+        self._tick = 0
+
+        self._frames = [queue.Queue(maxsize=16) for _ in self.device_indices]
+        #Channels which missed their last tick, they are only polled until audio arrives again
+        self._stalled = np.zeros(num_channels, dtype=bool)
+        self._pool = ThreadPoolExecutor(max_workers=num_workers)
+        self._stop = Event()
+        self._threads = []
+        #Calls from other threads, applied between ticks so detectors are only touched by the processing thread
+        self._requests = queue.Queue()
+
+        #Detections waiting for the merge window to close, as channel -> (keyword, SNR)
+        self._pending = {}
+        self._pending_deadline = None
+        self.active_channel = None
+        self.last_channel = 0
+
+        self._active_channels_metric = METRICS.histogram('multi_active_channels', buckets=tuple(range(num_channels + 1)))
+
+    @property
+    def active_detector(self):
+        """The detector of the channel currently (or most recently) in use."""
+        return self._detectors[self.active_channel if self.active_channel is not None else self.last_channel]
+
+    def start_listening(self, include_preroll = False):
+        """Begin an utterance on the most recently used channel without waiting for the wake word."""
+        def start():
+            self.active_channel = self.last_channel
+            self._detectors[self.active_channel].start_listening(include_preroll = include_preroll)
+        self._requests.put(start)
+
+    def cancel(self):
+        """Abandon the current utterance and go back to waiting for the wake word."""
+        def cancel():
+            if self.active_channel is not None:
+                self._detectors[self.active_channel].cancel()
+                self.active_channel = None
+        self._requests.put(cancel)
+
+    def start(self):
+        for channel, device_index in enumerate(self.device_indices):
+            thread = Thread(target=self._capture, args=(channel, device_index), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = Thread(target=self._process_loop, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout=1)
+        self._pool.shutdown(wait=False)
+        for detector in self._detectors:
+            detector.delete()
+
+    def _capture(self, channel, device_index):
+        recorder = self._recorder_factory(device_index=device_index, frame_length=self.frame_length)
+        recorder.start()
+        STARTUP.listening()
+        print(f'Listening on device {recorder.selected_device} as channel {channel}')
+        monitor = FrameLoopMonitor(self.sample_rate)
+        frames = self._frames[channel]
+        try:
+            while not self._stop.is_set():
+                pcm = recorder.read()
+                monitor.tick(len(pcm))
+                if frames.full():
+                    frames.get_nowait()
+                    METRICS.counter('multi_dropped_frames').inc()
+                frames.put(pcm)
+        finally:
+            recorder.delete()
+
+    def _collect_tick(self):
+        """
+        Gather the next frame of every channel. Returns the (num_channels,
+        frame_length) batch and a mask of the channels which delivered a frame.
+        Live channels share one deadline, so a stalled one never holds the
+        others up for more than a few frames, and stalled channels aren't
+        waited for at all.
+        """
+        deadline = time.monotonic() + 4 * self.frame_length / self.sample_rate
+        batch = np.zeros((len(self._frames), self.frame_length), dtype=np.int16)
+        present = np.zeros(len(self._frames), dtype=bool)
+        for channel, frames in enumerate(self._frames):
+            try:
+                if self._stalled[channel]:
+                    pcm = frames.get_nowait()
+                else:
+                    pcm = frames.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                if not self._stalled[channel]:
+                    print(f"[Multi Listener] Device {self.device_indices[channel]} stalled, leaving it out")
+                    METRICS.counter('multi_stalled_channels').inc()
+                self._stalled[channel] = True
+                continue
+            if self._stalled[channel]:
+                print(f"[Multi Listener] Device {self.device_indices[channel]} is back")
+            self._stalled[channel] = False
+            batch[channel] = pcm
+            present[channel] = True
+        return batch, present
+
+    def _select_channels(self, batch, present):
+        """Update per-channel noise floors and SNR, and pick the channels which should run wake detection."""
+        samples = batch.astype(np.float32)
+        #Missing channels get no level, so they leave their noise floor and history untouched
+        energy_db = np.where(present, 10 * np.log10(np.mean(samples * samples, axis=1) + 1e-6), -np.inf)
+        column = self._tick % self._energy_history.shape[1]
+        self._energy_history[present, column] = energy_db[present]
+
+        snr = energy_db - self._noise_floor.db
+        voiced = snr > self._voice_gate_db
+        self._noise_floor.update(energy_db, background = ~voiced)
+
+        self._last_voiced[voiced] = self._tick
+        recent_snr = self._energy_history.mean(axis=1) - self._noise_floor.db
+
+        candidates = np.flatnonzero((self._tick - self._last_voiced <= self._hold_ticks) & present)
+        if len(candidates) > self._max_active_channels:
+            candidates = candidates[np.argsort(-recent_snr[candidates])[:self._max_active_channels]]
+        detect = np.zeros(len(self._detectors), dtype=bool)
+        detect[candidates] = True
+        return detect, recent_snr
+
+    def _process_loop(self):
+        while not self._stop.is_set():
+            batch, present = self._collect_tick()
+            self._process_tick(batch, present)
+            if not present.any():
+                #Every microphone stalled, so nothing was waited for
+                self._stop.wait(self.frame_length / self.sample_rate)
+
+    def _process_tick(self, batch, present):
+        while not self._requests.empty():
+            self._requests.get_nowait()()
+        #An utterance can't wait for a microphone which stopped delivering, so it ends with what was heard
+        if self.active_channel is not None and not present[self.active_channel]:
+            channel, self.active_channel = self.active_channel, None
+            detector = self._detectors[channel]
+            utterance = detector.utterance()
+            detector.cancel()
+            self._on_event(self.device_indices[channel], WakeDetector.END, None, utterance)
+        if not present.any():
+            return
+
+        detect, recent_snr = self._select_channels(batch, present)
+        self._active_channels_metric.observe(int(np.count_nonzero(detect)))
+
+        #Porcupine runs in native code without the GIL, so channels are processed in parallel
+        channels = np.flatnonzero(present)
+        events = self._pool.map(
+            lambda channel: self._detectors[channel].process(batch[channel], detect = bool(detect[channel])), channels)
+        results = [[] for _ in self._detectors]
+        for channel, channel_events in zip(channels, events):
+            results[channel] = channel_events
+        self._handle_events(results, recent_snr)
+        self._tick += 1
+
+    def _handle_events(self, results, recent_snr):
+        for channel, events in enumerate(results):
+            for event, keyword, audio in events:
+                if event == WakeDetector.WAKE:
+                    if self.active_channel is None:
+                        self._pending[channel] = (keyword, float(recent_snr[channel]))
+                        if self._pending_deadline is None:
+                            self._pending_deadline = self._tick + self._merge_ticks
+                    else:
+                        #Someone is already being listened to on another channel
+                        self._detectors[channel].cancel()
+                elif channel == self.active_channel:
+                    if event == WakeDetector.END:
+                        self.active_channel = None
+                    self._on_event(self.device_indices[channel], event, keyword, audio)
+
+        #Once the merge window closes, keep the detection with the best SNR
+        if self._pending_deadline is not None and self._tick >= self._pending_deadline:
+            best = max(self._pending, key=lambda channel: self._pending[channel][1])
+            for channel in self._pending:
+                if channel != best:
+                    self._detectors[channel].cancel()
+            keyword, snr = self._pending[best]
+            print(f"[Multi Listener] Using device {self.device_indices[best]} (SNR {snr:.1f} dB)")
+
+            self._pending = {}
+            self._pending_deadline = None
+            self.active_channel = self.last_channel = best
+            detector = self._detectors[best]
+            if detector.listening:
+                self._on_event(self.device_indices[best], WakeDetector.WAKE, keyword, detector.utterance())
+            else:
+                #The utterance already ended inside the merge window
+                self.active_channel = None
+                self._on_event(self.device_indices[best], WakeDetector.WAKE, keyword, detector.utterance())
+                self._on_event(self.device_indices[best], WakeDetector.END, keyword, detector.utterance())
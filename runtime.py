@@ -0,0 +1,322 @@
+import copy
+import asyncio
+import functools
+from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import numpy as np
+
+from audio import WakeDetector
+from audio_writer import default_writer
+from multi_audio import MultiDeviceListener
+from speech import StreamingRecognizer
+from metrics import METRICS, FrameLoopMonitor
+from startup import STARTUP
+
+class CommandCancelled(Exception):
+    """Raised inside a command which was cancelled, e.g. because the user barged in with the wake word."""
+
+def put_dropping_oldest(queue, item):
+    """Put an item on a bounded asyncio queue, dropping the oldest item if it is full. Returns True if one was dropped."""
+    dropped = False
+    if queue.full():
+        queue.get_nowait()
+        dropped = True
+    queue.put_nowait(item)
+    return dropped
+
+class BotRuntime:
+    """
+    Event loop based runtime for WelcomeBot which keeps listening while the
+    bot answers. Audio capture, wake detection, recognition and command
+    dispatch run as separate tasks linked by bounded queues, and blocking
+    SDK/OpenCV work runs on a thread pool. Saying the wake word while the
+    bot is talking interrupts the response (barge-in). When the bot lists
+    several input devices, a MultiDeviceListener replaces capture and wake
+    detection and the runtime consumes its events instead.
+    """
+
+    def __init__(self, bot, frame_queue_size = 64, utterance_queue_size = 4, command_queue_size = 4, num_workers = 4,
+                 output_path = 'data/logs/speech_{timestamp}.wav'):
+        """
+        Constructor.
+        :param bot: The WelcomeBot to run.
+        :param frame_queue_size: Frames buffered between capture and wake detection before the oldest are dropped.
+        :param utterance_queue_size: Utterances buffered waiting for recognition.
+        :param command_queue_size: Recognized texts and proactive commands buffered waiting for dispatch.
+        :param num_workers: Threads available for blocking SDK, camera and disk calls.
+        :param output_path: If provided, each utterance is streamed to this file by the background AudioWriter.
+        """
+        self.bot = bot
+        self._frame_queue_size = frame_queue_size
+        self._utterance_queue_size = utterance_queue_size
+        self._command_queue_size = command_queue_size
+        self._num_workers = num_workers
+        self._output_path = output_path
+
+        self.dropped_frames = 0
+        self.dropped_utterances = 0
+
+        self._loop = None
+        self._executor = None
+        self._detector = None
+        self._listener = None
+        self._pending_listen = None
+        self._recognizer = None
+        self._voice_match = None
+        self._wake_audio = None
+        self._output_stream = None
+        self._busy = False
+        self._stop = Event()
+
+    async def run(self):
+        """Listen and answer until cancelled."""
+        self._loop = asyncio.get_running_loop()
+        self._executor = ThreadPoolExecutor(max_workers=self._num_workers)
+        self._frames = asyncio.Queue(maxsize=self._frame_queue_size)
+        self._utterances = asyncio.Queue(maxsize=self._utterance_queue_size)
+        self._commands = asyncio.Queue(maxsize=self._command_queue_size)
+        #Set while no wake utterance is being recorded, so a command's listen never takes over one
+        self._utterance_idle = asyncio.Event()
+        self._utterance_idle.set()
+
+        device_indices = self.bot._audio_input_device_indices
+        if device_indices is not None and len(device_indices) > 1:
+            self._listener = await self._loop.run_in_executor(self._executor, self._create_listener, device_indices)
+            self._detector = self._listener.active_detector
+        else:
+            self._detector = await self._loop.run_in_executor(self._executor, self.bot.wake_thread.create_detector)
+
+        #Follow up questions are answered from the shared audio stream instead of opening the microphone again
+        self.bot.listen = self.listen
+
+        tasks = [
+            asyncio.create_task(self._event_task() if self._listener is not None else self._wake_task()),
+            asyncio.create_task(self._recognition_task()),
+            asyncio.create_task(self._dispatch_task()),
+        ]
+        if self._listener is not None:
+            self._listener.start()
+        else:
+            capture_thread = Thread(target=self._capture, daemon=True)
+            capture_thread.start()
+
+        #The watcher always runs to keep the identity tracker fed, greeting arrivals is optional
+        watcher = self.bot.face_watcher
+        if self.bot._proactive_greeting:
+            watcher.on_arrival = lambda observation, frame: self._loop.call_soon_threadsafe(self._visitor_arrived)
+        watcher.start()
+
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            self._stop.set()
+            for task in tasks:
+                task.cancel()
+            watcher.stop()
+            if self._listener is not None:
+                self._listener.stop()
+            else:
+                capture_thread.join(timeout=1)
+                self._detector.delete()
+            self._executor.shutdown(wait=False)
+
+    def _create_listener(self, device_indices):
+        wake_thread = self.bot.wake_thread
+        #Each microphone gets its own endpointer, since their noise floors differ
+        return MultiDeviceListener(
+            device_indices,
+            detector_factory = lambda: wake_thread.create_detector(endpointer = copy.deepcopy(self.bot.endpointer)),
+            on_event = lambda device_index, *event: self._deliver_event(event),
+            recorder_factory = wake_thread.recorder_factory)
+
+    def _capture(self):
+        """Read the microphone on a dedicated thread and hand frames to the event loop."""
+        recorder = self.bot.wake_thread.recorder_factory(device_index=self.bot.wake_thread.input_device_index,
+                                                         frame_length=self._detector.frame_length)
+        recorder.start()
+        STARTUP.listening()
+        print(f'Listening continuously on device {recorder.selected_device}')
+        monitor = FrameLoopMonitor(self._detector.sample_rate)
+        try:
+            while not self._stop.is_set():
+                pcm = recorder.read()
+                monitor.tick(len(pcm))
+                self._loop.call_soon_threadsafe(self._put_frame, pcm)
+        finally:
+            recorder.delete()
+
+    def _put_frame(self, pcm):
+        #Drop the oldest frame rather than block capture when detection falls behind
+        if put_dropping_oldest(self._frames, pcm):
+            self.dropped_frames += 1
+            METRICS.counter('runtime_dropped_frames').inc()
+
+    def _deliver_event(self, event):
+        """
+        Hand a listener event to the event loop. Called on the listener's
+        thread, which waits for room in the queue rather than drop an event,
+        since a lost WAKE or END would leave an utterance half handled.
+        """
+        future = asyncio.run_coroutine_threadsafe(self._frames.put(event), self._loop)
+        while not self._stop.is_set():
+            try:
+                return future.result(timeout=0.5)
+            except FutureTimeoutError:
+                METRICS.counter('runtime_delayed_events').inc()
+        future.cancel()
+
+    async def _wake_task(self):
+        """Run wake detection and endpointing, streaming commands to the recognizer as they are spoken."""
+        while True:
+            pcm = await self._frames.get()
+            try:
+                events = self._detector.process(pcm)
+            except Exception as e:
+                print("[Runtime] Wake detection failed:", e)
+                METRICS.counter('runtime_event_errors').inc()
+                continue
+            self._handle_events(events)
+
+    async def _event_task(self):
+        """Handle the events of the multi-device listener, which runs detection on its own threads."""
+        while True:
+            event, keyword, audio = await self._frames.get()
+            if event == WakeDetector.WAKE:
+                #Follow ups are recorded from whichever microphone heard the wake word
+                self._detector = self._listener.active_detector
+            self._handle_events([(event, keyword, audio)])
+
+    def _handle_events(self, events):
+        """Handle each event on its own, so one which fails is only logged and the runtime keeps listening."""
+        for event, keyword, audio in events:
+            try:
+                self._handle_event(event, keyword, audio)
+            except Exception as e:
+                print(f"[Runtime] Handling {event} failed:", e)
+                METRICS.counter('runtime_event_errors').inc()
+
+    def _handle_event(self, event, keyword, audio):
+        if event == WakeDetector.WAKE:
+            self._utterance_idle.clear()
+            #Barge-in: stop the running command and any response still playing, never waiting for speech to load
+            if self._busy:
+                self.bot.cancel_command()
+            elif getattr(self.bot.speech_manager, 'ready', True):
+                self.bot.speech_manager.interrupt()
+            if self._pending_listen is not None:
+                future, self._pending_listen = self._pending_listen, None
+                if not future.done():
+                    future.set_exception(CommandCancelled())
+            #Travel with the utterance, so they never apply to another one. Copied out of the ring buffer, since
+            #capture keeps overwriting it
+            self._wake_audio = np.copy(audio)
+            #Identified on the thread pool, the guest store may be busy with an enrollment
+            self._voice_match = self._loop.run_in_executor(self._executor, self.bot.identify_voice, self._wake_audio)
+            if self.bot._streaming_recognition:
+                self._recognizer = StreamingRecognizer(self.bot._azure_speech_config)
+                self._recognizer.write(audio)
+            if self._output_path is not None:
+                self._output_stream = default_writer().open(self._output_path, sample_rate = self._detector.sample_rate)
+                self._output_stream.write(audio)
+
+        elif event == WakeDetector.AUDIO:
+            if self._recognizer is not None:
+                self._recognizer.write(audio)
+            if self._output_stream is not None:
+                self._output_stream.write(audio)
+
+        elif event == WakeDetector.END:
+            if self._output_stream is not None:
+                self._output_stream.close()
+                self._output_stream = None
+            #Copy out of the ring buffer, since capture keeps overwriting it
+            utterance = np.copy(audio)
+            if self._pending_listen is not None:
+                future, self._pending_listen = self._pending_listen, None
+                if not future.done():
+                    future.set_result(utterance)
+            else:
+                self._utterance_idle.set()
+                if put_dropping_oldest(self._utterances, (keyword, self._recognizer, utterance, self._voice_match,
+                                                         self._wake_audio)):
+                    self.dropped_utterances += 1
+                self._recognizer = None
+                self._voice_match = None
+                self._wake_audio = None
+
+    async def _recognition_task(self):
+        """Collect recognition results, most of which were computed while the user spoke."""
+        while True:
+            keyword, recognizer, utterance, voice_match, wake_audio = await self._utterances.get()
+            try:
+                if recognizer is not None:
+                    text = await self._loop.run_in_executor(self._executor, recognizer.finish)
+                else:
+                    text = await self._loop.run_in_executor(
+                        self._executor, self.bot.azure_speech_recognition, utterance)
+            except Exception as e:
+                print("[Runtime] Recognition failed:", e)
+                METRICS.counter('runtime_recognition_errors').inc()
+                continue
+            try:
+                voice_match = await voice_match if voice_match is not None else None
+            except Exception as e:
+                print("[Voice ID] Could not identify the speaker:", e)
+                voice_match = None
+
+            parse_text = functools.partial(self.bot.parse_text, voice_match = voice_match, wake_audio = wake_audio)
+            await self._commands.put((parse_text, text))
+
+    async def _dispatch_task(self):
+        """Execute commands one at a time on the thread pool."""
+        while True:
+            function, argument = await self._commands.get()
+            self._busy = True
+            try:
+                #A cancelled command stops at its next step, the thread running it can't be stopped from outside
+                await self._loop.run_in_executor(self._executor, function, argument)
+            except CommandCancelled:
+                print("[Runtime] Command cancelled")
+            except Exception as e:
+                print("Command failed:", e)
+            finally:
+                self._busy = False
+            self._loop.run_in_executor(self._executor, self.bot.export_metrics)
+
+    def _visitor_arrived(self):
+        #Only greet proactively when nobody is talking to the bot already
+        if self._busy or not self._commands.empty() or self._detector.listening:
+            return
+        print("[Runtime] Visitor arrived, trying to recognize them")
+        put_dropping_oldest(self._commands, (self.bot.run_command, 'recognizeMe'))
+
+    def listen(self, seconds):
+        """
+        Record the user's next answer from the shared audio stream. Called
+        from command handlers running on the thread pool.
+        """
+        return asyncio.run_coroutine_threadsafe(self._listen(seconds), self._loop).result()
+
+    async def _listen(self, seconds):
+        #Someone said the wake word before the question was asked, their utterance is a command of its own
+        await self._utterance_idle.wait()
+        self.bot.check_cancelled()
+
+        future = self._loop.create_future()
+        self._pending_listen = future
+        if self._listener is not None:
+            self._listener.start_listening(include_preroll = False)
+            self._detector = self._listener.active_detector
+        else:
+            self._detector.start_listening(include_preroll = False)
+        try:
+            return await asyncio.wait_for(future, timeout=seconds)
+        except asyncio.TimeoutError:
+            #Give back whatever was said so far
+            self._pending_listen = None
+            if self._listener is not None:
+                self._listener.cancel()
+            else:
+                self._detector.cancel()
+            return np.copy(self._detector.ring_buffer.latest(seconds))
@@ -0,0 +1,501 @@
+"""
+Runs audio and camera capture in their own small processes, writing into
+shared memory ring buffers which the bot reads without copying. The capture
+processes only import what they need to record, so the recorder is never
+starved by the speech SDK, OpenCV or the face models in the bot's process.
+
+Each ring has one writer. A slot's sequence stamp is cleared while it is
+written and set once it is complete, then the ring's write sequence is
+published; readers check the stamp before and after reading a slot, so no
+locks are shared between processes. A CaptureSupervisor restarts a capture
+process which dies or stops writing, and readers carry on from the same ring.
+
+Capture processes run this module as a script rather than being spawned by
+multiprocessing, which would import the bot's main script again in each of
+them, and with it everything the bot imports.
+"""
+import os
+import sys
+import time
+import pickle
+import signal
+import subprocess
+from multiprocessing import shared_memory, resource_tracker
+from threading import Thread, Lock
+
+import numpy as np
+
+from metrics import METRICS, span
+
+#Header fields of a ring, each an int64
+_WRITE_SEQ, _HEARTBEAT, _CONNECTED, _RESTARTS, _STOP = range(5)
+_HEADER_SIZE = 5
+
+class SharedRing:
+    """
+    Fixed-size slots in shared memory, written by one process and read by
+    any number. Slot `seq % num_slots` holds the item numbered `seq`, and
+    the write sequence is the number of the newest complete item (0 while
+    empty). Passing a ring to another process attaches it to the same memory.
+    """
+
+    def __init__(self, slot_shape, dtype, num_slots, name = None):
+        """
+        Constructor.
+        :param slot_shape: Shape of one item, e.g. (frame_length,) for audio.
+        :param dtype: Numpy dtype of the items.
+        :param num_slots: Number of items kept before the oldest is overwritten.
+        :param name: Name of an existing ring to attach to. A new ring is created if not given.
+        """
+        self.slot_shape = tuple(slot_shape)
+        self.dtype = np.dtype(dtype)
+        self.num_slots = num_slots
+        self._owner = name is None
+
+        slot_bytes = int(np.prod(self.slot_shape)) * self.dtype.itemsize
+        #Slots are 64 byte aligned after the header, stamps and timestamps
+        meta_bytes = (_HEADER_SIZE + 2 * num_slots) * 8
+        data_offset = (meta_bytes + 63) // 64 * 64
+        size = data_offset + num_slots * slot_bytes
+
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            #The owner's resource tracker unlinks the memory if the bot dies
+            self._shm = shared_memory.SharedMemory(name=name)
+        self.name = self._shm.name
+
+        buffer = self._shm.buf
+        self._header = np.ndarray((_HEADER_SIZE,), dtype=np.int64, buffer=buffer)
+        self._stamps = np.ndarray((num_slots,), dtype=np.int64, buffer=buffer, offset=_HEADER_SIZE * 8)
+        self._times = np.ndarray((num_slots,), dtype=np.int64, buffer=buffer, offset=(_HEADER_SIZE + num_slots) * 8)
+        self._slots = np.ndarray((num_slots,) + self.slot_shape, dtype=self.dtype, buffer=buffer, offset=data_offset)
+        if self._owner:
+            self._header[:] = 0
+            self._stamps[:] = 0
+
+    def __getstate__(self):
+        return {'slot_shape': self.slot_shape, 'dtype': self.dtype.str, 'num_slots': self.num_slots, 'name': self.name}
+
+    def __setstate__(self, state):
+        self.__init__(state['slot_shape'], state['dtype'], state['num_slots'], name = state['name'])
+
+    @property
+    def write_seq(self):
+        return int(self._header[_WRITE_SEQ])
+
+    @property
+    def heartbeat(self):
+        """time.monotonic() of the writer's last sign of life, in seconds."""
+        return self._header[_HEARTBEAT] / 1e9
+
+    @property
+    def connected(self):
+        return bool(self._header[_CONNECTED])
+
+    @property
+    def restarts(self):
+        return int(self._header[_RESTARTS])
+
+    @property
+    def stopping(self):
+        """Whether the writer was asked to stop."""
+        return bool(self._header[_STOP])
+
+    def request_stop(self):
+        self._header[_STOP] = 1
+
+    def beat(self, connected = True):
+        """Record that the writer is alive, also while it has nothing to write."""
+        self._header[_CONNECTED] = int(connected)
+        self._header[_HEARTBEAT] = time.monotonic_ns()
+
+    def write(self, item):
+        """Write the next item, overwriting the oldest. Only one process may write."""
+        seq = int(self._header[_WRITE_SEQ]) + 1
+        slot = seq % self.num_slots
+        self._stamps[slot] = 0
+        self._slots[slot] = item
+        now = time.monotonic_ns()
+        self._times[slot] = now
+        self._stamps[slot] = seq
+        self._header[_WRITE_SEQ] = seq
+        self._header[_HEARTBEAT] = now
+
+    def view(self, seq):
+        """
+        Read-only view of item `seq` in shared memory, or None if it was
+        already overwritten. The view is only valid until the ring wraps
+        around to its slot, see `valid`.
+        """
+        slot = seq % self.num_slots
+        if seq <= 0 or self._stamps[slot] != seq:
+            return None
+        view = self._slots[slot]
+        view.flags.writeable = False
+        return view
+
+    def valid(self, seq):
+        """Whether item `seq` is still in its slot, e.g. after reading a view of it."""
+        return seq > 0 and self._stamps[seq % self.num_slots] == seq
+
+    def read(self, seq):
+        """Copy of item `seq`, or None if it was overwritten before or while it was read."""
+        view = self.view(seq)
+        if view is None:
+            return None
+        item = np.array(view)
+        return item if self.valid(seq) else None
+
+    def age(self, seq):
+        """Seconds since item `seq` was written."""
+        return (time.monotonic_ns() - self._times[seq % self.num_slots]) / 1e9
+
+    def close(self):
+        #Views into the buffer have to go before it can be closed
+        self._header = self._stamps = self._times = self._slots = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+def _audio_capture(ring, running, device_index, frame_length, recorder_options):
+    """Record frames into the ring until stopped."""
+    from pvrecorder import PvRecorder
+
+    recorder = PvRecorder(device_index=device_index, frame_length=frame_length, **recorder_options)
+    recorder.start()
+    ring.beat()
+    try:
+        while running():
+            ring.write(recorder.read())
+    finally:
+        recorder.delete()
+
+def _camera_capture(ring, running, device_id, fps, reconnect_seconds):
+    """Grab frames into the ring until stopped."""
+    import cv2
+
+    height, width = ring.slot_shape[:2]
+    cap = None
+    while running():
+        if cap is None or not cap.isOpened():
+            cap = cv2.VideoCapture(device_id)
+            cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+            cap.set(cv2.CAP_PROP_FPS, fps)
+            cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+            if not cap.isOpened():
+                print(f"[Capture] Could not open camera {device_id}, retrying...")
+                ring.beat(connected = False)
+                time.sleep(reconnect_seconds)
+                continue
+
+        ret, frame = cap.read()
+        if not ret or frame is None:
+            print("[Capture] Lost camera, reconnecting...")
+            cap.release()
+            cap = None
+            ring.beat(connected = False)
+            time.sleep(reconnect_seconds)
+            continue
+
+        #Slots have the requested size, which the device may not honor
+        if frame.shape != ring.slot_shape:
+            frame = cv2.resize(frame, (width, height))
+        ring.write(frame)
+        ring.beat()
+
+    if cap is not None:
+        cap.release()
+
+_CAPTURE_TARGETS = {'audio': _audio_capture, 'camera': _camera_capture}
+
+def _capture_main():
+    """Entry point of a capture process, which reads its target, ring and arguments from stdin."""
+    #Ctrl+C is for the bot, which stops capture itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    target, ring, args = pickle.load(sys.stdin.buffer)
+    if os.name == 'posix':
+        #The bot owns the ring, this process's resource tracker must not unlink it on exit
+        resource_tracker.unregister(ring._shm._name, 'shared_memory')
+    parent_pid = os.getppid()
+    #Also stop once the bot is gone, e.g. after it was killed
+    running = lambda: not ring.stopping and os.getppid() == parent_pid
+    _CAPTURE_TARGETS[target](ring, running, *args)
+
+class _CaptureProcess:
+    """One supervised capture process and the ring it writes."""
+
+    def __init__(self, name, target, ring, args):
+        """
+        Constructor.
+        :param name: Name of the capture, for display.
+        :param target: Key of the capture function in _CAPTURE_TARGETS.
+        :param ring: SharedRing the process writes.
+        :param args: Arguments of the capture function after the ring.
+        """
+        self.name = name
+        self.ring = ring
+        self._target = target
+        self._args = args
+        self.process = None
+
+    def start(self):
+        #The heartbeat restarts with the process, so a slow start isn't taken for a stall
+        self.ring.beat(connected = self.ring.connected)
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__)], stdin=subprocess.PIPE)
+        pickle.dump((self._target, self.ring, self._args), self.process.stdin)
+        self.process.stdin.close()
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    @property
+    def exitcode(self):
+        return self.process.poll() if self.process is not None else None
+
+    def terminate(self):
+        if self.alive:
+            self.process.terminate()
+
+    def stop(self, timeout = 2.0):
+        if self.process is None:
+            return
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+class CaptureSupervisor:
+    """
+    Starts the capture processes, one per microphone and camera, and
+    restarts any which exits or stops writing for `stall_seconds`. Use
+    `recorder_factory` wherever a PvRecorder is created, and `camera` in
+    place of a CameraService.
+    """
+
+    def __init__(self, audio_seconds = 4.0, camera_slots = 16, stall_seconds = 5.0, restart_seconds = 1.0,
+                 check_interval = 0.5, recorder_options = None):
+        """
+        Constructor.
+        :param audio_seconds: Seconds of audio each ring holds, how far a reader may fall behind before losing audio.
+        :param camera_slots: Number of most recent camera frames kept.
+        :param stall_seconds: A capture process which hasn't written for this long is restarted.
+        :param restart_seconds: Delay before restarting a capture process, so a missing device isn't retried in a tight loop.
+        :param check_interval: Seconds between checks of the capture processes.
+        :param recorder_options: Extra PvRecorder arguments used by the audio capture processes.
+        """
+        self._audio_seconds = audio_seconds
+        self._camera_slots = camera_slots
+        self._stall_seconds = stall_seconds
+        self._restart_seconds = restart_seconds
+        self._check_interval = check_interval
+        self._recorder_options = recorder_options or {}
+
+        self._captures = {}
+        self._lock = Lock()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """Start supervising. Capture processes start when their recorder or camera is first asked for."""
+        if not self._running:
+            self._running = True
+            self._thread = Thread(target=self._supervise, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop every capture process and free the rings. Readers must not be used afterwards."""
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+        with self._lock:
+            captures, self._captures = list(self._captures.values()), {}
+        for capture in captures:
+            capture.ring.request_stop()
+        for capture in captures:
+            capture.stop()
+            capture.ring.close()
+
+    def _capture(self, key, create):
+        with self._lock:
+            capture = self._captures.get(key)
+            if capture is None:
+                capture = self._captures[key] = create()
+                capture.start()
+            return capture
+
+    def recorder_factory(self, device_index = -1, frame_length = 512, **options):
+        """
+        Return a SharedRecorder for a microphone, with the same arguments as
+        PvRecorder. Buffering `options` are ignored, the capture process does
+        its own; see `recorder_options`.
+        """
+        def create():
+            num_slots = max(int(self._audio_seconds * SharedRecorder.sample_rate / frame_length), 2)
+            ring = SharedRing((frame_length,), np.int16, num_slots)
+            return _CaptureProcess(f'audio-{device_index}', 'audio', ring,
+                                   (device_index, frame_length, self._recorder_options))
+        capture = self._capture(('audio', device_index, frame_length), create)
+        return SharedRecorder(capture.ring, device_index)
+
+    def camera(self, device_id = None, width = 1280, height = 720, fps = 30, reconnect_seconds = 1.0):
+        """Return a SharedCamera for a camera, with the same arguments as CameraService."""
+        device_id = device_id if device_id is not None else 0
+        def create():
+            ring = SharedRing((height, width, 3), np.uint8, self._camera_slots)
+            return _CaptureProcess(f'camera-{device_id}', 'camera', ring, (device_id, fps, reconnect_seconds))
+        return SharedCamera(self._capture(('camera', device_id), create).ring)
+
+    def _supervise(self):
+        while self._running:
+            time.sleep(self._check_interval)
+            with self._lock:
+                captures = list(self._captures.values())
+            for capture in captures:
+                if not self._running:
+                    break
+                alive = capture.alive
+                stalled = time.monotonic() - capture.ring.heartbeat > self._stall_seconds
+                if alive and not stalled:
+                    continue
+
+                reason = 'stalled' if alive else f'exited with code {capture.exitcode}'
+                print(f"[Capture] {capture.name} {reason}, restarting...")
+                METRICS.counter('capture_restarts').inc()
+                capture.terminate()
+                capture.stop()
+                time.sleep(self._restart_seconds)
+                capture.ring._header[_RESTARTS] += 1
+                capture.start()
+
+class SharedRecorder:
+    """
+    Reads a microphone's frames from a SharedRing, with the methods of
+    PvRecorder that the bot uses. Each recorder reads independently from
+    where it was started, so several can share one microphone.
+    """
+
+    sample_rate = 16_000
+
+    def __init__(self, ring, device_index = -1, poll_fraction = 0.25):
+        """
+        Constructor.
+        :param ring: SharedRing written by an audio capture process.
+        :param device_index: Device the ring records, for display.
+        :param poll_fraction: Fraction of a frame's duration to wait between checks for a new frame.
+        """
+        self._ring = ring
+        self.frame_length = ring.slot_shape[0]
+        self.selected_device = f'{device_index} (shared capture)'
+        self._poll_seconds = poll_fraction * self.frame_length / self.sample_rate
+        self._next_seq = None
+        self.overruns = 0
+
+    def start(self):
+        """Start reading from the newest frame."""
+        self._next_seq = self._ring.write_seq + 1
+
+    def stop(self):
+        self._next_seq = None
+
+    def delete(self):
+        self.stop()
+
+    @property
+    def is_recording(self):
+        return self._next_seq is not None
+
+    def read(self):
+        """Return the next frame, waiting for it if needed. Frames the reader fell too far behind on are skipped."""
+        if self._next_seq is None:
+            raise Exception("Recorder is not started.")
+        while True:
+            write_seq = self._ring.write_seq
+            if write_seq < self._next_seq:
+                time.sleep(self._poll_seconds)
+                continue
+
+            #Keep a slot of slack, the writer may be filling the oldest one
+            oldest = write_seq - self._ring.num_slots + 2
+            if self._next_seq < oldest:
+                self._skip(oldest)
+            pcm = self._ring.read(self._next_seq)
+            if pcm is None:
+                self._skip(self._ring.write_seq)
+                continue
+            self._next_seq += 1
+            return pcm
+
+    def _skip(self, seq):
+        self.overruns += seq - self._next_seq
+        METRICS.counter('capture_audio_overruns').inc(seq - self._next_seq)
+        self._next_seq = seq
+
+class SharedCamera:
+    """
+    Reads a camera's frames from a SharedRing, with the methods of
+    CameraService. `latest` returns views into shared memory, which are only
+    valid for about `camera_slots / fps` seconds; copy a frame to keep it.
+    """
+
+    def __init__(self, ring):
+        self._ring = ring
+
+    def start(self):
+        return self
+
+    def stop(self):
+        pass
+
+    @property
+    def connected(self):
+        return self._ring.connected
+
+    @property
+    def reconnects(self):
+        return self._ring.restarts
+
+    def _latest_seqs(self, max_age):
+        write_seq = self._ring.write_seq
+        seqs = range(max(write_seq - self._ring.num_slots + 2, 1), write_seq + 1)
+        return [seq for seq in seqs if self._ring.valid(seq) and self._ring.age(seq) <= max_age]
+
+    def latest(self, max_age = 0.5):
+        """Return views of the recent frames which are at most `max_age` seconds old, oldest first."""
+        views = [self._ring.view(seq) for seq in self._latest_seqs(max_age)]
+        return [view for view in views if view is not None]
+
+    def capture(self, max_age = 0.5, timeout = 3.0):
+        """Return a copy of the sharpest, best exposed of the most recent frames."""
+        with span('camera_capture'):
+            return self._capture(max_age, timeout)
+
+    def _capture(self, max_age, timeout):
+        #Imported here, so capture processes unpickling this module don't load the bot's vision stack
+        from visual import score_frames
+
+        #Only a recent frame will do, an old one may show whoever stood there before the camera dropped out
+        deadline = time.monotonic() + timeout
+        while True:
+            views = [(seq, self._ring.view(seq)) for seq in self._latest_seqs(max_age)]
+            views = [(seq, view) for seq, view in views if view is not None]
+            if len(views) > 0:
+                seq, view = views[int(np.argmax(score_frames([view for seq, view in views])))]
+                #None if the chosen frame was overwritten meanwhile, then the newer frames are scored
+                frame = self._ring.read(seq)
+                if frame is not None:
+                    return frame
+            if time.monotonic() > deadline:
+                raise Exception("Could not capture photo.")
+            time.sleep(0.01)
+
+if __name__ == '__main__':
+    _capture_main()
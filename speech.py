@@ -1,67 +1,384 @@
 import os
 import json
-# import azure.cognitiveservices.speech as speechsdk
+import mmap
+import hashlib
+import time
+import string
+from collections import OrderedDict
+from threading import Event, Thread, RLock
 
-from azure.cognitiveservices.speech import SpeechSynthesizer
+from metrics import METRICS, span
+from startup import lazy_import
+
+import numpy as np
+#Imported on first use, so the Azure SDK doesn't delay wake listening
+pyaudio = lazy_import('pyaudio')
+speechsdk = lazy_import('azure.cognitiveservices.speech')
+
+TTS_SAMPLE_RATE = 16_000
+TTS_OUTPUT_FORMAT = 'Raw16Khz16BitMonoPcm' #Name in speechsdk.SpeechSynthesisOutputFormat
+STT_SAMPLE_RATE = 16_000
+PLAYBACK_CHUNK_SECONDS = 0.1
+SPLICE_CROSSFADE_SECONDS = 0.02
+SPLICE_SILENCE_SECONDS = 0.06 #Silence kept at each side of a joint, so a comma still sounds like a pause
+
+def template_segments(template):
+    """
+    Split a response template such as "Welcome back, {name}!" into its
+    fixed texts and replacement fields, as (is_field, text) pairs. A field's
+    text is the whole field, e.g. "{guest.name}", so formatting it with the
+    template's values gives the field's text. Fixed parts which are only
+    punctuation or spaces are dropped, since they synthesize to silence.
+    """
+    segments = []
+    for literal, field, format_spec, conversion in string.Formatter().parse(template):
+        if any(character.isalnum() for character in literal):
+            segments.append((False, literal.strip()))
+        if field is not None:
+            field = field + ('!' + conversion if conversion else '') + (':' + format_spec if format_spec else '')
+            segments.append((True, '{' + field + '}'))
+    return segments
+
+def splice_pcm(segments, sample_rate = TTS_SAMPLE_RATE, crossfade_seconds = SPLICE_CROSSFADE_SECONDS,
+               silence_seconds = SPLICE_SILENCE_SECONDS, silence_threshold = 300):
+    """
+    Join 16 bit mono PCM segments into one buffer. Each segment's leading and
+    trailing silence is trimmed down to `silence_seconds`, and neighbouring
+    segments overlap by an equal-power crossfade, so the joints don't click.
+    """
+    keep = int(silence_seconds * sample_rate)
+    trimmed = []
+    for segment in segments:
+        audio = np.frombuffer(segment, dtype=np.int16)
+        loud = np.flatnonzero(np.abs(audio) >= silence_threshold)
+        if len(loud) > 0:
+            audio = audio[max(loud[0] - keep, 0):loud[-1] + keep + 1]
+        trimmed.append(audio.astype(np.float32))
+
+    fade = int(crossfade_seconds * sample_rate)
+    output = np.zeros(sum(len(audio) for audio in trimmed), dtype=np.float32)
+    position = 0
+    for audio in trimmed:
+        overlap = min(fade, len(audio), position)
+        if overlap > 0:
+            #Fade the previous segment's tail out while this one fades in
+            ramp = np.linspace(0, np.pi / 2, overlap, dtype=np.float32)
+            joint = output[position - overlap:position]
+            joint[:] = joint * np.cos(ramp) + audio[:overlap] * np.sin(ramp)
+        output[position:position + len(audio) - overlap] = audio[overlap:]
+        position += len(audio) - overlap
+    return np.clip(output[:position], -32768, 32767).astype(np.int16).tobytes()
+
+def atomic_write_json(obj, file_name):
+    """Write JSON to a temporary file and swap it in, so readers never see a partial file."""
+    tmp_file_name = file_name + '.tmp'
+    with open(tmp_file_name, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file_name, file_name)
+
+def recognition_text(result):
+    """Return the text of an Azure recognition result, or None if nothing was recognized."""
+    if result.reason == speechsdk.ResultReason.RecognizedSpeech:
+        print("Recognized: {}".format(result.text))
+        return result.text
+    elif result.reason == speechsdk.ResultReason.NoMatch:
+        print("No speech could be recognized")
+    elif result.reason == speechsdk.ResultReason.Canceled:
+        cancellation_details = result.cancellation_details
+        print("Speech Recognition canceled: {}".format(cancellation_details.reason))
+        if cancellation_details.reason == speechsdk.CancellationReason.Error:
+            print("Error details: {}".format(cancellation_details.error_details))
+    return None
+
+class StreamingRecognizer:
+    """
+    Recognizes speech while it is still being captured. Recognition starts
+    as soon as the recognizer is created, and audio is pushed to Azure as it
+    arrives, so upload and decoding overlap with the user speaking.
+    """
+
+    def __init__(self, azure_speech_config, on_partial = None, sample_rate = STT_SAMPLE_RATE):
+        """
+        Constructor.
+        :param azure_speech_config: Azure SpeechConfig used for recognition.
+        :param on_partial: Optional callback receiving the partial text recognized so far.
+        :param sample_rate: Sample rate of the 16 bit mono audio which will be written.
+        """
+        audio_format = speechsdk.audio.AudioStreamFormat(sample_rate, 16, 1)
+        self._push_stream = speechsdk.audio.PushAudioInputStream(stream_format=audio_format)
+        audio_config = speechsdk.audio.AudioConfig(stream=self._push_stream)
+
+        self._recognizer = speechsdk.SpeechRecognizer(speech_config=azure_speech_config, audio_config=audio_config)
+        if on_partial is not None:
+            self._recognizer.recognizing.connect(lambda evt: on_partial(evt.result.text))
+
+        self._result_future = self._recognizer.recognize_once_async()
+        self._closed = False
+
+    def write(self, audio):
+        """Push int16 audio samples to the recognizer."""
+        if not self._closed:
+            self._push_stream.write(np.asarray(audio, dtype=np.int16).tobytes())
+
+    def finish(self):
+        """Signal the end of the audio and return the final recognized text, or None."""
+        if not self._closed:
+            self._closed = True
+            self._push_stream.close()
+        #Only the time left after the end of speech is on the response path
+        with span('stt'):
+            return recognition_text(self._result_future.get())
+
+def recognize_audio(azure_speech_config, audio, sample_rate = STT_SAMPLE_RATE):
+    """Recognize speech in an already captured int16 recording."""
+    print("Writing Audio to Stream: ", len(audio), "samples")
+    recognizer = StreamingRecognizer(azure_speech_config, sample_rate = sample_rate)
+    recognizer.write(audio)
+
+    print("Sending voice data to Azure...")
+    return recognizer.finish()
+
+class TTSCache:
+    """
+    Bounded, content-addressed cache of synthesized speech. Audio is stored
+    as raw PCM files named by a hash of text + voice + format, evicted in
+    least recently used order, and served from memory-mapped files.
+    """
+
+    def __init__(self, cache_dir = 'data/tts_cache', max_entries = 500, max_bytes = 200 * 1024 * 1024):
+        self._cache_dir = cache_dir
+        self._index_file_name = os.path.join(cache_dir, 'index.json')
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+        #Entries are kept in least to most recently used order
+        self._entries = OrderedDict()
+        if os.path.exists(self._index_file_name):
+            with open(self._index_file_name, 'r', encoding='utf-8') as f:
+                self._entries.update(json.load(f))
+        #Drop entries whose audio file has gone missing
+        for key in [key for key, entry in self._entries.items() if not os.path.exists(self._file_name(key))]:
+            del self._entries[key]
+        #And audio files left behind by an eviction which couldn't delete them, e.g. while still mapped on Windows
+        for file_name in os.listdir(cache_dir):
+            if file_name.endswith('.pcm') and file_name[:-len('.pcm')] not in self._entries:
+                self._remove_file(os.path.join(cache_dir, file_name))
+
+        self._maps = {}
+        self._dirty = False
+        #Segments for spliced responses are cached from background threads
+        self._lock = RLock()
+
+    @staticmethod
+    def key(text, voice, output_format):
+        return hashlib.sha256('\0'.join([text, str(voice), str(output_format)]).encode('utf-8')).hexdigest()
+
+    def _file_name(self, key):
+        return os.path.join(self._cache_dir, key + '.pcm')
+
+    @property
+    def total_bytes(self):
+        return sum(entry['size'] for entry in self._entries.values())
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """Return a read-only memoryview of the cached PCM audio, or None on a miss."""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            self._entries[key]['last_used'] = time.time()
+            self._dirty = True
+
+            if key not in self._maps:
+                with open(self._file_name(key), 'rb') as f:
+                    self._maps[key] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return memoryview(self._maps[key])
+
+    def put(self, key, audio, **metadata):
+        """Store PCM audio under a key, evicting old entries to stay within limits."""
+        if len(audio) == 0:
+            return
+        file_name = self._file_name(key)
+        with self._lock:
+            with open(file_name + '.tmp', 'wb') as f:
+                f.write(audio)
+            os.replace(file_name + '.tmp', file_name)
+
+            self._entries[key] = dict(metadata, size=len(audio), last_used=time.time())
+            self._entries.move_to_end(key)
+            self._evict()
+            self.flush(force=True)
+
+    def _evict(self):
+        total_bytes = self.total_bytes
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or total_bytes > self.max_bytes):
+            key, entry = self._entries.popitem(last=False)
+            total_bytes -= entry['size']
+            #Views returned by get() may still be playing, so the map is closed by the last of them going away
+            self._maps.pop(key, None)
+            self._remove_file(self._file_name(key))
+
+    @staticmethod
+    def _remove_file(file_name):
+        try:
+            os.remove(file_name)
+        except OSError as e:
+            print("[Speech Cache] Could not remove", file_name, e)
+
+    def flush(self, force = False):
+        """Persist the index if it changed."""
+        with self._lock:
+            if self._dirty or force:
+                atomic_write_json(self._entries, self._index_file_name)
+                self._dirty = False
 
 class SpeechManager:
     """Controls spoken response behavior and speaker threads."""
 
-    def __init__(self, speech_log_file_name = 'data/speech_log.json',
-                 output_device_index = 0, speaker = True):
-
+    def __init__(self, azure_speech_config, cache = None, output_device_index = None, speaker = True):
+        """
+        Constructor.
+        :param azure_speech_config: Azure SpeechConfig used for synthesis.
+        :param cache: TTSCache for synthesized audio. Defaults to one in data/tts_cache.
+        :param output_device_index: PyAudio output device. Defaults to the system's default speaker.
+        :param speaker: If False, responses are only printed.
+        """
+        self._azure_speech_config = azure_speech_config
         self._output_device_index = output_device_index
         self._speaker = speaker
-        self._speech_log_file_name = speech_log_file_name
-
-        if not os.path.exists(speech_log_file_name):
-            with open(speech_log_file_name, 'w') as f:
-                json.dump({}, f)
-        
-        with open(speech_log_file_name, 'r') as f:
-            self.speech_log = json.load(f)
-            print('[Speech Log]', self.speech_log)
-    
+
+        #Raw PCM can be cached and played back without parsing a container
+        self._output_format = getattr(speechsdk.SpeechSynthesisOutputFormat, TTS_OUTPUT_FORMAT)
+        self._azure_speech_config.set_speech_synthesis_output_format(self._output_format)
+        self._voice = self._azure_speech_config.speech_synthesis_voice_name
+
+        self.cache = cache if cache is not None else TTSCache()
+        self._pyaudio = None
+        self._interrupted = Event()
+
+    def _cache_key(self, text):
+        return TTSCache.key(text, self._voice, self._output_format)
+
+    def prewarm(self, texts):
+        """Synthesize and cache any of the given texts which aren't cached yet."""
+        for text in texts:
+            key = self._cache_key(text)
+            if key not in self.cache:
+                audio = self.azure_speech_synthesis(text)
+                if audio is not None:
+                    self.cache.put(key, audio, text=text, voice=self._voice)
+        self.cache.flush()
+        print(f"[Speech Cache] {len(texts)} responses ready")
+
+    def prewarm_templates(self, templates):
+        """Synthesize and cache the fixed parts of response templates, e.g. "Welcome back," of "Welcome back, {name}!"."""
+        self.prewarm([text for template in templates for is_field, text in template_segments(template) if not is_field])
+
+    def prewarm_in_background(self, texts):
+        """Synthesize and cache texts on a background thread, e.g. a new guest's name for spliced greetings."""
+        Thread(target=self.prewarm, args=(list(texts),), daemon=True).start()
+
+    def speak_template(self, template, **values):
+        """
+        Speak a filled in response template. When every fixed part and value
+        has been synthesized before, the cached segments are spliced locally
+        and no network call is made. Otherwise the whole sentence is
+        synthesized, and the missing segments are cached for next time.
+        """
+        #An interruption applies to the response it arrived during, including while it is being synthesized
+        self._interrupted.clear()
+        text = template.format(**values)
+        if not self._speaker:
+            return self._speak(text)
+
+        #Fields are formatted like the whole template, so attribute and index fields such as {guest.name} work too
+        texts = [text.format(**values) if is_field else text for is_field, text in template_segments(template)]
+        texts = [segment_text for segment_text in texts if segment_text.strip()]
+        #Copied out of the cache, so neither eviction nor another response can change them while they are spliced
+        segments = [self.cache.get(self._cache_key(segment_text)) for segment_text in texts]
+        segments = [bytes(segment) if segment is not None else None for segment in segments]
+        if any(segment is None for segment in segments):
+            METRICS.counter('tts_splice_misses').inc()
+            self.prewarm_in_background([segment_text for segment_text, segment in zip(texts, segments)
+                                        if segment is None])
+            return self._speak(text)
+
+        print("[Response]", text)
+        METRICS.counter('tts_splice_hits').inc()
+        with span('tts_splice'):
+            audio = splice_pcm(segments)
+        with span('tts_playback'):
+            self.play_audio(audio)
+
     def speak(self, text):
+        """Speak a response, synthesizing it unless it is cached. Stops early if interrupted."""
+        self._interrupted.clear()
+        self._speak(text)
+
+    def _speak(self, text):
         print("[Response]", text)
 
         #If we are outputting sound to the speaker
         if self._speaker:
-            #If this text has already been received from Azure before
-            if text in self.speech_log:
-                self.play_audio_from_file(self.speech_log[text])
-            else:
-                #Synthesize audio
-                #Play to speaker
-                # 
-                #Write to file
-                #Record in guest log
-                #Overwrite guest log
+            key = self._cache_key(text)
+            audio = self.cache.get(key)
+
+            #If this text hasn't been received from Azure before, synthesize and cache it
+            METRICS.counter('tts_cache_hits' if audio is not None else 'tts_cache_misses').inc()
+            if audio is None:
+                with span('tts_synthesis'):
+                    audio = self.azure_speech_synthesis(text)
+                if audio is None:
+                    return
+                self.cache.put(key, audio, text=text, voice=self._voice)
+
+            with span('tts_playback'):
+                self.play_audio(audio)
+
+    def interrupt(self):
+        """Stop the current response, e.g. when the user barges in with the wake word, even before it plays."""
+        self._interrupted.set()
+
+    def play_audio(self, audio):
+        """Play 16 bit mono PCM audio on the output device, stopping early if interrupted."""
+        if self._pyaudio is None:
+            self._pyaudio = pyaudio.PyAudio()
+        stream = self._pyaudio.open(format=pyaudio.paInt16, channels=1, rate=TTS_SAMPLE_RATE, output=True,
+                                    output_device_index=self._output_device_index)
+
+        #Write in short chunks, so an interruption takes effect quickly
+        audio = memoryview(audio).cast('B')
+        chunk_bytes = int(PLAYBACK_CHUNK_SECONDS * TTS_SAMPLE_RATE) * 2
+        try:
+            for start in range(0, len(audio), chunk_bytes):
+                if self._interrupted.is_set():
+                    print("[Response] Interrupted")
+                    break
+                stream.write(audio[start:start + chunk_bytes])
+        finally:
+            stream.stop_stream()
+            stream.close()
 
     def azure_speech_synthesis(self, text):
-        """Upload text to Azure and output response to speaker"""
-        #Speech synthesizer using the default speaker as audio output.
-        speech_synthesizer = speechsdk.SpeechSynthesizer(
-            speech_config=self._azure_speech_config, 
-            audio_config=speechsdk.audio.AudioOutputConfig(use_default_speaker=True)
-        )
-
-        # Receives a text from console input and synthesizes it to speaker.
+        """Upload text to Azure and return the synthesized PCM audio."""
+        #No audio config, the audio is returned so it can be cached before playing
+        speech_synthesizer = speechsdk.SpeechSynthesizer(speech_config=self._azure_speech_config, audio_config=None)
+
         result = speech_synthesizer.speak_text_async(text).get()
         # Check result
         if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
-            print(f"Speech synthesized to speaker for text: {text}")
-            result_stream = speechsdk.AudioDataStream(result)
-
-            #Write to file here and save sentence which was sent to file
-            #TODO
-            result_stream.save_to_wav_file('data/logs/latest_tts.wav')
-            
-            #Add to list of sentences spoken
-            #TODO
+            print(f"Speech synthesized for text: {text}")
+            return result.audio_data
         elif result.reason == speechsdk.ResultReason.Canceled:
             cancellation_details = result.cancellation_details
             print("Speech synthesis canceled: {}".format(cancellation_details.reason))
             if cancellation_details.reason == speechsdk.CancellationReason.Error:
                 print("Error details: {}".format(cancellation_details.error_details))
-       
\ No newline at end of file
+        return None
@@ -0,0 +1,170 @@
+import time
+import importlib
+from threading import Thread, Event, Lock
+from contextlib import contextmanager
+
+from metrics import METRICS
+
+class StartupProfiler:
+    """
+    Records how long each step of starting the bot takes (imports, model
+    loads, file parsing) and when wake listening first came online, measured
+    from when this module was imported.
+    """
+
+    def __init__(self, target_seconds = None):
+        """
+        Constructor.
+        :param target_seconds: Optional time-to-first-listen budget, reported as met or missed.
+        """
+        self.start = time.perf_counter()
+        self.target_seconds = target_seconds
+        self.phases = []
+        self.subsystems = []
+        self.time_to_listen = None
+        self._lock = Lock()
+
+    @contextmanager
+    def phase(self, name, kind = 'other'):
+        """Time the enclosed block as one startup phase, e.g. kind 'import', 'model', 'parse' or 'subsystem'."""
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases.append((name, kind, begin - self.start, time.perf_counter() - begin))
+
+    def listening(self):
+        """Record that wake listening came online. Only the first call counts."""
+        if self.time_to_listen is not None:
+            return
+        self.time_to_listen = time.perf_counter() - self.start
+        METRICS.histogram('startup_time_to_listen').observe(self.time_to_listen)
+
+        message = f"[Startup] Listening after {self.time_to_listen:.2f}s"
+        if self.target_seconds is not None:
+            message += f" (target {self.target_seconds:.2f}s, {'met' if self.met_target() else 'MISSED'})"
+        print(message)
+
+    def met_target(self):
+        """Whether listening came online within the target, None if there is no target or it hasn't yet."""
+        if self.target_seconds is None or self.time_to_listen is None:
+            return None
+        return self.time_to_listen <= self.target_seconds
+
+    def readiness(self):
+        """Return each subsystem's state ('loading', 'ready' or 'failed') and load time."""
+        return {subsystem.name: {'state': subsystem.state, 'seconds': subsystem.seconds}
+                for subsystem in self.subsystems}
+
+    def report(self):
+        """Print every phase in the order it started, the subsystems' readiness and the time to first listen."""
+        print(f"{'startup phase':<40}{'kind':<12}{'start s':>9}{'took s':>9}")
+        with self._lock:
+            phases = sorted(self.phases, key=lambda phase: phase[2])
+        for name, kind, start, seconds in phases:
+            print(f"{name:<40}{kind:<12}{start:>9.3f}{seconds:>9.3f}")
+        for name, readiness in self.readiness().items():
+            seconds = f"{readiness['seconds']:.2f}s" if readiness['seconds'] is not None else ''
+            print(f"[Startup] {name}: {readiness['state']} {seconds}")
+        if self.time_to_listen is not None:
+            print(f"[Startup] Time to first listen: {self.time_to_listen:.2f}s"
+                  + (f" (target {self.target_seconds:.2f}s)" if self.target_seconds is not None else ''))
+
+    def report_when_ready(self):
+        """Print the report on a background thread once every subsystem has finished loading."""
+        def wait_and_report():
+            for subsystem in list(self.subsystems):
+                subsystem.wait()
+            self.report()
+        Thread(target=wait_and_report, daemon=True).start()
+
+#Process wide profiler, started when the bot's modules are first imported
+STARTUP = StartupProfiler()
+
+class LazyModule:
+    """Stand-in for a module which is only imported, and timed, on first attribute access."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            with STARTUP.phase(f'import {self._name}', 'import'):
+                self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+def lazy_import(name):
+    return LazyModule(name)
+
+class Subsystem:
+    """
+    Proxy for a part of the bot which loads on a background thread. Public
+    attribute access waits until it has loaded, so callers use it like the
+    object itself and only block if they need it before it is ready.
+    """
+
+    def __init__(self, name, loader, profiler = STARTUP):
+        """
+        Constructor.
+        :param name: Name reported in the readiness report.
+        :param loader: Function creating the object.
+        :param profiler: StartupProfiler to report to.
+        """
+        self.name = name
+        self.seconds = None
+        self._loader = loader
+        self._profiler = profiler
+        self._loaded = Event()
+        self._value = None
+        self._error = None
+        profiler.subsystems.append(self)
+
+    def start(self, background = True):
+        """Start loading, on a background thread unless `background` is False."""
+        if background:
+            Thread(target=self._load, name=f'load-{self.name}', daemon=True).start()
+        else:
+            self._load()
+        return self
+
+    def _load(self):
+        begin = time.perf_counter()
+        try:
+            with self._profiler.phase(self.name, 'subsystem'):
+                self._value = self._loader()
+        except Exception as e:
+            self._error = e
+            print(f"[Startup] {self.name} failed to load:", e)
+        finally:
+            self.seconds = time.perf_counter() - begin
+            self._loaded.set()
+
+    @property
+    def ready(self):
+        return self._loaded.is_set() and self._error is None
+
+    @property
+    def state(self):
+        if not self._loaded.is_set():
+            return 'loading'
+        return 'failed' if self._error is not None else 'ready'
+
+    def wait(self, timeout = None):
+        """Block until loading finished, successfully or not. Returns False on timeout."""
+        return self._loaded.wait(timeout)
+
+    def get(self, timeout = None):
+        """Return the loaded object, waiting for it if needed."""
+        if not self._loaded.wait(timeout):
+            raise TimeoutError(f"{self.name} is still loading")
+        if self._error is not None:
+            raise RuntimeError(f"{self.name} failed to load") from self._error
+        return self._value
+
+    def __getattr__(self, attribute):
+        #Only reached for attributes the proxy itself lacks
+        if attribute.startswith('_'):
+            raise AttributeError(attribute)
+        return getattr(self.get(), attribute)
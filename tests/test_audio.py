@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pvporcupine')
+pytest.importorskip('pvrecorder')
+
+from audio import AudioRingBuffer, WakeDetector
+
+def test_ring_buffer_views_wrapping_windows_contiguously():
+    ring = AudioRingBuffer(1, sample_rate = 10)
+    for start in range(0, 25, 4):
+        frame = ring.write(np.arange(start, start + 4, dtype=np.int16))
+        assert frame.tolist() == list(range(start, start + 4))
+
+    #28 samples written, only the last 10 are kept
+    assert ring.view(0).tolist() == list(range(18, 28))
+    assert ring.latest(0.5).tolist() == list(range(23, 28))
+    assert ring.view(20, 24).base is ring._buffer
+
+def test_ring_buffer_refuses_frames_larger_than_itself():
+    with pytest.raises(ValueError):
+        AudioRingBuffer(1, sample_rate = 10).write(np.zeros(11, dtype=np.int16))
+
+class FakeWakeEngine:
+    """Hears the wake word in frames starting with 1."""
+
+    sample_rate = 16_000
+    frame_length = 512
+
+    def process(self, pcm):
+        return 0 if pcm[0] == 1 else -1
+
+    def delete(self):
+        pass
+
+class FakeEndpointer:
+    """Ends an utterance after a fixed number of frames."""
+
+    max_seconds = 1
+    vad = None
+    total_seconds = speech_seconds = seconds_silent = 0.0
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.heard = 0
+
+    def reset(self):
+        self.heard = 0
+
+    def observe(self, frame):
+        pass
+
+    def update(self, frame):
+        self.heard += 1
+        return self.heard >= self.frames
+
+def frames(*values):
+    return [np.full(512, value, dtype=np.int16) for value in values]
+
+def test_wake_utterance_includes_the_preroll():
+    detector = WakeDetector(keyword_paths = ['/x/jarvis_linux.ppn'], preroll_seconds = 1024 / 16_000,
+                            endpointer = FakeEndpointer(3), wake_engine = FakeWakeEngine())
+    events = [detector.process(pcm) for pcm in frames(5, 6, 7, 1, 2, 3)]
+
+    assert events[:3] == [WakeDetector.NO_EVENTS] * 3
+    event, keyword, preroll = events[3][0]
+    assert (event, keyword) == (WakeDetector.WAKE, 'jarvis')
+    #Two frames of pre-roll, ending with the wake word
+    assert preroll[::512].tolist() == [7, 1]
+
+    assert [event for event, keyword, audio in events[4]] == [WakeDetector.AUDIO]
+    event, keyword, utterance = events[5][-1]
+    assert event == WakeDetector.END and utterance[::512].tolist() == [7, 1, 2, 3]
+    assert not detector.listening
@@ -0,0 +1,90 @@
+import os
+import sys
+import time
+import subprocess
+from threading import Event
+
+import numpy as np
+import soundfile
+
+from audio_writer import AudioWriter, RetentionPolicy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def tone(seconds = 0.5, sample_rate = 16_000):
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    return (3000 * np.sin(2 * np.pi * 440 * t)).astype(np.int16)
+
+def test_stream_is_written_in_order(tmp_path):
+    writer = AudioWriter(audio_format = 'wav')
+    stream = writer.open(str(tmp_path / 'clip.wav'))
+    audio = tone()
+    for frame in np.split(audio, 10):
+        assert stream.write(frame)
+    stream.close()
+    writer.flush()
+
+    written, sample_rate = soundfile.read(stream.file_name, dtype='int16')
+    assert sample_rate == 16_000
+    assert np.array_equal(written, audio)
+    writer.close()
+
+def test_stream_fails_when_writer_falls_behind(tmp_path):
+    writer = AudioWriter(audio_format = 'wav', max_queued_frames = 1, max_block_seconds = 0.05)
+    release = Event()
+    write = writer._write
+    def slow_write(stream, audio):
+        release.wait()
+        write(stream, audio)
+    writer._write = slow_write
+
+    stream = writer.open(str(tmp_path / 'clip.wav'))
+    results = [stream.write(frame) for frame in np.split(tone(), 5)]
+    #The writer holds one frame and the queue another, the rest waited too long
+    assert results[:2] == [True, True]
+    assert not any(results[2:])
+    assert stream.failed
+
+    release.set()
+    stream.close()
+    writer.flush()
+    #A recording with frames missing is discarded rather than saved
+    assert not os.path.exists(stream.file_name)
+    writer.close()
+
+def test_close_writes_everything_queued(tmp_path):
+    writer = AudioWriter(audio_format = 'wav')
+    file_name = writer.write(tone(), str(tmp_path / 'clip.wav'))
+    #Left open, so close has to finish it
+    stream = writer.open(str(tmp_path / 'open.wav'))
+    stream.write(tone())
+    writer.close()
+
+    assert soundfile.info(file_name).frames == len(tone())
+    assert soundfile.info(stream.file_name).frames == len(tone())
+    assert not stream.write(tone())
+
+def test_queued_audio_is_written_at_exit(tmp_path):
+    file_name = str(tmp_path / 'exit.wav')
+    code = ("import numpy as np; from audio_writer import AudioWriter; "
+            f"AudioWriter(audio_format = 'wav').write(np.ones(160000, dtype=np.int16), {file_name!r})")
+    subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True, timeout=60)
+    assert soundfile.info(file_name).frames == 160000
+
+def test_retention_keeps_referenced_files(tmp_path):
+    names = tmp_path / 'names'
+    names.mkdir()
+    now = time.time()
+    for i in range(4):
+        path = names / f'{i}.wav'
+        path.write_bytes(b'x' * 100)
+        os.utime(path, (now - 100 + i, now - 100 + i))
+
+    writer = AudioWriter(audio_format = 'wav', retention = {str(names): RetentionPolicy(max_files = 2)})
+    writer.protect(str(names), lambda: [str(names / '0.wav'), None])
+    writer.write(tone(0.1), str(names / 'new.wav'))
+    writer.flush()
+    writer.close()
+
+    #Unreferenced files go oldest first, the referenced one still counts towards the limit
+    assert sorted(os.listdir(names)) == ['0.wav', 'new.wav']
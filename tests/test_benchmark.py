@@ -0,0 +1,45 @@
+import os
+import sys
+import json
+import subprocess
+
+import numpy as np
+import soundfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_RATE = 16_000
+
+def write_clip(corpus_dir, name, annotation):
+    #Quiet room, a second of loud changing "speech" after the wake word, then quiet again
+    rng = np.random.default_rng(0)
+    audio = rng.normal(0, 30, int(4 * SAMPLE_RATE))
+    t = np.arange(SAMPLE_RATE) / SAMPLE_RATE
+    speech = 8000 * np.sin(2 * np.pi * (200 + 600 * t) * t) * (0.6 + 0.4 * np.sin(2 * np.pi * 4 * t))
+    audio[SAMPLE_RATE:2 * SAMPLE_RATE] += speech
+    soundfile.write(os.path.join(corpus_dir, name + '.wav'), audio.astype(np.int16), SAMPLE_RATE)
+    with open(os.path.join(corpus_dir, name + '.json'), 'w', encoding='utf-8') as f:
+        json.dump(annotation, f)
+
+def test_import_needs_no_hardware_modules():
+    #A fresh interpreter, so nothing imported by other tests hides a module level import
+    code = "import sys, benchmark; assert 'bot' not in sys.modules and 'pvporcupine' not in sys.modules"
+    subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True)
+
+def test_scripted_benchmark(tmp_path):
+    corpus_dir = tmp_path / 'corpus'
+    corpus_dir.mkdir()
+    write_clip(str(corpus_dir), 'photo', {'wake': 0.9, 'speech_end': 2.0, 'text': 'could you take my photo',
+                                          'command': 'takeMyPhoto'})
+    report_file_name = str(tmp_path / 'report.json')
+
+    #Run as a script, so the stand-in modules never leak into this process
+    subprocess.run([sys.executable, 'benchmark.py', str(corpus_dir), '--scripted-wake', '--stt-latency', '0',
+                    '--tts-latency', '0', '--json', report_file_name], cwd=ROOT, check=True, timeout=120)
+
+    with open(report_file_name, 'r', encoding='utf-8') as f:
+        report = json.load(f)
+    assert report['accuracy']['wake_hits'] == 1
+    assert report['accuracy']['command_accuracy'] == 1.0
+    clip, = report['clips']
+    assert clip['end_seconds'] is not None
+    assert clip['command'] == 'takeMyPhoto'
@@ -0,0 +1,121 @@
+from threading import Event
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pvporcupine')
+pytest.importorskip('pvrecorder')
+
+from bot import WelcomeBot, CommandsParser, Responses
+
+ADA = {'id': 1, 'name': 'Ada'}
+
+class FakeSpeech:
+    def __init__(self):
+        self.spoken = []
+
+    def speak(self, text):
+        self.spoken.append(text)
+
+    def speak_template(self, template, **values):
+        self.spoken.append(template.format(**values))
+
+class FakeCamera:
+    def capture(self):
+        return np.zeros((4, 4, 3), dtype=np.uint8)
+
+class NoGate:
+    ready = False
+
+    def wait(self):
+        pass
+
+class FakeGuestManager:
+    def __init__(self, matches):
+        self.matches = matches
+        self.candidates = []
+        self.voices = []
+
+    def recognize(self, frame, observation = None, candidate_id = None):
+        self.candidates.append(candidate_id)
+        return self.matches
+
+    def add_voice(self, guest_id, audio):
+        self.voices.append((guest_id, audio))
+
+def bot_with(matches):
+    #Only what parsing and recognizeMe need, without devices or models
+    bot = WelcomeBot.__new__(WelcomeBot)
+    bot.commands_parser = CommandsParser(commands_file = 'commands.context')
+    bot.speech_manager = FakeSpeech()
+    bot.camera = FakeCamera()
+    bot.face_gate = NoGate()
+    bot.guest_manager = FakeGuestManager(matches)
+    bot._cancelled = Event()
+    bot._wake_audio = None
+    bot._heard_wake_audio = None
+    bot._voice_match = None
+    return bot
+
+def test_voice_match_only_suggests_whom_the_camera_confirms():
+    bot = bot_with([])
+    bot.parse_text('recognize me', voice_match = (ADA, 0.95))
+    #The camera saw nobody it knows, so the voice alone doesn't welcome anyone
+    assert bot.guest_manager.candidates == [1]
+    assert bot.speech_manager.spoken[-1] == Responses.UNKNOWN_GUEST
+
+def test_voice_match_only_applies_to_its_own_utterance():
+    bot = bot_with([(ADA, 0.9)])
+    bot.parse_text('recognize me', voice_match = (ADA, 0.95))
+    assert bot._voice_match is None
+    bot.parse_text('recognize me')
+    assert bot.guest_manager.candidates == [1, None]
+    assert 'Ada' in bot.speech_manager.spoken[-1]
+
+class FakeRecognizer:
+    def __init__(self, azure_speech_config, on_partial = None):
+        self.audio = []
+        self.finished = False
+
+    def write(self, audio):
+        self.audio.append(np.array(audio))
+
+    def finish(self):
+        self.finished = True
+        return 'who am i'
+
+def test_speech_is_recognized_while_it_is_captured(monkeypatch):
+    monkeypatch.setattr('bot.StreamingRecognizer', FakeRecognizer)
+    bot = bot_with([])
+    bot.guest_manager.recognize_voice = lambda audio: None
+    bot._streaming_recognition = True
+    bot._streaming_recognizer = None
+    bot._azure_speech_config = None
+    bot._heard_voice_match = None
+    bot._metrics_file_name = None
+    parsed = []
+    bot.parse_text = lambda text, voice_match = None, wake_audio = None: parsed.append((text, wake_audio))
+
+    bot._on_wake('jarvis', np.ones(4, dtype=np.int16))
+    recognizer = bot._streaming_recognizer
+    bot._stream_audio(np.full(4, 2, dtype=np.int16))
+    bot._stream_audio(np.full(4, 3, dtype=np.int16))
+    #The pre-roll and every frame reached the recognizer before the utterance ended
+    assert [audio[0] for audio in recognizer.audio] == [1, 2, 3]
+    assert not recognizer.finished
+
+    bot._run_callback('jarvis', np.zeros(12, dtype=np.int16))
+    assert recognizer.finished and parsed[0][0] == 'who am i'
+    #The wake phrase goes with its utterance's command, and no further
+    assert parsed[0][1][0] == 1 and bot._heard_wake_audio is None
+    assert bot._streaming_recognizer is None
+
+def test_wake_phrase_is_only_learned_by_the_command_it_asked_for():
+    bot = bot_with([(ADA, 0.9)])
+    wake_audio = np.ones(4, dtype=np.int16)
+    bot.parse_text('recognize me', wake_audio = wake_audio)
+    assert bot.guest_manager.voices == [(1, wake_audio)] and bot._wake_audio is None
+
+    #A proactive greeting has no wake phrase, so nothing is learned
+    bot.run_command('recognizeMe')
+    assert len(bot.guest_manager.voices) == 1
@@ -0,0 +1,34 @@
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pvporcupine')
+pytest.importorskip('pvrecorder')
+
+from visual import CameraService, score_frames
+
+def frame(height = 48, width = 64, seed = 0):
+    return np.random.default_rng(seed).integers(0, 255, (height, width, 3), dtype=np.uint8)
+
+def camera_with(*timed_frames):
+    camera = CameraService()
+    for age, image in timed_frames:
+        camera._frames.append((time.monotonic() - age, image))
+    camera._frame_ready.set()
+    return camera
+
+def test_stale_frames_are_never_returned():
+    camera = camera_with((120.0, frame()))
+    with pytest.raises(Exception, match="Could not capture photo"):
+        camera.capture(max_age = 0.5, timeout = 0.1)
+
+def test_sharpest_recent_frame_is_chosen():
+    blurry = np.full((48, 64, 3), 128, dtype=np.uint8)
+    sharp = frame()
+    camera = camera_with((0.1, blurry), (0.05, sharp), (0.0, blurry))
+    assert camera.capture() is sharp
+
+def test_frames_of_another_resolution_score_zero():
+    scores = score_frames([frame(96, 128), frame(48, 64, seed = 1)])
+    assert scores[0] == 0 and scores[1] > 0
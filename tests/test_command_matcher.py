@@ -0,0 +1,31 @@
+from command_matcher import CommandMatcher, normalize
+
+COMMANDS = {
+    'recognizeMe': ['do you know me', 'who am i'],
+    'addGuest': ['remember me', 'remember my face'],
+    'weather': ['weather'],
+}
+
+def test_normalize_drops_punctuation_and_case():
+    assert normalize("  Who AM i?!\tPlease ") == 'who am i please'
+
+def test_whole_words_only():
+    matcher = CommandMatcher(COMMANDS)
+    assert matcher.match('tell me the weather') == 'weather'
+    assert matcher.match('what is weatherproof') is None
+
+def test_longest_prompt_wins():
+    matcher = CommandMatcher({'face': ['face'], 'addGuest': ['remember my face']})
+    assert len(matcher.find_all('please remember my face')) == 2
+    assert matcher.match('please remember my face') == 'addGuest'
+
+def test_earliest_match_wins_between_equal_lengths():
+    matcher = CommandMatcher({'a': ['left'], 'b': ['lift']})
+    assert matcher.match('lift then left') == 'b'
+    assert matcher.match('left then lift') == 'a'
+
+def test_fuzzy_match_only_above_the_cutoff():
+    assert CommandMatcher(COMMANDS).match('do you no me') is None
+    matcher = CommandMatcher(COMMANDS, fuzzy_cutoff = 0.8)
+    assert matcher.match('hey do you no me') == 'recognizeMe'
+    assert matcher.match('something else entirely') is None
@@ -0,0 +1,97 @@
+import os
+
+import numpy as np
+import pytest
+
+from embedding_index import EmbeddingIndex
+
+def random_embeddings(count, dim = 8, seed = 0):
+    return np.random.default_rng(seed).normal(size=(count, dim)).astype(np.float32)
+
+def test_query_returns_best_matches_first(tmp_path):
+    index = EmbeddingIndex(str(tmp_path / 'faces.npy'), initial_capacity = 2)
+    embeddings = random_embeddings(5)
+    #Grows past its initial capacity
+    index.add_many([10, 11, 12, 13, 14], embeddings)
+
+    matches = index.query(embeddings[3] * 5, k = 2)
+    assert matches[0][0] == 13
+    assert matches[0][1] == pytest.approx(1.0, abs = 1e-5)
+    assert len(matches) == 2 and matches[1][1] <= matches[0][1]
+    assert index.query(-embeddings[3], threshold = 0.5) == []
+
+def test_index_persists(tmp_path):
+    file_name = str(tmp_path / 'faces.npy')
+    embeddings = random_embeddings(3)
+    EmbeddingIndex(file_name, model = 'Facenet512').add_many([1, 2, 3], embeddings)
+
+    index = EmbeddingIndex(file_name, model = 'Facenet512')
+    assert len(index) == 3 and index.dim == 8 and index.model == 'Facenet512'
+    assert index.keys().tolist() == [1, 2, 3]
+    assert index.query(embeddings[1])[0][0] == 2
+
+def test_other_model_is_refused(tmp_path):
+    file_name = str(tmp_path / 'faces.npy')
+    EmbeddingIndex(file_name, model = 'Facenet512').add(1, random_embeddings(1)[0])
+
+    index = EmbeddingIndex(file_name, model = 'ArcFace')
+    with pytest.raises(ValueError):
+        index.query(random_embeddings(1)[0])
+    with pytest.raises(ValueError):
+        index.add(2, random_embeddings(1)[0])
+
+def test_other_dimension_is_refused(tmp_path):
+    index = EmbeddingIndex(str(tmp_path / 'faces.npy'))
+    index.add(1, random_embeddings(1, dim = 8)[0])
+    with pytest.raises(ValueError):
+        index.query(random_embeddings(1, dim = 4)[0])
+
+def test_index_without_model_takes_the_callers(tmp_path):
+    file_name = str(tmp_path / 'faces.npy')
+    EmbeddingIndex(file_name).add(1, random_embeddings(1)[0])
+    os.remove(str(tmp_path / 'faces.meta.json'))
+
+    index = EmbeddingIndex(file_name, model = 'Facenet512')
+    assert index.model == 'Facenet512'
+    assert index.query(random_embeddings(1)[0], threshold = -1)[0][0] == 1
+
+def test_replace_takes_over_the_rebuilt_model(tmp_path):
+    index = EmbeddingIndex(str(tmp_path / 'faces.npy'), model = 'Facenet512')
+    index.add(1, random_embeddings(1)[0])
+    rebuilt = EmbeddingIndex(str(tmp_path / 'faces.reindex.npy'), model = 'ArcFace')
+    rebuilt.add_many([1, 2], random_embeddings(2, dim = 16))
+
+    index.replace(rebuilt)
+    assert len(index) == 2 and index.dim == 16 and index.model == 'ArcFace'
+    #The bot still embedding with the old model can't use the new index
+    with pytest.raises(ValueError):
+        EmbeddingIndex(str(tmp_path / 'faces.npy'), model = 'Facenet512').query(random_embeddings(1, dim = 16)[0])
+
+def test_similarity_to_one_key(tmp_path):
+    index = EmbeddingIndex(str(tmp_path / 'faces.npy'))
+    embeddings = random_embeddings(3)
+    index.add_many([1, 1, 2], embeddings)
+    #The best of the key's embeddings counts
+    assert index.similarity(1, embeddings[1]) == pytest.approx(1.0, abs = 1e-5)
+    assert index.similarity(3, embeddings[1]) is None
+
+def test_queries_while_the_index_grows_on_another_thread(tmp_path):
+    from threading import Thread
+
+    index = EmbeddingIndex(str(tmp_path / 'faces.npy'), initial_capacity = 1)
+    embeddings = random_embeddings(200)
+    index.add(0, embeddings[0])
+    errors = []
+    def grow():
+        try:
+            for key in range(1, 200):
+                index.add(key, embeddings[key])
+        except Exception as e:
+            errors.append(e)
+    thread = Thread(target=grow)
+    thread.start()
+    #Growing swaps the matrix out, queries meanwhile must neither fail nor lose the first row
+    while thread.is_alive():
+        assert index.query(embeddings[0])[0][0] == 0
+    thread.join()
+    assert errors == [] and len(index) == 200
@@ -0,0 +1,90 @@
+import os
+from concurrent.futures import Future
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pvporcupine')
+pytest.importorskip('pvrecorder')
+
+from enroll import directory_items, enroll, reindex
+from embedding_index import EmbeddingIndex
+from guest_store import GuestStore
+from visual import GuestManager
+
+class FakeFaceService:
+    """Embeds a photo as its first byte, and fails photos named bad."""
+
+    model_name = 'Fake'
+
+    def __init__(self):
+        self.embedded = []
+
+    def submit_embed_file(self, file_name, enforce_detection = True, face_gate = None):
+        self.embedded.append(file_name)
+        future = Future()
+        if 'bad' in file_name:
+            future.set_result((None, 'no face'))
+        else:
+            with open(file_name, 'rb') as f:
+                future.set_result((np.array([f.read()[0], 1.0], dtype=np.float32), None))
+        return future
+
+@pytest.fixture
+def guest_manager(tmp_path, monkeypatch):
+    #Guest files are copied under data/, relative to where the bot runs
+    monkeypatch.chdir(tmp_path)
+    manager = GuestManager.__new__(GuestManager)
+    manager._face_service = FakeFaceService()
+    manager._face_gate = None
+    manager.voice_id = None
+    manager.store = GuestStore(str(tmp_path / 'guests.db'))
+    manager.face_index = EmbeddingIndex(str(tmp_path / 'faces.npy'), model = 'Fake')
+    yield manager
+    manager.store.close()
+
+@pytest.fixture
+def photos(tmp_path):
+    directory = tmp_path / 'photos'
+    directory.mkdir()
+    for value, name in enumerate(['Ada_Lovelace.jpg', 'Grace_Hopper.png', 'bad.jpg', 'notes.txt']):
+        (directory / name).write_bytes(bytes([value + 1]))
+    return str(directory)
+
+def test_directory_items_name_guests_after_their_photos(photos):
+    items = list(directory_items(photos))
+    assert [item['name'] for item in items] == ['Ada Lovelace', 'Grace Hopper', 'bad']
+    assert all(item['audio'] is None for item in items)
+
+def test_enroll_commits_in_batches_and_resumes(guest_manager, photos):
+    stats = enroll(guest_manager, directory_items(photos), commit_size = 1, max_in_flight = 2)
+    assert (stats.enrolled, stats.failed, stats.skipped) == (2, 1, 0)
+    assert sorted(guest['name'] for guest in guest_manager.store) == ['Ada Lovelace', 'Grace Hopper']
+    guest, = guest_manager.store.find_by_name('Ada Lovelace')
+    assert open(guest['face_file_name'], 'rb').read() == bytes([1])
+    assert len(guest_manager.face_index) == 2
+
+    #Enrolled guests are skipped when the run is repeated, only the failure is retried
+    guest_manager._face_service.embedded.clear()
+    stats = enroll(guest_manager, directory_items(photos))
+    assert (stats.enrolled, stats.failed, stats.skipped) == (0, 1, 2)
+    assert [file_name.endswith('bad.jpg') for file_name in guest_manager._face_service.embedded] == [True]
+
+def test_reindex_swaps_in_a_complete_index(guest_manager, photos):
+    enroll(guest_manager, directory_items(photos))
+    guest_manager.face_index.add_many([99], [np.array([5.0, 5.0], dtype=np.float32)])
+
+    stats = reindex(guest_manager)
+    assert stats.enrolled == 2
+    #Only stored guests are in the rebuilt index
+    assert sorted(guest_manager.face_index.keys().tolist()) == sorted(guest['id'] for guest in guest_manager.store)
+
+def test_reindex_keeps_the_old_index_if_a_guest_fails(guest_manager, photos):
+    enroll(guest_manager, directory_items(photos))
+    before = sorted(guest_manager.face_index.keys().tolist())
+    guest, = guest_manager.store.find_by_name('Grace Hopper')
+    os.remove(guest['face_file_name'])
+
+    stats = reindex(guest_manager)
+    assert stats.failed == 1
+    assert sorted(guest_manager.face_index.keys().tolist()) == before
@@ -0,0 +1,63 @@
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from face_gate import FaceGate, FaceObservation, FaceWatcher
+
+needs_cascades = pytest.mark.skipif(not hasattr(cv2, 'CascadeClassifier'), reason='OpenCV without Haar cascades')
+
+def test_opencv_without_cascades_is_refused(monkeypatch):
+    monkeypatch.delattr(cv2, 'CascadeClassifier', raising=False)
+    with pytest.raises(ImportError):
+        FaceGate()
+
+@needs_cascades
+def test_blank_frame_has_no_face():
+    assert FaceGate().detect(np.zeros((240, 320, 3), dtype=np.uint8)) is None
+
+@needs_cascades
+def test_crop_is_square_and_gate_can_be_rebuilt_from_its_settings():
+    gate = FaceGate(crop_size = 112)
+    frame = np.random.default_rng(0).integers(0, 255, (240, 320, 3), dtype=np.uint8)
+    crop = gate.crop(frame, FaceObservation((100, 60, 80, 90), 320))
+    assert crop.shape == (112, 112, 3)
+    assert FaceGate(**gate.settings).settings == gate.settings
+
+class FlakyCamera:
+    """Fails its first reads, as a camera reconnecting would."""
+
+    def __init__(self, failures):
+        self.failures = failures
+
+    def latest(self, max_age = None):
+        if self.failures > 0:
+            self.failures -= 1
+            raise RuntimeError('camera disconnected')
+        return [np.zeros((4, 4, 3), dtype=np.uint8)]
+
+class FakeGate:
+    def detect(self, frame):
+        return FaceObservation((0, 0, 2, 2), 4)
+
+class FakeTracker:
+    def __init__(self):
+        self.updates = 0
+
+    def update(self, observations):
+        self.updates += 1
+
+def test_watcher_keeps_watching_after_a_failed_check(capsys):
+    tracker = FakeTracker()
+    arrivals = []
+    watcher = FaceWatcher(FlakyCamera(3), FakeGate(), on_arrival = lambda observation, frame: arrivals.append(frame),
+                          interval = 0.01, confirm_checks = 2, tracker = tracker).start()
+    deadline = time.monotonic() + 2
+    while not arrivals and time.monotonic() < deadline:
+        time.sleep(0.01)
+    watcher.stop()
+
+    assert arrivals and tracker.updates > 0
+    #The same error is reported once, not on every check
+    assert capsys.readouterr().out.count('camera disconnected') == 1
@@ -0,0 +1,42 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pytest
+
+from face_service import FaceService
+
+@pytest.fixture
+def service():
+    service = FaceService(num_workers = 2)
+    #Swap in workers without DeepFace, the pool itself is what is under test
+    service._pool.shutdown()
+    service._create_pool = lambda: ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context('spawn'))
+    service._pool = service._create_pool()
+    yield service
+    service.shutdown()
+
+def test_warm_up_reaches_every_worker(service, capsys):
+    service.warm_up(timeout = 60)
+    assert '2 worker(s) warm' in capsys.readouterr().out
+
+def test_health_reports_alive(service):
+    assert service.health()['alive']
+
+def test_crashed_worker_fails_its_requests_and_the_pool_recovers(service):
+    broken_pool = service._pool
+    crash = broken_pool.submit(os._exit, 1)
+    assert isinstance(crash.exception(timeout = 60), BrokenProcessPool)
+
+    #Answered with the error instead of never, and the dispatcher lives on
+    request = service.submit_detect(np.zeros((4, 4, 3), dtype=np.uint8))
+    assert isinstance(request.exception(timeout = 10), BrokenProcessPool)
+    assert service._dispatcher.is_alive()
+
+    deadline = time.monotonic() + 60
+    while service._pool is broken_pool and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert service.health()['alive']
@@ -0,0 +1,138 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pvporcupine')
+pytest.importorskip('pvrecorder')
+
+from face_gate import FaceObservation
+from visual import GuestManager
+
+class CountingGate:
+    def __init__(self):
+        self.detections = 0
+
+    def detect(self, frame):
+        self.detections += 1
+        return FaceObservation((0, 0, 2, 2), 4)
+
+    def crop(self, frame, observation):
+        return frame
+
+class FakeIndex:
+    def __init__(self, similarities = None):
+        self.similarities = similarities or {}
+
+    def query(self, embedding, k = 1, threshold = 0.0):
+        return [(1, 0.9)]
+
+    def similarity(self, key, embedding):
+        return self.similarities.get(key)
+
+class FakeStore:
+    def get(self, guest_id):
+        return {'id': guest_id, 'name': {1: 'Ada', 2: 'Grace'}[guest_id]}
+
+def guest_manager(face_gate):
+    #Only what recognize needs, without the face service's worker processes
+    manager = GuestManager.__new__(GuestManager)
+    manager._face_gate = face_gate
+    manager._tracker = None
+    manager._match_threshold = 0.7
+    manager._embed = lambda frame, observation = None: np.ones(4)
+    manager.face_index = FakeIndex()
+    manager.store = FakeStore()
+    return manager
+
+def test_recognize_reuses_the_callers_observation():
+    gate = CountingGate()
+    manager = guest_manager(gate)
+    frame = np.zeros((4, 4, 3), dtype=np.uint8)
+
+    assert manager.recognize(frame, observation = gate.detect(frame))[0][0]['name'] == 'Ada'
+    assert gate.detections == 1
+    manager.recognize(frame)
+    assert gate.detections == 2
+
+def test_candidate_is_chosen_only_if_the_face_confirms_them():
+    manager = guest_manager(CountingGate())
+    frame = np.zeros((4, 4, 3), dtype=np.uint8)
+
+    manager.face_index = FakeIndex({2: 0.8})
+    assert [(guest['name'], score) for guest, score in manager.recognize(frame, candidate_id = 2)] == [('Grace', 0.8)]
+    #A face unlike the candidate's is looked up among every guest
+    manager.face_index = FakeIndex({2: 0.3})
+    assert manager.recognize(frame, candidate_id = 2)[0][0]['name'] == 'Ada'
+
+def test_tracked_face_is_answered_without_running_the_face_model():
+    from tracking import IdentityTracker
+
+    manager = guest_manager(CountingGate())
+    manager._tracker = IdentityTracker()
+    embeddings = []
+    manager._embed = lambda frame, observation = None: embeddings.append(frame) or np.ones(4)
+    queries = []
+    manager.face_index.query = lambda embedding, k = 1, threshold = 0.0: queries.append(embedding) or [(1, 0.9)]
+    frame = np.zeros((4, 4, 3), dtype=np.uint8)
+
+    manager.recognize(frame)
+    assert manager.recognize(frame)[0][0]['name'] == 'Ada'
+    assert len(embeddings) == 1 and len(queries) == 1
+
+def test_tracked_face_is_checked_again_once_due():
+    from tracking import IdentityTracker
+
+    manager = guest_manager(CountingGate())
+    manager._tracker = IdentityTracker(verify_seconds = 0)
+    queries = []
+    manager.face_index.query = lambda embedding, k = 1, threshold = 0.0: queries.append(embedding) or [(1, 0.9)]
+    frame = np.zeros((4, 4, 3), dtype=np.uint8)
+
+    manager.recognize(frame)
+    manager.recognize(frame)
+    assert len(queries) == 1
+    #Someone else stepping into the same spot is looked up again
+    manager._embed = lambda frame, observation = None: np.array([1, -1, 1, -1])
+    manager.recognize(frame)
+    assert len(queries) == 2
+
+class FakeVoices:
+    def enroll(self, guest_id, audio):
+        pass
+
+def test_rolled_back_guest_leaves_no_embedding_for_the_next_one(tmp_path, monkeypatch):
+    from audio_writer import AudioWriter
+    from embedding_index import EmbeddingIndex
+    from guest_store import GuestStore
+    import visual
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'data' / 'faces').mkdir(parents = True)
+    writer = AudioWriter(audio_format = 'wav')
+    monkeypatch.setattr(visual, 'default_writer', lambda: writer)
+    manager = GuestManager.__new__(GuestManager)
+    manager._face_gate = manager._tracker = None
+    manager._embed = lambda frame, observation = None: frame[0, 0, :3].astype(np.float32) + 1
+    manager.store = GuestStore('data/guests.db')
+    manager.face_index = EmbeddingIndex('data/faces.npy', dim = 3)
+    manager.voice_id = FakeVoices()
+    frame = np.zeros((4, 4, 3), dtype=np.uint8)
+    audio = np.zeros(1600, dtype=np.int16)
+
+    def fail(*args, **kwargs):
+        raise OSError("Disk full")
+    monkeypatch.setattr(writer, 'write_now', fail)
+    with pytest.raises(OSError):
+        manager.add_guest(frame, audio, 'Ada')
+    assert len(manager.face_index) == 0
+    assert not list((tmp_path / 'data' / 'faces').iterdir())
+
+    #The next guest is given the rolled back id, and only their own face
+    monkeypatch.undo()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(visual, 'default_writer', lambda: writer)
+    guest_id = manager.add_guest(frame + 5, audio, 'Grace')
+    assert list(manager.face_index.keys()) == [guest_id]
+    assert manager.face_index.similarity(guest_id, np.full(3, 6.0)) == pytest.approx(1.0)
+    #The name recording is on disk as soon as the guest is
+    assert (tmp_path / manager.store.get(guest_id)['audio_file_name']).exists()
+    writer.close()
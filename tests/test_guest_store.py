@@ -0,0 +1,80 @@
+import json
+from threading import Thread
+
+import pytest
+
+from guest_store import GuestStore
+
+@pytest.fixture
+def store(tmp_path):
+    store = GuestStore(str(tmp_path / 'guests.db'))
+    yield store
+    store.close()
+
+def test_add_fills_in_id(store):
+    guest_id = store.add('Ada', face_file_name = 'data/faces/{id}.jpg')
+    guest = store.get(guest_id)
+    assert guest['name'] == 'Ada'
+    assert guest['face_file_name'] == f'data/faces/{guest_id}.jpg'
+    assert guest['audio_file_name'] is None
+
+def test_prepare_sees_the_new_guest(store):
+    seen = []
+    guest_id = store.add('Ada', prepare = seen.append, face_file_name = '{id}.jpg')
+    assert seen[0]['id'] == guest_id
+    assert store.get(guest_id) is not None
+
+def test_failed_prepare_rolls_back(store):
+    def fail(guest):
+        raise IOError('disk full')
+
+    with pytest.raises(IOError):
+        store.add('Ada', prepare = fail)
+    assert len(store) == 0
+    assert store.add('Grace') is not None
+
+def test_iteration_spans_pages(store, monkeypatch):
+    monkeypatch.setattr(GuestStore, 'PAGE_SIZE', 3)
+    store.add_many([{'name': f'guest {i}'} for i in range(7)])
+    assert [guest['name'] for guest in store] == [f'guest {i}' for i in range(7)]
+
+def test_add_many_records_sources(store):
+    guest_ids = store.add_many([{'name': 'Ada', 'source': 'a.jpg'}, {'name': 'Grace', 'source': 'g.jpg'}])
+    assert store.enrolled_sources() == {'a.jpg': guest_ids[0], 'g.jpg': guest_ids[1]}
+
+def test_find_by_name_ignores_case(store):
+    store.add('Ada')
+    assert [guest['name'] for guest in store.find_by_name('ADA')] == ['Ada']
+
+def test_file_names_lists_referenced_files(store):
+    first = store.add('Ada', audio_file_name = 'data/names/{id}.flac', face_file_name = 'data/faces/{id}.jpg')
+    second = store.add('Grace', face_file_name = 'data/faces/{id}.jpg')
+    assert store.file_names() == {f'data/names/{first}.flac', f'data/faces/{first}.jpg', f'data/faces/{second}.jpg'}
+
+def test_retention_does_not_wait_for_a_guest_being_added(store, tmp_path):
+    import numpy as np
+    from audio_writer import AudioWriter, RetentionPolicy
+
+    names = tmp_path / 'names'
+    writer = AudioWriter(audio_format = 'wav', retention = {str(names): RetentionPolicy(max_files = 10)})
+    writer.protect(str(names), store.file_names)
+
+    def write_and_wait(guest):
+        #The writer thread runs retention while the store's transaction is still open
+        writer.write(np.zeros(160, dtype=np.int16), str(names / 'clip.wav'))
+        writer.flush()
+
+    adding = Thread(target=store.add, args=('Ada',), kwargs={'prepare': write_and_wait}, daemon=True)
+    adding.start()
+    adding.join(timeout = 10)
+    assert not adding.is_alive()
+    assert len(store) == 1
+    writer.close()
+
+def test_legacy_log_is_imported(tmp_path):
+    log = tmp_path / 'guest_log.json'
+    log.write_text(json.dumps([{'id': 4, 'name': 'Ada', 'face_file_name': 'data/faces/4.jpg'}]))
+    store = GuestStore(str(tmp_path / 'guests.db'), legacy_log_file_name = str(log))
+    assert store.get(4)['name'] == 'Ada'
+    assert store.add('Grace') == 5
+    store.close()
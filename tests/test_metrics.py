@@ -0,0 +1,67 @@
+import json
+import time
+
+import pytest
+
+from metrics import Metrics, FrameLoopMonitor
+
+def test_histogram_quantiles_are_bucket_bounds():
+    histogram = Metrics().histogram('stage', buckets = (0.01, 0.1, 1))
+    assert histogram.quantile(0.5) is None
+    for value in (0.005, 0.05, 0.05, 0.5, 5):
+        histogram.observe(value)
+
+    assert histogram.counts == [1, 2, 1, 1]
+    assert histogram.quantile(0.5) == 0.1
+    assert histogram.quantile(1.0) == float('inf')
+    assert histogram.sum == pytest.approx(5.605)
+
+def test_metrics_are_registered_once_by_name():
+    metrics = Metrics()
+    metrics.counter('wakes').inc()
+    metrics.counter('wakes').inc(2)
+    assert metrics.counter('wakes').value == 3
+    assert metrics.histogram('stt') is metrics.histogram('stt')
+
+def test_span_times_the_block_even_when_it_raises():
+    metrics = Metrics()
+    with pytest.raises(ValueError):
+        with metrics.span('command'):
+            raise ValueError()
+    assert metrics.histogram('command').count == 1
+
+def test_prometheus_export(tmp_path):
+    metrics = Metrics(prefix = 'bot')
+    metrics.histogram('stt', buckets = (0.1, 1)).observe(0.5)
+    metrics.counter('wakes').inc()
+    file_name = str(tmp_path / 'metrics.prom')
+    metrics.export_prometheus(file_name)
+
+    lines = open(file_name).read().splitlines()
+    assert 'bot_stt_seconds_bucket{le="0.1"} 0' in lines
+    assert 'bot_stt_seconds_bucket{le="1"} 1' in lines
+    assert 'bot_stt_seconds_bucket{le="+Inf"} 1' in lines
+    assert 'bot_wakes_total 1' in lines
+
+def test_jsonl_export_appends_snapshots(tmp_path):
+    metrics = Metrics()
+    metrics.counter('wakes').inc()
+    file_name = str(tmp_path / 'metrics.jsonl')
+    metrics.export_jsonl(file_name)
+    metrics.export_jsonl(file_name)
+
+    snapshots = [json.loads(line) for line in open(file_name)]
+    assert len(snapshots) == 2 and snapshots[0]['counters'] == {'wakes': 1}
+
+def test_frame_loop_monitor_estimates_overflows():
+    metrics = Metrics()
+    monitor = FrameLoopMonitor(sample_rate = 1000, buffer_seconds = 0.05, metrics = metrics)
+    monitor.tick(10)
+    #Reading 10 ms of audio took 100 ms, so the recorder's 50 ms buffer overflowed
+    time.sleep(0.1)
+    monitor.tick(10)
+    monitor.tick(10)
+
+    assert metrics.counter('audio_frames').value == 3
+    assert metrics.counter('recorder_overflows_estimated').value == 1
+    assert metrics.histogram('frame_jitter').count == 2
@@ -0,0 +1,89 @@
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pvporcupine')
+pytest.importorskip('pvrecorder')
+
+from audio import WakeDetector
+from multi_audio import MultiDeviceListener
+
+class FakeDetector:
+    sample_rate = 16_000
+    frame_length = 512
+
+    def __init__(self):
+        self.processed = 0
+        self.listening = False
+
+    def process(self, pcm, detect = True):
+        self.processed += 1
+        return WakeDetector.NO_EVENTS
+
+    def utterance(self):
+        return np.ones(10, dtype=np.int16)
+
+    def start_listening(self, include_preroll = True):
+        self.listening = True
+
+    def cancel(self):
+        self.listening = False
+
+    def delete(self):
+        pass
+
+def make_listener(num_channels = 3):
+    events = []
+    listener = MultiDeviceListener(list(range(num_channels)), FakeDetector,
+                                   on_event = lambda *event: events.append(event))
+    return listener, events
+
+def frame(amplitude):
+    return (amplitude * np.sin(np.arange(512) * 0.3)).astype(np.int16)
+
+def test_stalled_channel_is_left_out_without_holding_up_the_tick():
+    listener, events = make_listener()
+    listener._frames[0].put(frame(100))
+    listener._frames[2].put(frame(100))
+
+    start = time.monotonic()
+    batch, present = listener._collect_tick()
+    #One shared deadline of four frames, not one per channel
+    assert time.monotonic() - start < 0.2
+    assert list(present) == [True, False, True]
+    assert listener._stalled[1]
+
+    #Once stalled, the channel is polled without waiting at all
+    listener._frames[0].put(frame(100))
+    listener._frames[2].put(frame(100))
+    start = time.monotonic()
+    batch, present = listener._collect_tick()
+    assert time.monotonic() - start < 0.02
+    assert list(present) == [True, False, True]
+
+    listener._frames[1].put(frame(100))
+    batch, present = listener._collect_tick()
+    assert present[1] and not listener._stalled[1]
+
+def test_missing_channel_keeps_its_noise_floor_and_skips_detection():
+    listener, events = make_listener(2)
+    batch = np.stack([frame(100), np.zeros(512, dtype=np.int16)])
+    floor = listener._noise_floor.db.copy()
+    listener._process_tick(batch, np.array([True, False]))
+
+    assert listener._noise_floor.db[1] == floor[1]
+    assert listener._noise_floor.db[0] != floor[0]
+    assert listener._detectors[0].processed == 1
+    assert listener._detectors[1].processed == 0
+
+def test_utterance_on_a_stalled_channel_ends():
+    listener, events = make_listener(2)
+    listener.active_channel = 1
+    listener._detectors[1].listening = True
+    listener._process_tick(np.zeros((2, 512), dtype=np.int16), np.array([True, False]))
+
+    assert listener.active_channel is None
+    assert not listener._detectors[1].listening
+    device_index, event, keyword, audio = events[0]
+    assert (device_index, event) == (1, WakeDetector.END) and len(audio) == 10
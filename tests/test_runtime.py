@@ -0,0 +1,148 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pvporcupine')
+pytest.importorskip('pvrecorder')
+
+from audio import WakeDetector
+from runtime import BotRuntime, CommandCancelled
+
+class FakeSpeech:
+    def __init__(self):
+        self.interrupts = 0
+
+    def interrupt(self):
+        self.interrupts += 1
+
+class FakeBot:
+    _streaming_recognition = False
+    _azure_speech_config = None
+
+    def __init__(self):
+        self.speech_manager = FakeSpeech()
+        self.cancelled = False
+
+    def identify_voice(self, audio):
+        pass
+
+    def cancel_command(self):
+        self.cancelled = True
+        self.speech_manager.interrupt()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise CommandCancelled()
+
+class FakeDetector:
+    sample_rate = 16_000
+    listening = False
+
+    def start_listening(self, include_preroll = True):
+        self.listening = True
+
+    def cancel(self):
+        self.listening = False
+
+def runtime_for(bot):
+    runtime = BotRuntime(bot, output_path = None)
+    runtime._loop = asyncio.get_running_loop()
+    runtime._utterances = asyncio.Queue(maxsize=4)
+    runtime._utterance_idle = asyncio.Event()
+    runtime._utterance_idle.set()
+    runtime._detector = FakeDetector()
+    return runtime
+
+AUDIO = np.zeros(512, dtype=np.int16)
+
+def test_listen_waits_for_a_wake_utterance_in_progress():
+    async def scenario():
+        runtime = runtime_for(FakeBot())
+        runtime._handle_event(WakeDetector.WAKE, 'jarvis', AUDIO)
+        listen = asyncio.ensure_future(runtime._listen(5))
+        await asyncio.sleep(0.01)
+        assert runtime._pending_listen is None
+
+        #The wake utterance goes to recognition, not to the question being asked
+        runtime._handle_event(WakeDetector.END, 'jarvis', AUDIO)
+        assert runtime._utterances.qsize() == 1
+        await asyncio.sleep(0.01)
+        assert runtime._pending_listen is not None
+
+        runtime._handle_event(WakeDetector.END, None, AUDIO + 1)
+        assert (await listen)[0] == 1
+    asyncio.run(scenario())
+
+def test_barge_in_cancels_the_running_command_and_its_listen():
+    async def scenario():
+        bot = FakeBot()
+        runtime = runtime_for(bot)
+        listen = asyncio.ensure_future(runtime._listen(5))
+        await asyncio.sleep(0.01)
+
+        runtime._busy = True
+        runtime._handle_event(WakeDetector.WAKE, 'jarvis', AUDIO)
+        assert bot.cancelled and bot.speech_manager.interrupts == 1
+        with pytest.raises(CommandCancelled):
+            await listen
+    asyncio.run(scenario())
+
+def test_listener_events_wait_for_room_instead_of_being_dropped():
+    async def scenario():
+        runtime = runtime_for(FakeBot())
+        runtime._frames = asyncio.Queue(maxsize=1)
+        loop = asyncio.get_running_loop()
+        #The listener's thread delivers more events than the queue holds
+        delivered = loop.run_in_executor(None, lambda: [runtime._deliver_event((WakeDetector.AUDIO, None, i))
+                                                        for i in range(3)])
+        received = [(await runtime._frames.get())[2] for _ in range(3)]
+        await delivered
+        assert received == [0, 1, 2]
+    asyncio.run(scenario())
+
+def test_failed_event_is_logged_and_listening_goes_on(monkeypatch, capsys):
+    def no_recognizer(config):
+        raise RuntimeError('no network')
+    monkeypatch.setattr('runtime.StreamingRecognizer', no_recognizer)
+
+    class WakingDetector(FakeDetector):
+        def __init__(self):
+            self.frames = 0
+
+        def process(self, pcm):
+            self.frames += 1
+            return [(WakeDetector.WAKE, 'jarvis', pcm)] if self.frames == 1 else []
+
+    async def scenario():
+        bot = FakeBot()
+        bot._streaming_recognition = True
+        runtime = runtime_for(bot)
+        runtime._frames = asyncio.Queue()
+        runtime._detector = WakingDetector()
+        task = asyncio.ensure_future(runtime._wake_task())
+        for _ in range(3):
+            runtime._frames.put_nowait(AUDIO)
+        await asyncio.sleep(0.05)
+        assert not task.done() and runtime._detector.frames == 3
+        task.cancel()
+    asyncio.run(scenario())
+    assert 'Handling wake failed: no network' in capsys.readouterr().out
+
+def test_voice_is_identified_off_the_event_loop():
+    import threading
+
+    class SlowBot(FakeBot):
+        def identify_voice(self, audio):
+            self.thread = threading.current_thread()
+            return ({'id': 1, 'name': 'Ada'}, 0.95)
+
+    async def scenario():
+        bot = SlowBot()
+        runtime = runtime_for(bot)
+        runtime._handle_event(WakeDetector.WAKE, 'jarvis', AUDIO)
+        runtime._handle_event(WakeDetector.END, 'jarvis', AUDIO)
+        keyword, recognizer, utterance, voice_match, wake_audio = await runtime._utterances.get()
+        assert (await voice_match)[0]['name'] == 'Ada'
+        assert bot.thread is not threading.main_thread()
+    asyncio.run(scenario())
@@ -0,0 +1,102 @@
+import pickle
+import time
+
+import numpy as np
+import pytest
+
+from shm_capture import SharedRing, SharedRecorder, SharedCamera, CaptureSupervisor
+
+@pytest.fixture
+def make_ring():
+    rings = []
+    def make(slot_shape = (4,), dtype = np.int16, num_slots = 4):
+        rings.append(SharedRing(slot_shape, dtype, num_slots))
+        return rings[-1]
+    yield make
+    for ring in rings:
+        ring.close()
+
+def test_ring_reads_back_what_was_written(make_ring):
+    ring = make_ring()
+    assert ring.write_seq == 0 and ring.read(1) is None
+    ring.write(np.arange(4))
+    ring.write(np.arange(4) + 10)
+
+    assert ring.write_seq == 2
+    assert ring.read(1).tolist() == [0, 1, 2, 3]
+    view = ring.view(2)
+    assert view.tolist() == [10, 11, 12, 13] and not view.flags.writeable
+    assert ring.age(2) < 1
+
+def test_ring_overwrites_the_oldest_items(make_ring):
+    ring = make_ring()
+    for value in range(1, 7):
+        ring.write(np.full(4, value))
+
+    #Items 1 and 2 were overwritten by 5 and 6
+    assert ring.read(1) is None and not ring.valid(2)
+    assert [ring.read(seq)[0] for seq in range(3, 7)] == [3, 4, 5, 6]
+
+def test_ring_attaches_to_the_same_memory_when_passed_on(make_ring):
+    ring = make_ring()
+    attached = pickle.loads(pickle.dumps(ring))
+    try:
+        ring.write(np.full(4, 7))
+        ring.request_stop()
+        assert attached.write_seq == 1 and attached.read(1).tolist() == [7] * 4
+        assert attached.stopping
+    finally:
+        attached.close()
+
+def test_recorder_reads_every_frame_from_where_it_started(make_ring):
+    ring = make_ring()
+    ring.write(np.full(4, 1))
+    recorder = SharedRecorder(ring)
+    recorder.start()
+    ring.write(np.full(4, 2))
+    ring.write(np.full(4, 3))
+
+    assert recorder.read()[0] == 2 and recorder.read()[0] == 3
+    assert recorder.overruns == 0
+
+def test_recorder_skips_frames_it_fell_too_far_behind_on(make_ring):
+    ring = make_ring()
+    recorder = SharedRecorder(ring)
+    recorder.start()
+    for value in range(1, 11):
+        ring.write(np.full(4, value))
+
+    #Only the newest frames are left, less a slot the writer may be filling
+    assert recorder.read()[0] == 8
+    assert recorder.overruns == 7
+    assert [recorder.read()[0] for _ in range(2)] == [9, 10]
+    assert recorder.overruns == 7
+
+def test_camera_refuses_frames_older_than_max_age(make_ring):
+    pytest.importorskip('pvporcupine')
+    pytest.importorskip('pvrecorder')
+    ring = make_ring((32, 32, 3), np.uint8)
+    camera = SharedCamera(ring)
+    ring.write(np.full((32, 32, 3), 100, dtype=np.uint8))
+    assert camera.capture(max_age = 1.0, timeout = 0.1).shape == (32, 32, 3)
+
+    time.sleep(0.1)
+    start = time.monotonic()
+    with pytest.raises(Exception, match='Could not capture photo'):
+        camera.capture(max_age = 0.05, timeout = 0.2)
+    #Waited for a fresh frame before giving up
+    assert time.monotonic() - start >= 0.2
+
+def test_capture_process_stops_when_asked():
+    supervisor = CaptureSupervisor(check_interval = 60)
+    #No such camera, so the capture process keeps retrying until it is stopped
+    camera = supervisor.camera(device_id = 99, width = 8, height = 8, reconnect_seconds = 0.05)
+    capture = supervisor._captures[('camera', 99)]
+    started = camera._ring.heartbeat
+    deadline = time.monotonic() + 20
+    while camera._ring.heartbeat == started and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    assert capture.alive and not camera.connected
+    supervisor.stop()
+    assert capture.exitcode == 0
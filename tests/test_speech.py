@@ -0,0 +1,68 @@
+import numpy as np
+
+import speech
+from speech import SpeechManager, TTSCache, splice_pcm, template_segments
+
+def test_template_segments_keep_whole_fields():
+    assert template_segments("Welcome back, {name}!") == [(False, 'Welcome back,'), (True, '{name}')]
+    assert template_segments("Hi {guest.name!s:>3}, {guests[0]}.") == [
+        (False, 'Hi'), (True, '{guest.name!s:>3}'), (True, '{guests[0]}')]
+
+def tone(seconds, amplitude = 5000, sample_rate = 16_000):
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    return (amplitude * np.sin(2 * np.pi * 300 * t)).astype(np.int16)
+
+def test_splice_trims_silence_and_crossfades():
+    silence = np.zeros(8000, dtype=np.int16)
+    first = np.concatenate([silence, tone(0.5), silence]).tobytes()
+    second = tone(0.25).tobytes()
+    spliced = np.frombuffer(splice_pcm([first, second]), dtype=np.int16)
+
+    #Half a second of silence at each side of the first segment is cut down to 60 ms, and the joint overlaps by 20 ms
+    keep, fade = int(0.06 * 16_000), int(0.02 * 16_000)
+    assert abs(len(spliced) - (2 * keep + 8000 + 4000 - fade)) < 20
+    assert np.abs(spliced).max() <= 5000
+
+class Guest:
+    name = 'Ada'
+
+class FakeCacheSpeech(SpeechManager):
+    """SpeechManager with a local cache and no Azure or audio device."""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._speaker = True
+        self._voice = 'voice'
+        self._output_format = 'format'
+        self._interrupted = speech.Event()
+        self.played = []
+        self.synthesized = []
+
+    def play_audio(self, audio):
+        self.played.append(bytes(audio))
+
+    def azure_speech_synthesis(self, text):
+        self.synthesized.append(text)
+        return tone(0.2).tobytes()
+
+    def prewarm_in_background(self, texts):
+        self.prewarm(texts)
+
+def test_speak_template_splices_cached_segments_with_attribute_fields(tmp_path):
+    manager = FakeCacheSpeech(TTSCache(str(tmp_path)))
+    manager.prewarm(['Welcome back,', 'Ada'])
+    manager.synthesized.clear()
+
+    manager.speak_template("Welcome back, {guest.name}!", guest = Guest())
+    assert manager.synthesized == []
+    assert len(manager.played) == 1
+
+def test_speak_template_caches_missing_segments(tmp_path):
+    manager = FakeCacheSpeech(TTSCache(str(tmp_path)))
+    manager.speak_template("Welcome back, {name}!", name = 'Ada')
+    #The whole sentence is synthesized now, and its parts for next time
+    assert manager.synthesized == ['Welcome back,', 'Ada', 'Welcome back, Ada!']
+
+    manager.synthesized.clear()
+    manager.speak_template("Welcome back, {name}!", name = 'Ada')
+    assert manager.synthesized == []
@@ -0,0 +1,53 @@
+import sys
+from threading import Event
+from types import SimpleNamespace
+
+import pytest
+
+from startup import StartupProfiler, Subsystem, LazyModule
+
+def test_subsystem_waits_only_when_used_before_it_loaded():
+    profiler = StartupProfiler()
+    release = Event()
+    def load():
+        release.wait()
+        return SimpleNamespace(greeting = 'hello')
+    subsystem = Subsystem('speech', load, profiler = profiler).start()
+
+    assert not subsystem.ready and profiler.readiness()['speech']['state'] == 'loading'
+    with pytest.raises(TimeoutError):
+        subsystem.get(timeout = 0.01)
+    release.set()
+    #Used like the object itself once it has loaded
+    assert subsystem.greeting == 'hello'
+    assert subsystem.ready and profiler.readiness()['speech']['state'] == 'ready'
+    assert [phase[:2] for phase in profiler.phases] == [('speech', 'subsystem')]
+
+def test_failed_subsystem_reports_its_error():
+    profiler = StartupProfiler()
+    def load():
+        raise OSError('no camera')
+    subsystem = Subsystem('camera', load, profiler = profiler).start(background = False)
+
+    assert subsystem.state == 'failed' and not subsystem.ready
+    with pytest.raises(RuntimeError):
+        subsystem.capture
+
+def test_time_to_listen_counts_once_against_the_target():
+    profiler = StartupProfiler(target_seconds = 60)
+    assert profiler.met_target() is None
+    profiler.listening()
+    first = profiler.time_to_listen
+    profiler.listening()
+    assert profiler.time_to_listen == first and profiler.met_target()
+
+    late = StartupProfiler(target_seconds = 0)
+    late.listening()
+    assert late.met_target() is False
+
+def test_lazy_module_imports_on_first_use():
+    sys.modules.pop('colorsys', None)
+    module = LazyModule('colorsys')
+    assert 'colorsys' not in sys.modules
+    assert module.rgb_to_hsv(1, 0, 0) == (0, 1, 1)
+    assert 'colorsys' in sys.modules
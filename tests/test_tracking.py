@@ -0,0 +1,75 @@
+import numpy as np
+
+from face_gate import FaceObservation
+from tracking import IdentityTracker, iou
+
+ADA = ({'id': 1, 'name': 'Ada'}, 0.9)
+ADA_FACE = np.array([1, 0, 0], dtype=np.float32)
+GRACE_FACE = np.array([0, 1, 0], dtype=np.float32)
+
+def face(x, y = 100, size = 100):
+    return FaceObservation((x, y, size, size), 640)
+
+def test_iou():
+    assert iou((0, 0, 10, 10), (0, 0, 10, 10)) == 1
+    assert iou((0, 0, 10, 10), (5, 0, 10, 10)) == 50 / 150
+    assert iou((0, 0, 10, 10), (20, 0, 10, 10)) == 0
+
+def test_identity_is_answered_only_for_the_same_face():
+    tracker = IdentityTracker()
+    tracker.update([face(100)], now = 0)
+    tracker.resolve(face(100), ADA, ADA_FACE, now = 0)
+
+    tracker.update([face(110)], now = 0.2)
+    assert tracker.lookup(face(110), ADA_FACE * 2, now = 0.4) == ADA
+    #Someone else in the same spot is not taken for Ada, and the identity is dropped
+    assert tracker.lookup(face(110), GRACE_FACE, now = 0.6) is None
+    assert tracker.lookup(face(110), ADA_FACE, now = 0.8) is None
+
+def test_identity_expires():
+    tracker = IdentityTracker(ttl_seconds = 5)
+    tracker.resolve(face(100), ADA, ADA_FACE, now = 0)
+    for now in np.arange(0.5, 4.5, 0.5):
+        tracker.update([face(100)], now = now)
+    assert tracker.lookup(face(100), ADA_FACE, now = 4.5) == ADA
+    tracker.update([face(100)], now = 5)
+    tracker.update([face(100)], now = 5.5)
+    assert tracker.lookup(face(100), ADA_FACE, now = 5.5) is None
+
+def test_face_leaving_drops_its_track():
+    tracker = IdentityTracker(leave_seconds = 1)
+    tracker.resolve(face(100), ADA, ADA_FACE, now = 0)
+    tracker.update([], now = 2)
+    assert tracker.lookup(face(100), ADA_FACE, now = 2) is None
+
+def test_jump_between_updates_drops_the_identity():
+    tracker = IdentityTracker()
+    tracker.resolve(face(100), ADA, ADA_FACE, now = 0)
+    #Still overlapping enough to continue the track, but the face grew too much to be the same person
+    tracks = tracker.update([face(100, size = 140)], now = 0.2)
+    assert tracks[0].identity is None
+
+    tracker.resolve(face(100), ADA, ADA_FACE, now = 0.4)
+    tracks = tracker.update([face(105)], now = 0.6)
+    assert tracks[0].identity == ADA
+
+def test_invalidate_forgets_every_identity():
+    tracker = IdentityTracker()
+    tracker.resolve(face(100), ADA, ADA_FACE, now = 0)
+    tracker.invalidate()
+    assert tracker.lookup(face(100), ADA_FACE, now = 0.1) is None
+
+def test_tracked_face_is_answered_without_its_embedding_until_it_is_due_a_check():
+    tracker = IdentityTracker(verify_seconds = 2)
+    tracker.resolve(face(100), ADA, ADA_FACE, now = 0)
+    tracker.update([face(105)], now = 0.5)
+    assert tracker.lookup(face(105), now = 1) == ADA
+    #Grown too much since the camera last saw it, the embedding has to decide
+    assert tracker.lookup(face(105, size = 130), now = 1) is None
+
+    tracker.update([face(105)], now = 1.5)
+    tracker.update([face(105)], now = 2.5)
+    assert tracker.lookup(face(105), now = 2.5) is None
+    #A matching embedding renews the check
+    assert tracker.lookup(face(105), ADA_FACE, now = 2.5) == ADA
+    assert tracker.lookup(face(105), now = 2.6) == ADA
@@ -0,0 +1,51 @@
+import json
+import os
+
+from speech import TTSCache
+
+def pcm(value, num_samples = 100):
+    return bytes([value]) * (2 * num_samples)
+
+def test_get_returns_what_was_put(tmp_path):
+    cache = TTSCache(str(tmp_path), max_entries = 4)
+    cache.put('a', pcm(1))
+    assert bytes(cache.get('a')) == pcm(1)
+    assert cache.get('missing') is None
+
+def test_least_recently_used_is_evicted(tmp_path):
+    cache = TTSCache(str(tmp_path), max_entries = 2)
+    cache.put('a', pcm(1))
+    cache.put('b', pcm(2))
+    cache.get('a')
+    cache.put('c', pcm(3))
+    assert 'a' in cache and 'c' in cache and 'b' not in cache
+    assert not os.path.exists(tmp_path / 'b.pcm')
+
+def test_evicting_an_entry_still_in_use(tmp_path):
+    cache = TTSCache(str(tmp_path), max_entries = 2)
+    cache.put('a', pcm(1))
+    cache.put('b', pcm(2))
+    view = cache.get('a')
+    cache.put('c', pcm(3))
+    cache.put('d', pcm(4))
+
+    #The evicted audio stays readable for as long as it is held
+    assert bytes(view) == pcm(1)
+    assert not os.path.exists(tmp_path / 'a.pcm')
+    with open(tmp_path / 'index.json') as f:
+        assert sorted(json.load(f)) == ['c', 'd']
+    view.release()
+
+def test_byte_limit(tmp_path):
+    cache = TTSCache(str(tmp_path), max_entries = 10, max_bytes = 500)
+    for key in 'abc':
+        cache.put(key, pcm(1))
+    assert cache.total_bytes <= 500
+
+def test_index_survives_restart_and_orphans_are_removed(tmp_path):
+    cache = TTSCache(str(tmp_path))
+    cache.put('a', pcm(1))
+    (tmp_path / 'orphan.pcm').write_bytes(pcm(2))
+    reopened = TTSCache(str(tmp_path))
+    assert bytes(reopened.get('a')) == pcm(1)
+    assert not os.path.exists(tmp_path / 'orphan.pcm')
@@ -0,0 +1,66 @@
+import numpy as np
+
+from vad import NoiseFloor, EnergyFluxVAD, Endpointer
+
+FRAME_LENGTH = 512
+
+def noise(num_frames, level = 30, seed = 0):
+    rng = np.random.default_rng(seed)
+    return (rng.normal(0, level, (num_frames, FRAME_LENGTH))).astype(np.int16)
+
+def speech(num_frames, seed = 1):
+    rng = np.random.default_rng(seed)
+    t = np.arange(num_frames * FRAME_LENGTH) / 16_000
+    #A rising tone with a syllable rate envelope, loud and changing like speech
+    tone = 3000 * np.sin(2 * np.pi * (200 + 300 * t) * t) * (0.6 + 0.4 * np.sin(2 * np.pi * 4 * t))
+    return (tone + rng.normal(0, 30, len(t))).astype(np.int16).reshape(num_frames, FRAME_LENGTH)
+
+def test_noise_floor_ignores_digital_silence():
+    floor = NoiseFloor(initial_db = 40.0)
+    floor.update(-60.0)
+    assert floor.db == 40.0
+
+def test_noise_floor_falls_fast_and_rises_slowly():
+    floor = NoiseFloor(initial_db = 40.0)
+    for _ in range(10):
+        floor.update(20.0)
+    assert floor.db < 21.0
+    for _ in range(10):
+        floor.update(40.0)
+    assert 21.0 < floor.db < 35.0
+
+def test_noise_floor_tracks_channels_independently():
+    floor = NoiseFloor(initial_db = np.full(2, 30.0))
+    floor.update(np.array([20.0, -60.0]))
+    assert floor.db[0] < 30.0 and floor.db[1] == 30.0
+
+def test_flux_is_seeded_from_several_frames():
+    vad = EnergyFluxVAD()
+    vad.process(noise(1))
+    assert vad.noise_flux is None
+    vad.process(noise(5))
+    assert vad.noise_flux > 0
+
+def test_silent_frame_does_not_break_endpointing():
+    endpointer = Endpointer()
+    endpointer.observe(noise(100))
+    endpointer.observe(np.zeros((1, FRAME_LENGTH), dtype=np.int16))
+    endpointer.observe(noise(100, seed = 2))
+
+    endpointer.reset()
+    frames = np.concatenate([speech(30), noise(300, seed = 3)])
+    for frame in frames:
+        if endpointer.update(frame):
+            break
+    assert endpointer.ended and endpointer.speech_detected
+    assert endpointer.total_seconds < 3.0
+
+def test_noise_alone_times_out_without_speech():
+    endpointer = Endpointer(no_speech_timeout = 1)
+    endpointer.observe(noise(50))
+    endpointer.reset()
+    for frame in noise(100, seed = 4):
+        if endpointer.update(frame):
+            break
+    assert not endpointer.speech_detected
+    assert endpointer.total_seconds < 1.1
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+import voice_id
+from voice_id import VoiceIdentifier, speaker_embedding
+
+def unit(*values):
+    vector = np.array(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+@pytest.fixture
+def identifier(tmp_path, monkeypatch):
+    #Voice prints are given directly, so each test controls the similarities
+    monkeypatch.setattr(voice_id, 'speaker_embedding', lambda audio, sample_rate: audio)
+    return VoiceIdentifier(str(tmp_path / 'voices.npy'))
+
+def test_single_guest_needs_a_near_certain_match(identifier):
+    identifier.enroll(1, unit(1, 0, 0))
+    #Clears the match threshold, but with nobody to lead there's no margin to check
+    assert identifier.identify(unit(1, 0.45, 0)) is None
+    guest_id, score = identifier.identify(unit(1, 0.1, 0))
+    assert guest_id == 1 and score > 0.97
+
+def test_match_needs_a_lead_over_other_guests(identifier):
+    identifier.enroll(1, unit(1, 0, 0))
+    identifier.enroll(2, unit(1, 0.05, 0))
+    assert identifier.identify(unit(1, 0.02, 0)) is None
+
+    identifier.enroll(3, unit(0, 0, 1))
+    identifier.enroll(4, unit(0, -1, 0))
+    assert identifier.identify(unit(0, 0.1, 1))[0] == 3
+
+def test_dissimilar_guests_still_count_as_runners_up(identifier):
+    identifier.enroll(1, unit(1, 0, 0))
+    identifier.enroll(1, unit(1, 0.1, 0))
+    identifier.enroll(2, unit(-1, 0, 0))
+    #Guest 2 scores below zero, but is still another guest, so the single guest threshold doesn't apply
+    guest_id, score = identifier.identify(unit(1, 0.4, 0))
+    assert guest_id == 1 and score < 0.97
+
+def test_speaker_embedding_needs_speech():
+    t = np.arange(16_000) / 16_000
+    voice = (8000 * np.sin(2 * np.pi * 180 * t) * (1 + np.sin(2 * np.pi * 3 * t))).astype(np.int16)
+    assert speaker_embedding(voice).shape == (38,)
+    assert speaker_embedding(np.zeros(100, dtype=np.int16)) is None
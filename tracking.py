@@ -0,0 +1,183 @@
+import time
+import itertools
+from threading import Lock
+
+import numpy as np
+
+from metrics import METRICS
+
+def iou(box, other):
+    """Intersection over union of two (x, y, width, height) boxes."""
+    x, y, w, h = box
+    other_x, other_y, other_w, other_h = other
+    overlap_w = max(0, min(x + w, other_x + other_w) - max(x, other_x))
+    overlap_h = max(0, min(y + h, other_y + other_h) - max(y, other_y))
+    overlap = overlap_w * overlap_h
+    union = w * h + other_w * other_h - overlap
+    return overlap / union if union > 0 else 0.0
+
+class Track:
+    """One face followed across frames, and who it was recognized as."""
+
+    def __init__(self, track_id, box, now):
+        self.id = track_id
+        self.box = box
+        self.first_seen = now
+        self.last_seen = now
+        self.identity = None
+        self.identity_time = None
+        self.verified_time = None
+        self.embedding = None
+
+class IdentityTracker:
+    """
+    Follows faces across camera frames and remembers who each one was
+    recognized as, so repeated questions about the same visitor are
+    answered without running the face model. A face which stayed in view
+    without its box jumping is answered from memory for `verify_seconds`
+    after its embedding last matched; after that its embedding is checked
+    again before the identity is trusted. Faces are associated by box
+    overlap (IoU), or by embedding similarity when one is at hand. An
+    identity is forgotten after `ttl_seconds`, as soon as its face leaves
+    the camera's view, or when its box jumps, since that is more likely
+    someone else stepping in.
+    """
+
+    def __init__(self, ttl_seconds = 60.0, leave_seconds = 1.0, iou_threshold = 0.3, similarity_threshold = 0.85,
+                 max_shift = 0.5, max_scale = 1.5, verify_seconds = 10.0):
+        """
+        Constructor.
+        :param ttl_seconds: How long a recognized identity is trusted.
+        :param leave_seconds: A face not seen for this long has left, and its track and identity are dropped.
+        :param iou_threshold: Least box overlap for a face to continue a track.
+        :param similarity_threshold: Least cosine similarity for a face embedding to continue a track, or to be
+        answered with the track's identity.
+        :param max_shift: Most a face's centre may move between two updates, as a fraction of its width, before its
+        identity is dropped.
+        :param max_scale: Most a face's area may grow or shrink by between two updates before its identity is dropped.
+        :param verify_seconds: How long an identity is answered without checking the face's embedding again.
+        """
+        self._ttl_seconds = ttl_seconds
+        self._leave_seconds = leave_seconds
+        self._iou_threshold = iou_threshold
+        self._similarity_threshold = similarity_threshold
+        self._max_shift = max_shift
+        self._max_scale = max_scale
+        self._verify_seconds = verify_seconds
+
+        self._tracks = []
+        self._track_ids = itertools.count(1)
+        #The camera watcher updates tracks while command handlers look them up
+        self._lock = Lock()
+
+    def _expire(self, now):
+        left = [track for track in self._tracks if now - track.last_seen > self._leave_seconds]
+        if left:
+            METRICS.counter('tracks_left').inc(len(left))
+            self._tracks = [track for track in self._tracks if now - track.last_seen <= self._leave_seconds]
+
+    def _associate(self, box, embedding = None, exclude = ()):
+        """Return the live track a face belongs to, or None."""
+        candidates = [track for track in self._tracks if track not in exclude]
+        if not candidates:
+            return None
+        overlaps = [iou(box, track.box) for track in candidates]
+        best = int(np.argmax(overlaps))
+        if overlaps[best] >= self._iou_threshold:
+            return candidates[best]
+
+        if embedding is not None:
+            embedding = self._normalize(embedding)
+            for track in candidates:
+                if track.embedding is not None and float(track.embedding @ embedding) >= self._similarity_threshold:
+                    return track
+        return None
+
+    @staticmethod
+    def _normalize(embedding):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        return embedding / max(float(np.linalg.norm(embedding)), 1e-12)
+
+    def _jumped(self, box, other):
+        """Whether a face moved or changed size too much between two boxes to surely be the same person."""
+        x, y, w, h = box
+        other_x, other_y, other_w, other_h = other
+        shift = np.hypot(x + w / 2 - other_x - other_w / 2, y + h / 2 - other_y - other_h / 2)
+        scale = (w * h) / max(other_w * other_h, 1)
+        return shift > self._max_shift * max(w, other_w) or not 1 / self._max_scale <= scale <= self._max_scale
+
+    def _forget(self, track):
+        track.identity = track.identity_time = track.verified_time = track.embedding = None
+
+    def update(self, observations, now = None):
+        """Feed the faces seen in one frame (FaceObservations, possibly none). Returns their tracks."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._expire(now)
+            tracks = []
+            for observation in observations:
+                track = self._associate(observation.box, exclude = tracks)
+                if track is None:
+                    track = Track(next(self._track_ids), observation.box, now)
+                    self._tracks.append(track)
+                elif track.identity is not None and self._jumped(observation.box, track.box):
+                    METRICS.counter('track_identity_jumps').inc()
+                    self._forget(track)
+                track.box = observation.box
+                track.last_seen = now
+                tracks.append(track)
+            return tracks
+
+    def _fresh_identity(self, track, now):
+        if track is None or track.identity is None or now - track.identity_time > self._ttl_seconds:
+            return None
+        return track.identity
+
+    def lookup(self, observation, embedding = None, now = None):
+        """
+        Return the cached (guest, score) of the track a face belongs to, or
+        None. Without the face's embedding, only an identity checked within
+        `verify_seconds` is answered. With it, the embedding must still match
+        the one the identity was recognized from, otherwise the identity is dropped.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._expire(now)
+            track = self._associate(observation.box, embedding)
+            identity = self._fresh_identity(track, now)
+            if identity is not None and embedding is None:
+                #Without an embedding, only a face where the camera last saw it and checked recently will do
+                if self._jumped(observation.box, track.box) or now - track.verified_time > self._verify_seconds:
+                    identity = None
+            elif identity is not None:
+                similarity = float(track.embedding @ self._normalize(embedding)) if track.embedding is not None \
+                    else None
+                if similarity is None or similarity < self._similarity_threshold:
+                    METRICS.counter('identity_cache_rejects').inc()
+                    self._forget(track)
+                    identity = None
+                else:
+                    track.verified_time = now
+        METRICS.counter('identity_cache_hits' if identity is not None else 'identity_cache_misses').inc()
+        return identity
+
+    def resolve(self, observation, identity, embedding = None, now = None):
+        """Record who a face was recognized as. The face starts a track if it isn't tracked yet."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._expire(now)
+            track = self._associate(observation.box, embedding)
+            if track is None:
+                track = Track(next(self._track_ids), observation.box, now)
+                self._tracks.append(track)
+            track.box = observation.box
+            track.last_seen = now
+            track.identity = identity
+            track.identity_time = track.verified_time = now
+            track.embedding = self._normalize(embedding) if embedding is not None else None
+
+    def invalidate(self):
+        """Forget every identity, e.g. after guests were changed."""
+        with self._lock:
+            for track in self._tracks:
+                self._forget(track)
@@ -0,0 +1,267 @@
+import numpy as np
+
+try:
+    import webrtcvad #Optional WebRTC voice activity model
+except ImportError:
+    webrtcvad = None
+
+class VoiceActivityDetector:
+    """
+    Interface for voice activity detectors. Detectors consume int16 audio
+    frames in batches and decide which frames contain speech.
+    """
+
+    def __init__(self, sample_rate = 16_000):
+        self.sample_rate = sample_rate
+
+    def reset(self):
+        """Forget any state carried between frames."""
+
+    def process(self, frames):
+        """
+        Given a (num_frames, frame_length) int16 array, return a boolean
+        array marking the frames which contain speech.
+        """
+        raise NotImplementedError
+
+    def is_speech(self, frame):
+        """Convenience wrapper to classify a single frame."""
+        return bool(self.process(np.asarray(frame)[np.newaxis])[0])
+
+class NoiseFloor:
+    """
+    Running estimate of the background level in dB, one per channel if
+    `initial_db` is an array. It falls quickly when the room gets quieter and
+    rises slowly when it gets louder, slower still while speech is heard.
+    Levels below `min_db`, such as digital silence from a device that is
+    starting up or glitching, are ignored rather than pinning the floor.
+    """
+
+    def __init__(self, initial_db = 30.0, min_db = 0.0, fall_alpha = 0.7, rise_alpha = 0.95, speech_rise_alpha = 0.998):
+        """
+        Constructor.
+        :param initial_db: Starting estimate before any background audio is seen.
+        :param min_db: Levels below this are not real background and are ignored.
+        :param fall_alpha: Per-frame smoothing when a level is below the floor. Smaller falls faster.
+        :param rise_alpha: Per-frame smoothing when a background level is above the floor.
+        :param speech_rise_alpha: Per-frame smoothing when a level judged as speech is above the floor, so a floor
+        which ended up too low still recovers.
+        """
+        self.initial_db = initial_db
+        self.min_db = min_db
+        self.fall_alpha = fall_alpha
+        self.rise_alpha = rise_alpha
+        self.speech_rise_alpha = speech_rise_alpha
+        self.reset()
+
+    def reset(self):
+        self.db = np.array(self.initial_db, dtype=np.float64)
+
+    def update(self, levels_db, background = True):
+        """
+        Advance by one frame. `levels_db` holds one level per channel and
+        `background` marks which of them were judged to be background.
+        """
+        levels_db = np.asarray(levels_db, dtype=np.float64)
+        alpha = np.where(levels_db < self.db, self.fall_alpha,
+                         np.where(background, self.rise_alpha, self.speech_rise_alpha))
+        updated = alpha * self.db + (1 - alpha) * levels_db
+        self.db = np.where(levels_db >= self.min_db, updated, self.db)
+        return self.db
+
+class EnergyFluxVAD(VoiceActivityDetector):
+    """
+    Vectorized detector combining frame energy against an adaptive noise floor
+    with spectral flux, which rejects loud but stationary lobby noise.
+    """
+
+    def __init__(self,
+                 sample_rate = 16_000,
+                 energy_margin_db = 9.0,
+                 loud_margin_db = 18.0,
+                 flux_margin = 1.5,
+                 noise_alpha = 0.95,
+                 initial_noise_db = 30.0,
+                 min_noise_db = 0.0,
+                 flux_seed_frames = 10):
+        """
+        Constructor.
+        :param energy_margin_db: dB above the noise floor a frame must reach to be considered speech.
+        :param loud_margin_db: dB above the noise floor at which a frame is speech regardless of spectral flux.
+        :param flux_margin: Multiple of the background spectral flux a frame must reach to be considered speech.
+        :param noise_alpha: Per-frame smoothing of the noise floor estimates. Closer to 1 adapts more slowly.
+        :param initial_noise_db: Starting noise floor estimate before any background audio is seen.
+        :param min_noise_db: Frames quieter than this, e.g. digital silence, don't count as background.
+        :param flux_seed_frames: Number of frames the background spectral flux is first estimated from.
+        """
+        super(EnergyFluxVAD, self).__init__(sample_rate)
+
+        self.energy_margin_db = energy_margin_db
+        self.loud_margin_db = loud_margin_db
+        self.flux_margin = flux_margin
+        self.noise_alpha = noise_alpha
+        self.initial_noise_db = initial_noise_db
+        self.flux_seed_frames = flux_seed_frames
+
+        self.noise_floor = NoiseFloor(initial_noise_db, min_db = min_noise_db, rise_alpha = noise_alpha)
+        self._window = None
+        self.reset()
+
+    def reset(self):
+        self.noise_floor.reset()
+        self.noise_flux = None
+        self._flux_seed = []
+        self._prev_spectrum = None
+
+    @property
+    def noise_db(self):
+        return float(self.noise_floor.db)
+
+    def process(self, frames):
+        frames = np.atleast_2d(frames).astype(np.float32)
+        num_frames, frame_length = frames.shape
+        if num_frames == 0:
+            return np.zeros(0, dtype=bool)
+
+        if self._window is None or len(self._window) != frame_length:
+            self._window = np.hanning(frame_length).astype(np.float32)
+
+        #Energy of each frame in dB
+        energy_db = 10 * np.log10(np.mean(frames * frames, axis=1) + 1e-6)
+
+        #Normalized spectral flux between consecutive frames
+        spectrum = np.abs(np.fft.rfft(frames * self._window, axis=1))
+        first = 0
+        if self._prev_spectrum is None or len(self._prev_spectrum) != spectrum.shape[1]:
+            #The very first frame has nothing to compare against, so its flux of 0 is meaningless
+            self._prev_spectrum = spectrum[0]
+            first = 1
+        previous = np.vstack((self._prev_spectrum[np.newaxis], spectrum[:-1]))
+        flux = np.sum(np.maximum(spectrum - previous, 0), axis=1) / (np.sum(spectrum, axis=1) + 1e-6)
+        self._prev_spectrum = spectrum[-1]
+
+        #Estimate the background flux from the first few frames, robustly against a word among them
+        seeding = len(self._flux_seed) < self.flux_seed_frames
+        if seeding:
+            self._flux_seed.extend(flux[first:first + self.flux_seed_frames - len(self._flux_seed)].tolist())
+            if self._flux_seed:
+                self.noise_flux = float(np.median(self._flux_seed))
+
+        #The floor moves frame by frame, so each frame is judged against the floor before it
+        speech = np.empty(num_frames, dtype=bool)
+        for i in range(num_frames):
+            noise_db = float(self.noise_floor.db)
+            above_floor = energy_db[i] > noise_db + self.energy_margin_db
+            very_loud = energy_db[i] > noise_db + self.loud_margin_db
+            changing = self.noise_flux is not None and flux[i] > self.noise_flux * self.flux_margin
+            speech[i] = above_floor and (changing or very_loud)
+            self.noise_floor.update(energy_db[i], background = not speech[i])
+
+        #Update the background flux using the frames judged as background
+        quiet = ~speech
+        num_quiet = int(np.count_nonzero(quiet))
+        if num_quiet > 0 and not seeding:
+            weight = self.noise_alpha ** num_quiet
+            self.noise_flux = weight * self.noise_flux + (1 - weight) * float(np.mean(flux[quiet]))
+
+        return speech
+
+class WebRTCVAD(VoiceActivityDetector):
+    """Wrapper around the optional WebRTC voice activity model."""
+
+    SUB_FRAME_SECONDS = 0.01
+
+    def __init__(self, sample_rate = 16_000, aggressiveness = 2, min_speech_ratio = 0.5):
+        """
+        Constructor.
+        :param aggressiveness: WebRTC filtering mode from 0 (least aggressive) to 3 (most aggressive).
+        :param min_speech_ratio: Fraction of 10ms sub-frames which must be speech for a frame to be speech.
+        """
+        if webrtcvad is None:
+            raise ImportError("webrtcvad is not installed, use EnergyFluxVAD instead.")
+        super(WebRTCVAD, self).__init__(sample_rate)
+
+        self.min_speech_ratio = min_speech_ratio
+        self._vad = webrtcvad.Vad(aggressiveness)
+        self._sub_frame_length = int(sample_rate * self.SUB_FRAME_SECONDS)
+
+    def process(self, frames):
+        frames = np.atleast_2d(frames).astype(np.int16, copy=False)
+        num_sub_frames = frames.shape[1] // self._sub_frame_length
+
+        #WebRTC only accepts 10/20/30ms frames, so split each frame into 10ms pieces
+        sub_frames = frames[:, :num_sub_frames * self._sub_frame_length].reshape(
+            frames.shape[0], num_sub_frames, self._sub_frame_length)
+        votes = np.array([[self._vad.is_speech(sub.tobytes(), self.sample_rate) for sub in frame]
+                          for frame in sub_frames], dtype=bool).reshape(frames.shape[0], num_sub_frames)
+
+        return votes.mean(axis=1) >= self.min_speech_ratio
+
+class Endpointer:
+    """Decides when a spoken utterance has ended from voice activity decisions."""
+
+    def __init__(self,
+                 vad = None,
+                 sample_rate = 16_000,
+                 hangover_seconds = 0.6,
+                 min_speech_seconds = 0.15,
+                 no_speech_timeout = 4,
+                 max_seconds = 10):
+        """
+        Constructor.
+        :param vad: VoiceActivityDetector to use. Defaults to an EnergyFluxVAD.
+        :param hangover_seconds: Seconds of trailing silence after speech which end the utterance.
+        :param min_speech_seconds: Seconds of speech needed before trailing silence can end the utterance.
+        :param no_speech_timeout: Seconds to wait for speech to start before giving up.
+        :param max_seconds: Maximum length of an utterance.
+        """
+        self.vad = vad if vad is not None else EnergyFluxVAD(sample_rate)
+        self.sample_rate = sample_rate
+        self.hangover_seconds = hangover_seconds
+        self.min_speech_seconds = min_speech_seconds
+        self.no_speech_timeout = no_speech_timeout
+        self.max_seconds = max_seconds
+
+        self.reset()
+
+    def reset(self):
+        """Start a new utterance. The VAD's noise floor is kept."""
+        self.total_seconds = 0
+        self.speech_seconds = 0
+        self.seconds_silent = 0
+        self.ended = False
+
+    @property
+    def speech_detected(self):
+        return self.speech_seconds >= self.min_speech_seconds
+
+    def observe(self, frames):
+        """Feed background audio while idle, so the VAD can track the noise floor."""
+        self.vad.process(np.atleast_2d(frames))
+
+    def update(self, frames):
+        """
+        Feed one frame or a batch of frames of the utterance.
+        Returns True once the end of the utterance has been reached.
+        """
+        frames = np.atleast_2d(frames)
+        seconds_per_frame = frames.shape[1] / self.sample_rate
+
+        for is_speech in self.vad.process(frames):
+            if self.ended:
+                break
+            self.total_seconds += seconds_per_frame
+
+            if is_speech:
+                self.speech_seconds += seconds_per_frame
+                self.seconds_silent = 0
+            else:
+                self.seconds_silent += seconds_per_frame
+
+            if self.speech_detected:
+                self.ended = self.seconds_silent >= self.hangover_seconds
+            else:
+                self.ended = self.total_seconds >= self.no_speech_timeout
+            self.ended = self.ended or self.total_seconds >= self.max_seconds
+
+        return self.ended
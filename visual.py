@@ -1,9 +1,16 @@
 import os
+import time
+from collections import deque
+from threading import Thread, Lock, Event
+
 import cv2
-import json
+import numpy as np
 
-from audio import write_audio
-from deepface import DeepFace #Facial Recognition
+from audio_writer import default_writer
+from embedding_index import EmbeddingIndex
+from guest_store import GuestStore
+from voice_id import VoiceIdentifier
+from metrics import span
 
 def write_photo(file_name, frame):
     """Write a frame to a new filename"""
@@ -11,7 +18,7 @@ def write_photo(file_name, frame):
 
 def capture_face(device_id = None):
     """Open a camera device and capture a photo"""
-    cap = cv2.VideoCapture()
+    cap = cv2.VideoCapture(device_id if device_id is not None else 0)
 
     if cap.isOpened():
         ret, frame = cap.read()
@@ -22,40 +29,287 @@ def capture_face(device_id = None):
             print("Frame was not returned")
     raise Exception("Could not capture photo.")
 
+def score_frames(frames, downscale = 4):
+    """
+    Score how usable each BGR frame is, higher is better. Sharpness is the
+    variance of the Laplacian, weighted by how well exposed the frame is.
+    All frames are scored together on downscaled grayscale copies. Frames
+    whose resolution differs from the last one's, e.g. from before the
+    camera reconnected, score 0.
+    """
+    scores = np.zeros(len(frames), dtype=np.float32)
+    same = [i for i, frame in enumerate(frames) if frame.shape == frames[-1].shape]
+    gray = np.stack([cv2.cvtColor(frames[i], cv2.COLOR_BGR2GRAY)[::downscale, ::downscale] for i in same])
+    gray = gray.astype(np.float32)
+
+    #4-neighbour Laplacian of every frame at once
+    laplacian = (gray[:, :-2, 1:-1] + gray[:, 2:, 1:-1] + gray[:, 1:-1, :-2] + gray[:, 1:-1, 2:]
+                 - 4 * gray[:, 1:-1, 1:-1])
+    sharpness = laplacian.var(axis=(1, 2))
+
+    #Penalize frames which are too dark/bright on average or have many clipped pixels
+    brightness = gray.mean(axis=(1, 2))
+    clipped = ((gray < 8) | (gray > 247)).mean(axis=(1, 2))
+    exposure = np.clip(1 - np.abs(brightness - 128) / 128 - clipped, 0.05, 1)
+
+    scores[same] = sharpness / max(float(sharpness.max()), 1e-6) * exposure
+    return scores
+
+class CameraService:
+    """
+    Long-lived camera session. A background thread keeps grabbing frames into
+    a small ring of the most recent ones, so a capture is instant and can pick
+    the best of them. The device is reopened automatically if it drops out.
+    """
+
+    def __init__(self, device_id = None, width = 1280, height = 720, fps = 30, ring_size = 8,
+                 reconnect_seconds = 1.0):
+        """
+        Constructor.
+        :param device_id: OpenCV camera index. Defaults to the first camera.
+        :param width: Requested frame width.
+        :param height: Requested frame height.
+        :param fps: Requested frames per second.
+        :param ring_size: Number of most recent frames kept to choose captures from.
+        :param reconnect_seconds: Delay between attempts to reopen the device after a failure.
+        """
+        self._device_id = device_id if device_id is not None else 0
+        self._width = width
+        self._height = height
+        self._fps = fps
+        self._reconnect_seconds = reconnect_seconds
+
+        self._frames = deque(maxlen=ring_size)
+        self._lock = Lock()
+        self._frame_ready = Event()
+        self._running = False
+        self._thread = None
+
+        self.connected = False
+        self.reconnects = 0
+
+    def start(self):
+        """Start grabbing frames in the background."""
+        if not self._running:
+            self._running = True
+            self._thread = Thread(target=self._grab_loop, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+
+    def _open(self):
+        cap = cv2.VideoCapture(self._device_id)
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, self._width)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self._height)
+        cap.set(cv2.CAP_PROP_FPS, self._fps)
+        #Only keep the newest frame in the driver, the ring does the buffering
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        return cap
+
+    def _grab_loop(self):
+        cap = None
+        while self._running:
+            if cap is None or not cap.isOpened():
+                cap = self._open()
+                if not cap.isOpened():
+                    print(f"[Camera] Could not open device {self._device_id}, retrying...")
+                    self.connected = False
+                    time.sleep(self._reconnect_seconds)
+                    continue
+                self.connected = True
+
+            ret, frame = cap.read()
+            if not ret or frame is None:
+                print("[Camera] Lost device, reconnecting...")
+                cap.release()
+                cap = None
+                self.connected = False
+                self.reconnects += 1
+                time.sleep(self._reconnect_seconds)
+                continue
+
+            with self._lock:
+                self._frames.append((time.monotonic(), frame))
+            self._frame_ready.set()
+
+        if cap is not None:
+            cap.release()
+
+    def latest(self, max_age = 0.5):
+        """Return the recent frames which are at most `max_age` seconds old, oldest first."""
+        now = time.monotonic()
+        with self._lock:
+            return [frame for timestamp, frame in self._frames if now - timestamp <= max_age]
+
+    def capture(self, max_age = 0.5, timeout = 3.0):
+        """Return the sharpest, best exposed of the most recent frames."""
+        with span('camera_capture'):
+            return self._capture(max_age, timeout)
+
+    def _capture(self, max_age, timeout):
+        #Only a recent frame will do, an old one may show whoever stood there before the camera dropped out
+        deadline = time.monotonic() + timeout
+        frames = self.latest(max_age)
+        while len(frames) == 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise Exception("Could not capture photo.")
+            self._frame_ready.clear()
+            self._frame_ready.wait(min(remaining, max_age))
+            frames = self.latest(max_age)
+        return frames[int(np.argmax(score_frames(frames)))]
+
 class GuestManager:
     """Manages the captured faces and names of stored guests."""
 
-    def __init__(self, guest_log_file_name = 'data/guest_log.json'):
-        self._guest_log_file_name = guest_log_file_name
+    def __init__(self, face_service, guest_db_file_name = 'data/guests.db',
+                 legacy_guest_log_file_name = 'data/guest_log.json', match_threshold = 0.7, face_gate = None,
+                 tracker = None, embed_timeout = 120.0):
+        """
+        Constructor.
+        :param face_service: FaceService computing the embeddings.
+        :param guest_db_file_name: Guest database, the face index is kept next to it.
+        :param legacy_guest_log_file_name: Old guest_log.json imported into an empty database.
+        :param match_threshold: Least cosine similarity for a face to be recognized.
+        :param face_gate: Optional FaceGate. Frames without an acceptable face are then rejected before embedding,
+        and only a tight crop of the face is embedded.
+        :param tracker: Optional IdentityTracker. Needs a face gate; faces it already knows are recognized from memory.
+        :param embed_timeout: Seconds to wait for an embedding, which includes the face models loading, before the
+        command fails with a TimeoutError.
+        """
+        self._face_service = face_service
+        self._embed_timeout = embed_timeout
+        self._match_threshold = match_threshold
+        self._face_gate = face_gate
+        self._tracker = tracker if face_gate is not None else None
 
-        with open(self._guest_log_file_name, 'r', encoding='utf-8') as f:
-            self.guests = json.load(f)
-        
-        print("Loaded Guests:", self.guests)
+        #Guests are looked up from the store on demand instead of being loaded up front
+        self.store = GuestStore(guest_db_file_name, legacy_log_file_name = legacy_guest_log_file_name)
+        print("Guests stored:", len(self.store))
+        #Retention keeps the name recordings within limits, but never deletes those of stored guests
+        default_writer().protect('data/names', self.store.file_names)
+
+        #Face embeddings are computed once at enrollment and kept next to the guest store
+        self.face_index = EmbeddingIndex(
+            os.path.join(os.path.dirname(guest_db_file_name), 'face_embeddings.npy'), model = face_service.model_name)
+
+        #Voice prints too, so returning guests can be recognized from the wake word alone
+        self.voice_id = VoiceIdentifier(os.path.join(os.path.dirname(guest_db_file_name), 'voice_embeddings.npy'))
+        added = self.voice_id.enroll_missing(self.store)
+        if added > 0:
+            print("Voice prints added from stored name recordings:", added)
         
-    def add_guest(self, face_frame, name_audio, name, sample_rate = 16_000):
+    def add_guest(self, face_frame, name_audio, name, sample_rate = 16_000, voice_audio = None):
         """
         Given the data for a new guest, add them to the system and 
-        save corresponding data.
+        save corresponding data. Returns the new guest's id.
+        `voice_audio` is an optional further recording of the guest, e.g.
+        their wake phrase, added to their voice prints.
         """
-        guest_id = len(self.guests)
+        #Embed the face once, so recognition never has to re-embed stored faces. If the gate finds no face, the
+        #embedding model looks for it itself, so a new guest is never lost
+        observation = self._face_gate.detect(face_frame) if self._face_gate is not None else None
+        embedding = self._embed(face_frame, observation)
+
+        def write_files(guest):
+            #Write Face and Name Audio to files in data/, both on disk before the guest is committed
+            try:
+                write_photo(guest['face_file_name'], face_frame)
+                default_writer().write_now(name_audio, guest['audio_file_name'], sample_rate = sample_rate)
+            except Exception:
+                for file_name in (guest['face_file_name'], guest['audio_file_name']):
+                    if os.path.exists(file_name):
+                        os.remove(file_name)
+                raise
 
-        #Write Face to file in data/ and record
-        face_file_name = os.path.join('data/faces', str(guest_id) + '.jpg')
-        write_photo(face_file_name, face_frame)
+        #Record new guest, the store allocates the id atomically and only commits once its files exist
+        guest_id = self.store.add(name, prepare = write_files,
+            face_file_name = os.path.join('data/faces', '{id}.jpg'),
+            audio_file_name = default_writer().file_name(os.path.join('data/names', '{id}.wav')))
+        #Indexed only once committed, since a rolled back id is handed out again. Adding an embedding twice is harmless
+        self.face_index.add(guest_id, embedding)
+        guest = self.store.get(guest_id)
 
-        #Write Name Audio to file ind ata/ and record
-        audio_file_name = os.path.join('data/names', str(guest_id) + '.wav')
-        write_audio(name_audio, audio_file_name, sample_rate = sample_rate)
+        if self._tracker is not None:
+            #Faces recognized before may match the new guest better
+            self._tracker.invalidate()
+            if observation is not None:
+                self._tracker.resolve(observation, (guest, 1.0), embedding)
+
+        #Voice prints of the spoken name and of the wake phrase
+        self.voice_id.enroll(guest_id, name_audio)
+        if voice_audio is not None:
+            self.voice_id.enroll(guest_id, voice_audio)
+        return guest_id
+
+    def add_voice(self, guest_id, audio):
+        """Add a recording of a known guest to their voice prints, so their voice is recognized more reliably."""
+        return self.voice_id.enroll(guest_id, audio)
+
+    def recognize_voice(self, audio):
+        """Return the (guest, similarity) pair of the guest whose voice matches a recording, or None."""
+        match = self.voice_id.identify(audio)
+        if match is None:
+            return None
+        guest_id, score = match
+        return self.store.get(guest_id), score
+
+    def _embed(self, face_frame, observation = None):
+        """Embed the face the face gate observed in a frame, or without an observation, the whole frame."""
+        if observation is None:
+            with span('face_embedding'):
+                return self._face_service.submit_embed(face_frame).result(timeout=self._embed_timeout)
+
+        crop = self._face_gate.crop(face_frame, observation)
+        with span('face_embedding'):
+            return self._face_service.submit_embed(crop, detector_backend = 'skip').result(timeout=self._embed_timeout)
+
+    def recognize(self, face_frame, k = 1, observation = None, candidate_id = None):
+        """
+        Find the stored guests whose faces best match the face in a frame.
+        Returns up to k (guest, similarity) pairs, best match first, and
+        none without running the embedding model if the face gate rejects the frame.
+        A face the tracker already recognized returns only its cached match,
+        without embedding it while the tracker still trusts the match.
+        Pass the face gate's `observation` of the frame if the caller already has it.
+        If the face matches the guest `candidate_id`, e.g. whom the speaker's
+        voice sounded like, that guest alone is returned.
+        """
+        if self._face_gate is None:
+            observation = None
+        else:
+            if observation is None:
+                observation = self._face_gate.detect(face_frame)
+            if observation is None:
+                return []
 
-        #Record new guest in memory
-        self.guests.append({
-            'id': guest_id,
-            'name': name,
-            'audio_file_name': audio_file_name,
-            'face_file_name': face_file_name
-        })
+        #A face the tracker followed since it was recognized is answered without running the face model
+        if self._tracker is not None:
+            identity = self._tracker.lookup(observation)
+            if identity is not None:
+                return [identity]
 
-        #Overwrite disk Guest Log with new updated guest
-        with open(self._guest_log_file_name, 'w', encoding='utf-8') as f:
-            json.dump(self.guests, f, ensure_ascii=False, indent=4)
+        embedding = self._embed(face_frame, observation)
+        #One it recognized longer ago only needs its embedding checked, not searched for
+        if self._tracker is not None:
+            identity = self._tracker.lookup(observation, embedding)
+            if identity is not None:
+                return [identity]
+        with span('face_lookup'):
+            matches = []
+            if candidate_id is not None:
+                score = self.face_index.similarity(candidate_id, embedding)
+                if score is not None and score >= self._match_threshold:
+                    matches = [(candidate_id, score)]
+            if not matches:
+                matches = self.face_index.query(embedding, k=k, threshold=self._match_threshold)
+        matches = [(self.store.get(guest_id), score) for guest_id, score in matches]
+        #An embedding left behind by an enrollment which failed to commit has no guest
+        matches = [(guest, score) for guest, score in matches if guest is not None]
+        if self._tracker is not None and matches:
+            self._tracker.resolve(observation, matches[0], embedding)
+        return matches
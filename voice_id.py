@@ -0,0 +1,164 @@
+import os
+from functools import lru_cache
+
+import numpy as np
+import soundfile
+
+from embedding_index import EmbeddingIndex
+from metrics import span
+
+@lru_cache(maxsize=4)
+def _mel_filterbank(num_filters, fft_size, sample_rate):
+    """Triangular mel filters as a (num_filters, fft_size // 2 + 1) matrix."""
+    def hz_to_mel(hz):
+        return 2595 * np.log10(1 + hz / 700)
+
+    def mel_to_hz(mel):
+        return 700 * (10 ** (mel / 2595) - 1)
+
+    mels = np.linspace(hz_to_mel(0), hz_to_mel(sample_rate / 2), num_filters + 2)
+    bins = np.floor((fft_size + 1) * mel_to_hz(mels) / sample_rate).astype(int)
+
+    filters = np.zeros((num_filters, fft_size // 2 + 1), dtype=np.float32)
+    for i in range(num_filters):
+        left, center, right = bins[i], bins[i + 1], bins[i + 2]
+        filters[i, left:center] = (np.arange(left, center) - left) / max(center - left, 1)
+        filters[i, center:right] = (right - np.arange(center, right)) / max(right - center, 1)
+    return filters
+
+@lru_cache(maxsize=4)
+def _dct_matrix(num_coefficients, num_filters):
+    """Orthonormal DCT-II rows, so the cepstrum of every frame is one matrix product."""
+    n = np.arange(num_filters)
+    k = np.arange(num_coefficients)[:, None]
+    dct = np.cos(np.pi * k * (2 * n + 1) / (2 * num_filters)) * np.sqrt(2 / num_filters)
+    dct[0] /= np.sqrt(2)
+    return dct.astype(np.float32)
+
+def mfcc(audio, sample_rate = 16_000, num_coefficients = 20, num_filters = 40, frame_seconds = 0.025,
+         hop_seconds = 0.01):
+    """
+    Mel-frequency cepstral coefficients of int16 audio, computed for all
+    frames at once. Returns a (frames, num_coefficients) matrix and the log
+    energy of every frame.
+    """
+    audio = np.asarray(audio, dtype=np.float32) / 32768
+    frame_length = int(frame_seconds * sample_rate)
+    hop_length = int(hop_seconds * sample_rate)
+    if len(audio) < frame_length:
+        return np.zeros((0, num_coefficients), dtype=np.float32), np.zeros(0, dtype=np.float32)
+
+    #Pre-emphasis, then every frame as a strided view of the signal
+    emphasized = np.append(audio[:1], audio[1:] - 0.97 * audio[:-1])
+    frames = np.lib.stride_tricks.sliding_window_view(emphasized, frame_length)[::hop_length]
+    fft_size = 1 << (frame_length - 1).bit_length()
+    power = np.abs(np.fft.rfft(frames * np.hamming(frame_length).astype(np.float32), n=fft_size, axis=1)) ** 2
+
+    mel_energies = power @ _mel_filterbank(num_filters, fft_size, sample_rate).T
+    log_mel = np.log(mel_energies + 1e-10)
+    log_energy = np.log(power.sum(axis=1) + 1e-10)
+    return log_mel @ _dct_matrix(num_coefficients, num_filters).T, log_energy
+
+def speaker_embedding(audio, sample_rate = 16_000, min_voiced_seconds = 0.3, hop_seconds = 0.01):
+    """
+    Fixed-size voice print of a clip: the mean and spread of the MFCCs of
+    its loudest frames, leaving out the energy coefficient. Returns None if
+    the clip holds too little speech.
+    """
+    coefficients, log_energy = mfcc(audio, sample_rate, hop_seconds=hop_seconds)
+    if len(coefficients) == 0:
+        return None
+
+    #Frames within 30 dB of the loudest are taken to be speech
+    voiced = log_energy > log_energy.max() - np.log(1000)
+    if np.count_nonzero(voiced) * hop_seconds < min_voiced_seconds:
+        return None
+    coefficients = coefficients[voiced, 1:]
+    return np.concatenate([coefficients.mean(axis=0), coefficients.std(axis=0)])
+
+def load_clip(file_name, sample_rate = 16_000):
+    """Read a recording as mono int16 at `sample_rate`, resampling linearly if needed."""
+    audio, file_sample_rate = soundfile.read(file_name, dtype='int16', always_2d=True)
+    audio = audio.mean(axis=1)
+    if file_sample_rate != sample_rate:
+        positions = np.arange(int(len(audio) * sample_rate / file_sample_rate)) * file_sample_rate / sample_rate
+        audio = np.interp(positions, np.arange(len(audio)), audio)
+    return audio.astype(np.int16)
+
+class VoiceIdentifier:
+    """
+    Identifies returning guests by their voice. Voice prints of each guest's
+    recordings are kept in an EmbeddingIndex; a guest may have several, e.g.
+    their spoken name and earlier wake phrases. A match needs both a high
+    similarity and a clear lead over the next best guest, since a short clip
+    is a weak voice print. With a single guest enrolled there is nobody to
+    lead, so a much higher similarity is needed instead.
+    """
+
+    def __init__(self, index_file_name, sample_rate = 16_000, match_threshold = 0.9, margin = 0.02,
+                 single_guest_threshold = 0.97):
+        """
+        Constructor.
+        :param index_file_name: Path of the voice print matrix, see EmbeddingIndex.
+        :param sample_rate: Sample rate of the audio passed in.
+        :param match_threshold: Least cosine similarity for a match.
+        :param margin: How much the best guest must beat the next best guest by.
+        :param single_guest_threshold: Least cosine similarity for a match while only one guest has voice prints.
+        """
+        self.index = EmbeddingIndex(index_file_name)
+        self.sample_rate = sample_rate
+        self._match_threshold = match_threshold
+        self._margin = margin
+        self._single_guest_threshold = single_guest_threshold
+
+    def enroll(self, guest_id, audio):
+        """Add a voice print of a recording to a guest. Returns False if it held too little speech."""
+        embedding = speaker_embedding(audio, self.sample_rate)
+        if embedding is None:
+            return False
+        self.index.add(guest_id, embedding)
+        return True
+
+    def enroll_missing(self, guests):
+        """Enroll the name recordings of guests who have no voice print yet. Returns how many were added."""
+        enrolled = set(self.index.keys().tolist())
+        keys, embeddings = [], []
+        for guest in guests:
+            file_name = guest.get('audio_file_name')
+            if guest['id'] in enrolled or not file_name or not os.path.exists(file_name):
+                continue
+            try:
+                embedding = speaker_embedding(load_clip(file_name, self.sample_rate), self.sample_rate)
+            except Exception as e:
+                print("[Voice ID] Could not read", file_name, e)
+                continue
+            if embedding is not None:
+                keys.append(guest['id'])
+                embeddings.append(embedding)
+        if keys:
+            self.index.add_many(keys, embeddings)
+        return len(keys)
+
+    def identify(self, audio):
+        """Return (guest id, similarity) of the guest whose voice matches, or None."""
+        with span('voice_id'):
+            embedding = speaker_embedding(audio, self.sample_rate)
+            if embedding is None or len(self.index) == 0:
+                return None
+            #Dissimilar guests are kept too, they are still runners up
+            matches = self.index.query(embedding, k=8, threshold=-1.0)
+
+        if len(matches) == 0 or matches[0][1] < self._match_threshold:
+            return None
+        guest_id, score = matches[0]
+        #Other voice prints of the same guest don't count against them
+        runner_up = next((other_score for other_id, other_score in matches[1:] if other_id != guest_id), None)
+        if runner_up is None:
+            if len(np.unique(self.index.keys())) < 2:
+                #Nobody to compare with, so only a near certain match counts
+                return (guest_id, score) if score >= self._single_guest_threshold else None
+            #Every match returned was this guest's, so the other guests score at most the lowest of them
+            runner_up = matches[-1][1]
+        if score - runner_up < self._margin:
+            return None
+        return guest_id, score